@@ -0,0 +1,314 @@
+"""
+Benchmarks of the CPU bound parts of the analysis
+
+    python3 -m benchmark
+    python3 -m benchmark --scale 0.01 --output bench.json
+    python3 -m benchmark --baseline bench.json --max-slowdown 1.25
+
+Each stage runs on synthetic datapoints and object listings: 10k buckets and 10M objects
+at scale 1. The results are saved as JSON in ns per item so that runs at different scales
+and commits can be compared; a stage slower than the baseline by more than
+--max-slowdown fails the run.
+"""
+import argparse
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+from operator import itemgetter
+import pytz
+try:
+    import numpy as np
+except ImportError:
+    # the columnar fold is not timed
+    np = None
+
+import s3_storage_analyser
+from s3_storage_analyser import (
+    fold_metrics_data, _format_buckets, _json_dumps,
+    update_gauges, update_s3_gauges, traverse_key_range, _merge_storage_stats,
+    _parse_objects_page, STORAGE_TYPES, FOLDED_KEYS, _PREFIX_TREE_MAX_NODES
+)
+
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1', 'eu-west-1',
+           'eu-west-2', 'eu-central-1', 'ap-south-1', 'ap-southeast-1', 'ap-southeast-2',
+           'ap-northeast-1', 'ap-northeast-2', 'sa-east-1', 'eu-west-3', 'cn-north-1']
+PAGE_SIZE = 1000
+
+_FOLDED_COLUMNS = ['Files', 'Bytes', 'Bytes-ST', 'Bytes-RR', 'Bytes-IA']
+# (MetricName, StorageType) -> index of the folded column
+_FOLDED_KEY_CODES = {tuple(key.split(':')): _FOLDED_COLUMNS.index(column)
+                     for key, column in FOLDED_KEYS.items()}
+
+def fold_metrics_data_columnar(metrics_data):
+    """Experiment: same result as fold_metrics_data.
+    The datapoints are encoded as numpy arrays of bucket/region/storage codes and values;
+    the sums by bucket, region and storage are computed with bincount.
+    Building the output dicts dominates: it is only ~15% faster so the analysis does not use it"""
+    count = len(metrics_data)
+    def _column(prop):
+        return list(map(itemgetter(prop), metrics_data))
+    def _encode(names):
+        """Codes in the order of first appearance like the dicts of fold_metrics_data"""
+        codes = dict.fromkeys(names)
+        for code, name in enumerate(codes):
+            codes[name] = code
+        return codes, np.fromiter(map(codes.__getitem__, names), np.int64, count)
+    bucket_codes, buckets = _encode(_column('BucketName'))
+    region_codes, regions = _encode(_column('Region'))
+    storage_names = _column('StorageType')
+    storage_codes, storages = _encode(storage_names)
+    metric_names = _column('MetricName')
+    metric_codes, metrics = _encode(metric_names)
+    keys = np.fromiter(map(_FOLDED_KEY_CODES.__getitem__, zip(metric_names, storage_names)),
+                       np.int64, count)
+    is_files = metrics == metric_codes.get('NumberOfObjects', -1)
+    values = np.fromiter(map(itemgetter('Value'), metrics_data), np.float64, count)
+
+    def _sum_by(codes, size, columns, column_codes):
+        """sums[code][column]"""
+        flat = codes * columns + column_codes
+        sums = np.bincount(flat, weights=values, minlength=size * columns).astype(object)
+        # A cell without any datapoint stays 0 like in fold_metrics_data
+        sums[np.bincount(flat, minlength=size * columns) == 0] = 0
+        return sums.reshape(size, columns).tolist()
+
+    ncolumns = len(_FOLDED_COLUMNS)
+    bucket_sums = _sum_by(buckets, len(bucket_codes), ncolumns, keys)
+    region_sums = _sum_by(regions, len(region_codes), ncolumns, keys)
+    storage_sums = _sum_by(storages, len(storage_codes), 2, (~is_files).astype(np.int64))
+    region_buckets = np.bincount(regions[is_files], minlength=len(region_codes)).tolist()
+    first_datapoints = np.unique(buckets, return_index=True)[1].tolist()
+    # The CreationDate comes from the last NumberOfObjects datapoint of the bucket
+    creation_datapoints = np.full(len(bucket_codes), -1, np.int64)
+    np.maximum.at(creation_datapoints, buckets[is_files], np.flatnonzero(is_files))
+    creation_datapoints = creation_datapoints.tolist()
+
+    bybucket = {}
+    for bucket, code in bucket_codes.items():
+        folded = {'Bucket': bucket, 'Region': metrics_data[first_datapoints[code]]['Region']}
+        folded.update(zip(_FOLDED_COLUMNS, bucket_sums[code]))
+        creation = creation_datapoints[code]
+        folded['CreationDate'] = metrics_data[creation]['CreationDate'] if creation >= 0 \
+            else pytz.utc.localize(datetime.min)
+        bybucket[bucket] = folded
+    byregion = {}
+    for region, code in region_codes.items():
+        folded = {'Buckets': region_buckets[code], 'Region': region}
+        folded.update(zip(_FOLDED_COLUMNS, region_sums[code]))
+        byregion[region] = folded
+    bystorage = {}
+    for storage, code in storage_codes.items():
+        bystorage[storage] = dict(zip(['Files', 'Bytes'], storage_sums[code]))
+    return {
+        'bybucket': bybucket,
+        'byregion': byregion,
+        'bystorage': bystorage
+    }
+
+def make_datapoints(nb_buckets):
+    """Datapoints as returned by get_metrics_data: 5 per bucket"""
+    datapoints = []
+    for i in range(0, nb_buckets):
+        bucket = {
+            'Name': f'bucket{i:06d}',
+            'Region': REGIONS[i % len(REGIONS)],
+            'CreationDate': pytz.utc.localize(datetime(2017, 11, 16))
+        }
+        for metric_name, storage_type, value in [
+                ('NumberOfObjects', 'AllStorageTypes', 1000.0 + i),
+                ('BucketSizeBytes', 'AllStorageTypes', 3000.0 * i),
+                ('BucketSizeBytes', 'StandardStorage', 1000.0 * i),
+                ('BucketSizeBytes', 'StandardIAStorage', 1000.0 * i),
+                ('BucketSizeBytes', 'ReducedRedundancyStorage', 1000.0 * i)]:
+            datapoint = dict(bucket)
+            datapoint.update({
+                'MetricName': metric_name,
+                'BucketName': bucket['Name'],
+                'StorageType': storage_type,
+                'Value': value
+            })
+            datapoints.append(datapoint)
+    return datapoints
+
+def make_objects_page(page_index=0):
+    """A page of (Key, Size, LastModified timestamp, StorageClass) as yielded by _list_objects"""
+    start = datetime(2017, 1, 1, tzinfo=timezone.utc).timestamp()
+    return [(f'logs/{page_index % 100:03d}/{page_index:08d}-{i:04d}.json',
+             (i * 7919) % 10000000 + 1,
+             start + (page_index * PAGE_SIZE + i) * 60.0,
+             STORAGE_TYPES[0] if i % 10 else STORAGE_TYPES[2])
+            for i in range(0, PAGE_SIZE)]
+
+def make_objects_body(page_index=0):
+    """The XML body of a ListObjectsV2 page as sent by S3"""
+    contents = b''.join(
+        b'<Contents><Key>%s</Key><LastModified>%s</LastModified>'
+        b'<ETag>&quot;900150983cd24fb0d6963f7d28e17f72&quot;</ETag><Size>%d</Size>'
+        b'<StorageClass>%s</StorageClass></Contents>' % (
+            key.encode(),
+            datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime(
+                '%Y-%m-%dT%H:%M:%S.000Z').encode(),
+            size, storage_class.encode())
+        for key, size, timestamp, storage_class in make_objects_page(page_index))
+    return (b'<?xml version="1.0" encoding="UTF-8"?>'
+            b'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            b'<Name>bucket</Name><KeyCount>1000</KeyCount><MaxKeys>1000</MaxKeys>'
+            b'<IsTruncated>true</IsTruncated><NextContinuationToken>token</NextContinuationToken>'
+            + contents + b'</ListBucketResult>')
+
+def make_bucket_stats(nb_buckets):
+    """Raw S3 stats of the buckets as returned by s3_bucket_stats"""
+    page = make_objects_page()
+    with _listing([page]):
+        partial_stats = traverse_key_range({'Bucket': {'Name': 'bucket'}})
+    return [_merge_storage_stats({
+        'Name': f'bucket{i:06d}',
+        'Region': REGIONS[i % len(REGIONS)],
+        'CreationDate': pytz.utc.localize(datetime(2017, 11, 16))
+    }, [partial_stats]) for i in range(0, nb_buckets)]
+
+@contextmanager
+def _listing(pages):
+    """Replace the S3 listing with the pages"""
+    list_objects = s3_storage_analyser._list_objects
+    s3_storage_analyser._list_objects = lambda **_kwargs: iter(pages)
+    try:
+        yield
+    finally:
+        s3_storage_analyser._list_objects = list_objects
+
+def _stage_fold(nb_buckets, _nb_objects):
+    datapoints = make_datapoints(nb_buckets)
+    return lambda: fold_metrics_data(datapoints), len(datapoints)
+
+def _stage_fold_columnar(nb_buckets, _nb_objects):
+    datapoints = make_datapoints(nb_buckets)
+    return lambda: fold_metrics_data_columnar(datapoints), len(datapoints)
+
+def _stage_format_buckets(nb_buckets, _nb_objects):
+    folded = fold_metrics_data(make_datapoints(nb_buckets))
+    return lambda: _format_buckets(folded['bybucket'].values()), nb_buckets
+
+def _stage_json_dumps(nb_buckets, _nb_objects):
+    folded = fold_metrics_data(make_datapoints(nb_buckets))
+    return lambda: _json_dumps(folded['bybucket']), nb_buckets
+
+def _stage_update_gauges(nb_buckets, _nb_objects):
+    datapoints = make_datapoints(nb_buckets)
+    return lambda: update_gauges(datapoints), len(datapoints)
+
+def _stage_update_s3_gauges(nb_buckets, _nb_objects):
+    bucket_stats = make_bucket_stats(nb_buckets)
+    return lambda: update_s3_gauges(bucket_stats), nb_buckets
+
+def _stage_traverse(_nb_buckets, nb_objects, prefix_depth=0):
+    # the same pages are listed again: the keys repeat but the cost per object is the same
+    pages = [make_objects_page(index) for index in range(0, 100)]
+    nb_pages = max(nb_objects // PAGE_SIZE, 1)
+    key_range = {'Bucket': {'Name': 'bucket'}}
+    if prefix_depth:
+        key_range['_prefix_tree'] = {'depth': prefix_depth, 'max_nodes': _PREFIX_TREE_MAX_NODES}
+    def _traverse():
+        with _listing(pages[index % len(pages)] for index in range(0, nb_pages)):
+            traverse_key_range(key_range)
+    return _traverse, nb_pages * PAGE_SIZE
+
+def _stage_traverse_prefixes(nb_buckets, nb_objects):
+    return _stage_traverse(nb_buckets, nb_objects, prefix_depth=2)
+
+def _stage_parse_objects_page(_nb_buckets, nb_objects):
+    body = make_objects_body()
+    nb_pages = max(nb_objects // PAGE_SIZE, 1)
+    def _parse():
+        for _index in range(0, nb_pages):
+            _parse_objects_page({'status_code': 200, 'body': body}, {})
+    return _parse, nb_pages * PAGE_SIZE
+
+# name -> function(nb_buckets, nb_objects) returning the function to time and the number of items
+STAGES = {
+    'fold_metrics_data': _stage_fold,
+    'fold_metrics_data_columnar': _stage_fold_columnar,
+    'format_buckets': _stage_format_buckets,
+    'json_dumps': _stage_json_dumps,
+    'update_gauges': _stage_update_gauges,
+    'update_s3_gauges': _stage_update_s3_gauges,
+    'traverse_key_range': _stage_traverse,
+    'traverse_key_range_prefixes': _stage_traverse_prefixes,
+    'parse_objects_page': _stage_parse_objects_page
+}
+if np is None:
+    del STAGES['fold_metrics_data_columnar']
+
+def run(nb_buckets=10000, nb_objects=10000000, repeat=3, stages=None):
+    """Time the stages; keep the best of repeat runs"""
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'buckets': nb_buckets,
+        'objects': nb_objects,
+        'stages': {}
+    }
+    for name in stages or STAGES.keys():
+        bench, items = STAGES[name](nb_buckets, nb_objects)
+        seconds = min(timeit.repeat(bench, number=1, repeat=repeat))
+        results['stages'][name] = {
+            'seconds': seconds,
+            'items': items,
+            'ns_per_item': seconds * 1e9 / items
+        }
+    return results
+
+def compare(results, baseline, max_slowdown=1.25):
+    """The stages slower than in the baseline by more than max_slowdown:
+    [(name, ratio)]"""
+    regressions = []
+    for name, stage in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            continue
+        ratio = stage['ns_per_item'] / base['ns_per_item']
+        if ratio > max_slowdown:
+            regressions.append((name, ratio))
+    return regressions
+
+def main(args=None):
+    """CLI entry point: return the exit code"""
+    parser = argparse.ArgumentParser(description='Benchmarks of the analysis hot paths')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplies the 10k buckets and 10M objects')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stage', action='append', choices=list(STAGES.keys()),
+                        help='Stage to run; all of them by default')
+    parser.add_argument('--output', help='Save the results as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--max-slowdown', type=float, default=1.25,
+                        help='Fail when a stage is slower than the baseline by more than this ratio')
+    args = parser.parse_args(args)
+    # update_gauges writes the exposition
+    os.environ.setdefault('PROM_TEXT', os.path.join(tempfile.mkdtemp(), 's3-metrics.prom'))
+    results = run(nb_buckets=max(int(10000 * args.scale), 1),
+                  nb_objects=max(int(10000000 * args.scale), PAGE_SIZE),
+                  repeat=args.repeat, stages=args.stage)
+    for name, stage in results['stages'].items():
+        print(f"{name:28} {stage['items']:>10} items {stage['seconds'] * 1000:10.1f}ms "
+              f"{stage['ns_per_item']:10.1f}ns/item")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, max_slowdown=args.max_slowdown)
+        for name, ratio in regressions:
+            print(f'{name} is {ratio:.2f} times slower than the baseline', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
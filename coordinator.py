@@ -0,0 +1,423 @@
+"""
+Distributed raw S3 analysis: a coordinator serves the (bucket, key range) shards of the
+account to workers on other hosts and merges their partial stats
+
+    python3 -m coordinator serve --db shards.sqlite --ranges 16
+    python3 -m coordinator work http://coordinator:8001 --conc 4
+
+The shards and the partial stats sent back are kept in SQLite: a coordinator restarted
+with --resume carries on where it stopped. A worker leases one shard at a time and renews
+the lease while it scans it; the shard of a worker that stops renewing is leased again
+once its lease expires. A worker that fails to scan a shard releases it; after
+MAX_ATTEMPTS the shard is left out of the results.
+
+The coordinator only listens on localhost unless TOKEN is set: the workers send it.
+"""
+import argparse
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from s3_storage_analyser import (
+    list_buckets, plan_key_ranges, merge_key_range_stats, traverse_key_range,
+    partial_stats_to_json, partial_stats_from_json, update_s3_gauges, commit_s3_gauges,
+    format_prefix_report, set_pool, conc_map, timed_phase, TraversalCancelled, EXECUTORS)
+
+DEFAULT_PORT = 8001
+LEASE_SECONDS = 300
+# Seconds between two lease requests of an idle worker
+POLL_SECONDS = 5
+# Once the analysis is complete, keep answering the idle workers for this long
+LINGER_SECONDS = 2 * POLL_SECONDS
+# A shard released this many times is failed
+MAX_ATTEMPTS = 5
+_LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+def _bucket_to_json(bucket):
+    return dict(bucket, CreationDate=bucket['CreationDate'].timestamp())
+
+def _bucket_from_json(bucket):
+    return dict(bucket, CreationDate=datetime.fromtimestamp(bucket['CreationDate'], tz=timezone.utc))
+
+def _key_range_to_json(key_range):
+    # the checkpoints of the coordinator are the results kept in its database
+    return dict({key: value for key, value in key_range.items() if key != '_checkpoint'},
+                Bucket=_bucket_to_json(key_range['Bucket']))
+
+def _key_range_from_json(key_range):
+    return dict(key_range, Bucket=_bucket_from_json(key_range['Bucket']))
+
+class ShardQueue:
+    """Durable queue of the shards of an analysis in a SQLite database.
+    A shard is pending, leased until its lease expires, done with its partial stats
+    or failed once released MAX_ATTEMPTS times"""
+    def __init__(self, path, lease_seconds=LEASE_SECONDS):
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                bucket TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS shards (
+                id INTEGER PRIMARY KEY,
+                key_range TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                lease TEXT,
+                expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT);
+        ''')
+
+    def add(self, buckets, key_ranges):
+        """Replace the shards with the key ranges of the buckets"""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.execute('DELETE FROM buckets')
+            self._db.execute('DELETE FROM shards')
+            self._db.executemany('INSERT INTO buckets (name, bucket) VALUES (?, ?)', [
+                (bucket['Name'], json.dumps(_bucket_to_json(bucket))) for bucket in buckets])
+            self._db.executemany('INSERT INTO shards (key_range) VALUES (?)', [
+                (json.dumps(_key_range_to_json(key_range)),) for key_range in key_ranges])
+            self._db.execute('COMMIT')
+
+    def lease(self):
+        """Lease a pending or expired shard {'Id','KeyRange','Lease','LeaseSeconds'}
+        or return None when they are all leased or done"""
+        now = time.time()
+        with self._lock:
+            self._fail_expired(now)
+            row = self._db.execute(
+                "SELECT id, key_range FROM shards WHERE state = 'pending'"
+                " OR (state = 'leased' AND expires < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            lease = uuid.uuid4().hex
+            self._db.execute(
+                "UPDATE shards SET state = 'leased', lease = ?, expires = ?,"
+                " attempts = attempts + 1 WHERE id = ?", (lease, now + self.lease_seconds, row[0]))
+        return {
+            'Id': row[0],
+            'KeyRange': json.loads(row[1]),
+            'Lease': lease,
+            'LeaseSeconds': self.lease_seconds
+        }
+
+    def renew(self, shard_id, lease):
+        """Extend a lease; False when the shard was leased again or is done"""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE shards SET expires = ? WHERE id = ? AND lease = ? AND state = 'leased'",
+                (time.time() + self.lease_seconds, shard_id, lease))
+        return cursor.rowcount == 1
+
+    def complete(self, shard_id, lease, partial_stats):
+        """Keep the serialized partial stats of a shard.
+        False when the lease was lost: the shard was leased again, released or is done"""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE shards SET state = 'done', lease = NULL, result = ?"
+                " WHERE id = ? AND lease = ? AND state = 'leased'",
+                (json.dumps(partial_stats), shard_id, lease))
+        return cursor.rowcount == 1
+
+    def release(self, shard_id, lease):
+        """Hand over a shard that could not be scanned to the next worker;
+        it is failed after MAX_ATTEMPTS. False when the lease was lost"""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE shards SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+                " lease = NULL, expires = NULL WHERE id = ? AND lease = ? AND state = 'leased'",
+                (MAX_ATTEMPTS, shard_id, lease))
+        return cursor.rowcount == 1
+
+    def _fail_expired(self, now):
+        """The shards whose last of MAX_ATTEMPTS leases expired crashed their workers: failed"""
+        self._db.execute(
+            "UPDATE shards SET state = 'failed', lease = NULL, expires = NULL"
+            " WHERE state = 'leased' AND expires < ? AND attempts >= ?", (now, MAX_ATTEMPTS))
+
+    def counts(self):
+        """Number of shards per state"""
+        with self._lock:
+            self._fail_expired(time.time())
+            rows = self._db.execute('SELECT state, COUNT(*) FROM shards GROUP BY state').fetchall()
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        counts.update(dict(rows))
+        return counts
+
+    def finished(self):
+        """True when all the shards are done or failed"""
+        counts = self.counts()
+        return counts['pending'] == 0 and counts['leased'] == 0
+
+    def bucket_stats(self, top_prefixes=10):
+        """Merge the partial stats of the shards into the stats of their buckets"""
+        with self._lock:
+            buckets = [_bucket_from_json(json.loads(row[0])) for row in self._db.execute(
+                'SELECT bucket FROM buckets ORDER BY name')]
+            rows = self._db.execute(
+                "SELECT key_range, result FROM shards WHERE state = 'done' ORDER BY id").fetchall()
+        key_ranges = [_key_range_from_json(json.loads(row[0])) for row in rows]
+        partial_stats = [partial_stats_from_json(json.loads(row[1])) for row in rows]
+        return merge_key_range_stats(buckets, key_ranges, partial_stats, top_prefixes)
+
+    def close(self):
+        self._db.close()
+
+_SHARD_PATH = re.compile(r'^/shards/(\d+)(/renew|/release)?$')
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    """POST /lease: 200 and a lease, 204 when all the shards are leased, 410 once done
+    POST /shards/ID {'Lease','Stats'}: the partial stats of a shard; 204 or 409 when the lease was lost
+    POST /shards/ID/renew {'Lease'}: 204 or 409 when the lease was lost
+    POST /shards/ID/release {'Lease'}: the shard could not be scanned; 204 or 409
+    GET /status: the number of shards per state"""
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path == '/status':
+            self._send_json(200, self.server.queue.counts())
+            return
+        self._send_json(404, {'Error': 'Not found'})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        queue = self.server.queue
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        params = json.loads(body) if body else {}
+        if self.path == '/lease':
+            if self.server.finished.is_set():
+                self._send_json(410, {'Error': 'The analysis is complete'})
+                return
+            lease = queue.lease()
+            if lease is None:
+                self._send_json(204)
+                return
+            self._send_json(200, lease)
+            return
+        match = _SHARD_PATH.match(self.path)
+        if match is None:
+            self._send_json(404, {'Error': 'Not found'})
+            return
+        shard_id = int(match.group(1))
+        if match.group(2) == '/renew':
+            self._send_json(204 if queue.renew(shard_id, params['Lease']) else 409)
+            return
+        if match.group(2) == '/release':
+            updated = queue.release(shard_id, params['Lease'])
+        else:
+            updated = queue.complete(shard_id, params['Lease'], params['Stats'])
+        if queue.finished():
+            self.server.finished.set()
+        self._send_json(204 if updated else 409)
+
+    def _authorized(self):
+        token = os.getenv('TOKEN')
+        if token and self.headers.get('X-Token') != token:
+            self._send_json(403, {'Error': 'Invalid token'})
+            return False
+        return True
+
+    def _send_json(self, status, data=None):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        if body:
+            self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+class CoordinatorServer(ThreadingMixIn, HTTPServer):
+    """Serve the shards of a queue; finished is set once they are all done"""
+    daemon_threads = True
+
+    def __init__(self, queue, host='localhost', port=DEFAULT_PORT):
+        if host not in _LOCAL_HOSTS and not os.getenv('TOKEN'):
+            raise ValueError(f'Set TOKEN to serve the shards on {host or "all the interfaces"}')
+        HTTPServer.__init__(self, (host, port), CoordinatorHandler)
+        self.queue = queue
+        self.finished = threading.Event()
+        if queue.finished():
+            self.finished.set()
+
+def coordinate(db, host='localhost', port=DEFAULT_PORT, prefix=None, ranges=None, resume=False,
+               lease_seconds=LEASE_SECONDS, prefix_depth=0, top_prefixes=10, prefix_gauges=False,
+               fast_list=False, conc=None, executor=None, linger=LINGER_SECONDS):
+    """Plan the shards of the account, serve them until the workers have scanned them all,
+    then merge their partial stats and update the s3 gauges"""
+    set_pool(conc, executor)
+    queue = ShardQueue(db, lease_seconds=lease_seconds)
+    if not resume or sum(queue.counts().values()) == 0:
+        with timed_phase('s3', 'list_buckets'):
+            buckets = list_buckets(prefix=prefix)
+        with timed_phase('s3', 'split_buckets'):
+            key_ranges = plan_key_ranges(buckets, ranges=ranges, prefix_depth=prefix_depth,
+                                         fast_list=fast_list)
+        queue.add(buckets, key_ranges)
+    server = CoordinatorServer(queue, host=host, port=port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with timed_phase('s3', 'traverse'):
+            server.finished.wait()
+        with timed_phase('s3', 'merge'):
+            bucket_stats = queue.bucket_stats(top_prefixes)
+        failed = queue.counts()['failed']
+        if failed:
+            print(f'{failed} shards could not be scanned: their objects are not counted',
+                  file=sys.stderr)
+        with timed_phase('s3', 'update_gauges'):
+            update_s3_gauges(bucket_stats, prefix_gauges=prefix_gauges)
+        commit_s3_gauges()
+        # the idle workers learn that the analysis is complete
+        time.sleep(linger)
+        return bucket_stats
+    finally:
+        server.shutdown()
+        server.server_close()
+        queue.close()
+
+def _post(url, path, params=None):
+    """POST JSON to the coordinator; return the status and the decoded body"""
+    headers = {'Content-type': 'application/json'}
+    if os.getenv('TOKEN'):
+        headers['X-Token'] = os.environ['TOKEN']
+    request = Request(url.rstrip('/') + path, data=json.dumps(params or {}).encode(),
+                      headers=headers, method='POST')
+    try:
+        with urlopen(request) as response:
+            body = response.read()
+            return response.status, json.loads(body) if body else None
+    except HTTPError as err:
+        return err.code, None
+
+def _renew_lease(url, lease, stop, lost):
+    """Renew the lease every third of its duration until stop is set.
+    Set lost when the shard was leased again or the coordinator could not be reached
+    before the lease expired"""
+    renewed = time.time()
+    while not stop.wait(lease['LeaseSeconds'] / 3):
+        try:
+            status, _ = _post(url, f"/shards/{lease['Id']}/renew", {'Lease': lease['Lease']})
+        except URLError as err:
+            if time.time() - renewed < lease['LeaseSeconds']:
+                # the coordinator may be restarting: try again
+                continue
+            print(f"Unable to renew the lease of the shard {lease['Id']}: {err}", file=sys.stderr)
+            lost.set()
+            return
+        if status != 204:
+            print(f"Lost the lease of the shard {lease['Id']}", file=sys.stderr)
+            lost.set()
+            return
+        renewed = time.time()
+
+def _work_loop(params):
+    """Lease and scan shards until the analysis is complete; return the number scanned"""
+    url = params['url']
+    scanned = 0
+    while True:
+        try:
+            status, lease = _post(url, '/lease')
+        except URLError:
+            # the coordinator stopped once the analysis was complete
+            return scanned
+        if status == 410:
+            return scanned
+        if status == 204:
+            time.sleep(params.get('poll', POLL_SECONDS))
+            continue
+        if status != 200:
+            raise ValueError(f'Unable to lease a shard from {url}: {status}')
+        stop = threading.Event()
+        lost = threading.Event()
+        renewer = threading.Thread(target=_renew_lease, args=(url, lease, stop, lost), daemon=True)
+        renewer.start()
+        try:
+            partial_stats = traverse_key_range(
+                dict(_key_range_from_json(lease['KeyRange']), _cancel=lost))
+        except TraversalCancelled:
+            # another worker scans the shard
+            continue
+        except Exception as err:
+            print(f"Unable to scan the shard {lease['Id']}: {err}", file=sys.stderr)
+            try:
+                _post(url, f"/shards/{lease['Id']}/release", {'Lease': lease['Lease']})
+            except URLError:
+                # the shard is leased again once its lease expires
+                pass
+            continue
+        finally:
+            stop.set()
+            renewer.join()
+        try:
+            status, _ = _post(url, f"/shards/{lease['Id']}", {
+                'Lease': lease['Lease'], 'Stats': partial_stats_to_json(partial_stats)})
+        except URLError as err:
+            # the shard is leased again once its lease expires
+            print(f"Unable to send the stats of the shard {lease['Id']}: {err}", file=sys.stderr)
+            continue
+        if status == 204:
+            scanned += 1
+
+def work(url, conc=None, executor=None, poll=POLL_SECONDS):
+    """Run a worker per slot of the pool; return the number of shards scanned"""
+    set_pool(conc, executor)
+    return sum(conc_map(_work_loop, [{'url': url, 'poll': poll}] * (conc or 1), chunksize=1))
+
+def main(args=None):
+    """CLI entry point"""
+    parser = argparse.ArgumentParser(description='Distributed raw S3 analysis')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    serve = commands.add_parser('serve', help='Plan the shards and serve them to the workers')
+    serve.add_argument('--db', default='s3-shards.sqlite', help='SQLite database of the shards')
+    serve.add_argument('--host', default='localhost',
+                       help='Interface to listen on; TOKEN is required on other than localhost')
+    serve.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve.add_argument('--prefix', help='Only select buckets that match a glob. "s3://mybucke*"')
+    serve.add_argument('--ranges', type=int, help='Split each bucket in up to N key ranges')
+    serve.add_argument('--resume', action='store_true',
+                       help='Carry on with the shards and results kept in the database')
+    serve.add_argument('--lease-seconds', type=int, default=LEASE_SECONDS)
+    serve.add_argument('--prefix-depth', type=int, default=0)
+    serve.add_argument('--top-prefixes', type=int, default=10)
+    serve.add_argument('--prefix-gauges', action='store_true')
+    serve.add_argument('--fast-list', action='store_true')
+    serve.add_argument('--unit', choices=['B', 'KB', 'MB', 'GB', 'TB'], default='GB')
+    serve.add_argument('--conc', type=int, help='Number of parallel workers to plan the shards')
+    serve.add_argument('--executor', choices=EXECUTORS, default='process')
+    worker = commands.add_parser('work', help='Scan the shards leased from a coordinator')
+    worker.add_argument('url', help='http://coordinator:8001')
+    worker.add_argument('--conc', type=int, help='Number of shards scanned in parallel')
+    worker.add_argument('--executor', choices=EXECUTORS, default='process')
+    args = parser.parse_args(args)
+    if args.command == 'work':
+        print(f'Scanned {work(args.url, conc=args.conc, executor=args.executor)} shards')
+        return 0
+    bucket_stats = coordinate(args.db, host=args.host, port=args.port, prefix=args.prefix,
+                              ranges=args.ranges, resume=args.resume,
+                              lease_seconds=args.lease_seconds, prefix_depth=args.prefix_depth,
+                              top_prefixes=args.top_prefixes, prefix_gauges=args.prefix_gauges,
+                              fast_list=args.fast_list, conc=args.conc, executor=args.executor)
+    if args.prefix_depth > 0:
+        print(format_prefix_report(bucket_stats, unit=args.unit))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,17 +4,42 @@ S3 Storage Analysis Tool
 
 import argparse
 import os
+import sys
 import re
 import json
+import hashlib
+import math
+import random
+import csv
+import sqlite3
+import gzip
+import heapq
+from array import array
 from pprint import pprint
+import threading
+from contextlib import contextmanager
+from functools import partial
+from time import perf_counter
 import multiprocessing as multi
+from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from fnmatch import fnmatchcase
 from operator import itemgetter
+from bisect import bisect_left
 from datetime import datetime, timedelta, time, timezone
+from urllib.parse import urlparse, unquote_plus
+from html import unescape as html_unescape
 import pytz
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ParamValidationError
 import tabulate
-from prometheus_client import CollectorRegistry, Gauge, push_to_gateway, write_to_textfile
+from prometheus_client import (
+    CollectorRegistry, push_to_gateway, write_to_textfile, generate_latest)
+from prometheus_client.core import (
+    GaugeMetricFamily, CounterMetricFamily, HistogramMetricFamily)
+from prometheus_client.openmetrics.exposition import (
+    generate_latest as generate_latest_openmetrics, CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE)
 
 def parse_args(args=None):
     """cli parser"""
@@ -24,12 +49,47 @@ def parse_args(args=None):
                         help='file size unit B|KB|MB|GB|TB', default='MB')
     parser.add_argument('--prefix', help='Only select buckets that match a glob. "s3://mybucke*"')
     parser.add_argument('--conc', type=int, help='Number of parallel workers')
+    parser.add_argument('--executor', choices=EXECUTORS, default='process',
+                        help='Run the workers as sub processes or threads')
+    parser.add_argument('--adaptive', action='store_true', default=None,
+                        help='Adapt the number of AWS calls in flight to the throttling')
     parser.add_argument('--raws3', action='store_true', help='Long running S3 analysis')
+    parser.add_argument('--ranges', type=int,
+                        help='Split each bucket in up to N key ranges scanned in parallel (raws3)')
+    parser.add_argument('--sample', type=int, default=None, metavar='CALLS',
+                        help='Estimate the stats of each bucket with at most CALLS LIST requests (raws3)')
+    parser.add_argument('--fast-list', action='store_true',
+                        help='Parse the pages of objects without botocore (raws3)')
+    parser.add_argument('--prefix-depth', type=int, default=0,
+                        help='Aggregate the objects per prefix down to N levels of "/" (raws3)')
+    parser.add_argument('--top-prefixes', type=int, default=10,
+                        help='Number of heaviest prefixes per level in the report (raws3)')
+    parser.add_argument('--prefix-gauges', action='store_true',
+                        help='Export the heaviest prefixes as gauges (raws3)')
+    parser.add_argument('--inventory',
+                        help='Analyse the S3 Inventory reports found in a directory or file:// URL')
+    parser.add_argument('--checkpoint', help='Directory where the progress of raws3 is saved')
+    parser.add_argument('--checkpoint-pages', type=int, default=100,
+                        help='Save the progress every N pages of objects (raws3)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume the raws3 analysis saved in the checkpoint directory')
+    parser.add_argument('--batch', action='store_true',
+                        help='Fetch the datapoints with batched GetMetricData calls')
+    parser.add_argument('--direct', action='store_true',
+                        help='Plan the Cloudwatch queries from the buckets instead of calling ListMetrics')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Overlap the listing of the buckets, of the metrics and the datapoints fetches')
+    parser.add_argument('--snapshots',
+                        help='SQLite database where the daily datapoints are kept')
+    parser.add_argument('--backfill', type=int, default=1, metavar='DAYS',
+                        help='Fetch the DAYS last days missing from the snapshots')
+    parser.add_argument('--growth', type=int, metavar='DAYS',
+                        help='Report the growth of the buckets over DAYS days from the snapshots only')
     parser.add_argument(
         '--fmt', # type='string',
-        choices=['json_pretty', 'json', 'tsv', 'csv', 'plain', 'simple', 'grid',
+        choices=['json_pretty', 'json', 'ndjson', 'tsv', 'csv', 'plain', 'simple', 'grid',
                  'pipe', 'orgtbl', 'rst', 'mediawiki', 'latex', 'html'],
-        help='report format json|plain|simple|grid|pipe|orgtbl|rst|mediawiki|latex|tsv|csv|json_pretty|html',
+        help='report format json|ndjson|plain|simple|grid|pipe|orgtbl|rst|mediawiki|latex|tsv|csv|json_pretty|html',
         default='plain')
     return parser.parse_args(args)
 
@@ -42,18 +102,311 @@ def convert_bytes(nbytes, unit='MB', append_unit=False):
     formatted = ('%.2f' % (nbytes/UNIT_DEFS[unit])).rstrip('0').rstrip('.')
     return f'{formatted}{unit}' if append_unit else formatted
 
+EXECUTORS = ['process', 'thread']
+# The threads mostly wait on AWS: many more of them than cpus
+_IO_POOL_SIZE = 32
 _POOL_SIZE = [None]
+_EXECUTOR = ['process']
+# S3ANALYSER_ADAPTIVE=1: limit the AWS calls in flight with the _AdaptiveLimiter of their service
+_ADAPTIVE = [os.getenv('S3ANALYSER_ADAPTIVE', '0') == '1']
 __POOL = [None]
-def _conc_map(fct, iterable):
-    if __POOL[0] is not None:
-        return __POOL[0].map(fct, iterable)
-    if _POOL_SIZE[0] is None: # TODO: should we use more workers than we have cpus?
-        _POOL_SIZE[0] = multi.cpu_count()
-    if _POOL_SIZE[0] <= 1:
-        return map(fct, iterable)
-    pool = multi.Pool(_POOL_SIZE[0])
-    __POOL[0] = pool
-    return pool.map(fct, iterable)
+def conc_map(fct, iterable, chunksize=None):
+    """Map over the pool of workers.
+    chunksize=1 makes the idle workers pick the next task one at a time
+    which suits tasks of very uneven durations"""
+    pool = __POOL[0]
+    if pool is None:
+        if _POOL_SIZE[0] is None: # TODO: should we use more workers than we have cpus?
+            _POOL_SIZE[0] = multi.cpu_count() if _EXECUTOR[0] == 'process' else _IO_POOL_SIZE
+        if _POOL_SIZE[0] <= 1:
+            return map(fct, iterable)
+        if _EXECUTOR[0] == 'thread':
+            pool = ThreadPool(_POOL_SIZE[0])
+        else:
+            pool = multi.Pool(_POOL_SIZE[0])
+        __POOL[0] = pool
+    if _EXECUTOR[0] != 'process':
+        return pool.map(fct, iterable, chunksize)
+    # the worker processes send back the stats of their AWS calls with the results
+    results = []
+    for result, api_stats in pool.map(_call_with_api_stats,
+                                      [(fct, item) for item in iterable], chunksize):
+        _merge_api_stats(api_stats)
+        results.append(result)
+    return results
+
+def set_pool(conc=None, executor=None, adaptive=None):
+    """Configure the pool of workers used by conc_map
+    and whether their AWS calls are limited adaptively"""
+    if conc is not None:
+        _POOL_SIZE[0] = conc
+    if adaptive is not None:
+        _ADAPTIVE[0] = adaptive
+    if executor is not None and executor != _EXECUTOR[0]:
+        stop_pool()
+        _EXECUTOR[0] = executor
+
+def _client_config():
+    """S3ANALYSER_MAX_POOL_CONNECTIONS: size of the connection pool of each client
+    S3ANALYSER_TCP_KEEPALIVE=1: enable the TCP keep-alive of those connections"""
+    # The threads of a pool share the clients of their process
+    default_size = max(50, 2 * (_POOL_SIZE[0] or 0)) if _EXECUTOR[0] != 'process' else 50
+    kwargs = {'max_pool_connections': int(os.getenv('S3ANALYSER_MAX_POOL_CONNECTIONS', default_size))}
+    if os.getenv('S3ANALYSER_TCP_KEEPALIVE', '0') == '1':
+        kwargs['tcp_keepalive'] = True
+    return Config(**kwargs)
+
+_CLIENTS = {}
+_CLIENTS_LOCK = [threading.Lock()]
+def _get_client(service, region=None, fast_list=False):
+    """Return the boto3 client of a service and a region for the current process.
+    A client is created once per process and reuses its connections.
+    The pid is part of the key: a forked worker never reuses the sockets of its parent.
+    The fast_list S3 client parses the ListObjectsV2 pages with _parse_objects_page"""
+    key = (service, region, os.getpid(), fast_list)
+    client = _CLIENTS.get(key)
+    if client is not None:
+        return client
+    # creating a client from the default session is not thread safe
+    with _CLIENTS_LOCK[0]:
+        if key not in _CLIENTS:
+            client = boto3.client(service, region_name=region, config=_client_config())
+            if fast_list:
+                client.meta.events.register('before-parse.s3.ListObjectsV2', _parse_objects_page)
+            _instrument_client(client, service)
+            limiter_key = (service, str(client.meta.region_name))
+            if limiter_key not in _LIMITERS:
+                _LIMITERS[limiter_key] = _AdaptiveLimiter(client.meta.config.max_pool_connections)
+            _CLIENTS[key] = client
+        return _CLIENTS[key]
+
+def _reset_clients_after_fork():
+    _CLIENTS.clear()
+    _LIMITERS.clear()
+    _CLIENTS_LOCK[0] = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+# ------------ Adaptive concurrency of the AWS calls
+_ADAPTIVE_INITIAL_LIMIT = 4
+# The limit stops growing while the latency is more than this many times the lowest one seen
+_ADAPTIVE_LATENCY_TOLERANCE = 2.0
+_ADAPTIVE_DECREASE = 0.5
+# Retries of the throttled calls once the ones of botocore are exhausted
+_ADAPTIVE_MAX_ATTEMPTS = 20
+_ADAPTIVE_BASE_BACKOFF = 0.1
+_ADAPTIVE_MAX_BACKOFF = 20.0
+# (service, region) -> _AdaptiveLimiter of the current process
+_LIMITERS = {}
+
+class _AdaptiveLimiter:
+    """Additive increase, multiplicative decrease of the number of calls in flight
+    to a service in a region.
+    The limit doubles every round trip until the first throttle (slow start),
+    then grows by one per round trip while the latency stays close to the lowest seen;
+    it is halved when a call is throttled, at most once per round trip"""
+    def __init__(self, maximum, initial=_ADAPTIVE_INITIAL_LIMIT):
+        self.maximum = maximum
+        self.limit = float(min(initial, maximum))
+        self.in_flight = 0
+        self.min_latency = None
+        self.last_decrease = None
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a slot under the limit"""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None):
+        """Free the slot of a call. latency is set when it succeeded without retries"""
+        with self._condition:
+            self.in_flight -= 1
+            if latency is not None:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if latency <= _ADAPTIVE_LATENCY_TOLERANCE * self.min_latency:
+                    increase = 1.0 if self.last_decrease is None else 1.0 / self.limit
+                    self.limit = min(self.maximum, self.limit + increase)
+            self._condition.notify_all()
+
+    def throttled(self, start):
+        """A call started at start was throttled.
+        The calls started before the last decrease do not decrease the limit again"""
+        with self._condition:
+            if self.last_decrease is not None and start < self.last_decrease:
+                return
+            self.limit = max(1.0, self.limit * _ADAPTIVE_DECREASE)
+            self.last_decrease = perf_counter()
+
+def _retry_delay(attempts):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(_ADAPTIVE_MAX_BACKOFF, _ADAPTIVE_BASE_BACKOFF * 2 ** attempts))
+
+# ------------ Self instrumentation of the AWS calls
+# Latency buckets in seconds; a call lasts from its first attempt to its last retry
+_API_LATENCY_BOUNDS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+_THROTTLING_CODES = frozenset([
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+    'RequestThrottledException', 'TooManyRequestsException', 'SlowDown',
+    'RequestLimitExceeded', 'BandwidthLimitExceeded', 'PriorRequestNotComplete'])
+_API_STATS_LABELS = ('service', 'operation', 'region')
+# (service, operation, region) -> {'Calls','Errors','Throttles','Retries','LatencySum','LatencyHistogram'}
+_API_STATS = {}
+_API_STATS_LOCK = [threading.Lock()]
+# (analysis, phase) -> duration in seconds of the latest run of the phase
+_PHASE_SECONDS = {}
+
+def _new_api_stats():
+    return {'Calls': 0, 'Errors': 0, 'Throttles': 0, 'Retries': 0, 'LatencySum': 0.0,
+            'LatencyHistogram': [0] * (len(_API_LATENCY_BOUNDS) + 1)}
+
+def _api_stats(service, operation, region):
+    """The stats of an operation; the caller holds _API_STATS_LOCK"""
+    key = (service, operation, region)
+    stats = _API_STATS.get(key)
+    if stats is None:
+        stats = _API_STATS[key] = _new_api_stats()
+    return stats
+
+def _instrument_client(client, service):
+    """Record the calls, latencies, retries and throttles of every operation of the client"""
+    region = str(client.meta.region_name)
+    client.meta.events.register('before-call', partial(_before_api_call, service, region))
+    client.meta.events.register('after-call', partial(_after_api_call, service, region))
+    client.meta.events.register('after-call-error', partial(_after_api_call_error, service, region))
+    client.meta.events.register('needs-retry', partial(_on_api_attempt, service, region))
+
+def _before_api_call(service, region, context, **_kwargs):
+    limiter = _LIMITERS.get((service, region)) if _ADAPTIVE[0] else None
+    if limiter is not None:
+        limiter.acquire()
+        context['_api_limiter'] = limiter
+    context['_api_call_start'] = perf_counter()
+
+def _record_api_call(service, operation, region, context, retries, error):
+    latency = perf_counter() - context.get('_api_call_start', perf_counter())
+    with _API_STATS_LOCK[0]:
+        stats = _api_stats(service, operation, region)
+        stats['Calls'] += 1
+        stats['Retries'] += retries
+        if error:
+            stats['Errors'] += 1
+        stats['LatencySum'] += latency
+        stats['LatencyHistogram'][bisect_left(_API_LATENCY_BOUNDS, latency)] += 1
+    limiter = context.pop('_api_limiter', None)
+    if limiter is not None:
+        limiter.release(latency if not error and retries == 0 else None)
+
+def _after_api_call(service, region, http_response, parsed, model, context, **_kwargs):
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    _record_api_call(service, model.name, region, context, retries,
+                     http_response.status_code >= 300)
+
+def _after_api_call_error(service, region, event_name, context, **_kwargs):
+    # the connection errors are raised once the retries are exhausted
+    _record_api_call(service, event_name.rsplit('.', 1)[-1], region, context, 0, True)
+
+def _on_api_attempt(service, region, response, operation, attempts=1, request_dict=None,
+                    **_kwargs):
+    """Called after each attempt to decide whether to retry it: count the throttled ones.
+    When the call is limited adaptively, decrease the limit
+    and return the delay before the next attempt if botocore gave up"""
+    if response is None:
+        return None
+    http_response, parsed = response
+    code = parsed.get('Error', {}).get('Code')
+    if code not in _THROTTLING_CODES and http_response.status_code != 503:
+        return None
+    with _API_STATS_LOCK[0]:
+        _api_stats(service, operation.name, region)['Throttles'] += 1
+    context = (request_dict or {}).get('context', {})
+    limiter = context.get('_api_limiter')
+    if limiter is None:
+        return None
+    limiter.throttled(context['_api_call_start'])
+    if attempts >= _ADAPTIVE_MAX_ATTEMPTS:
+        return None
+    return _retry_delay(attempts)
+
+def _merge_api_stats(api_stats):
+    """Add the stats recorded by a worker process"""
+    with _API_STATS_LOCK[0]:
+        for key, stats in api_stats.items():
+            merged = _api_stats(*key)
+            for name in ['Calls', 'Errors', 'Throttles', 'Retries', 'LatencySum']:
+                merged[name] += stats[name]
+            merged['LatencyHistogram'] = [
+                count + other for count, other in zip(merged['LatencyHistogram'],
+                                                      stats['LatencyHistogram'])]
+
+def _take_api_stats():
+    """Return the stats recorded so far and start again from zero"""
+    with _API_STATS_LOCK[0]:
+        api_stats = dict(_API_STATS)
+        _API_STATS.clear()
+    return api_stats
+
+def _call_with_api_stats(task):
+    """Run a task of conc_map in a worker process.
+    Return its result with the stats of the AWS calls it made for the parent to merge"""
+    fct, item = task
+    result = fct(item)
+    return result, _take_api_stats()
+
+def _reset_api_stats_after_fork():
+    # the stats of the parent are not the ones of the child
+    _API_STATS.clear()
+    _API_STATS_LOCK[0] = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_api_stats_after_fork)
+
+@contextmanager
+def timed_phase(analysis, name):
+    """Time a phase of an analysis"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        _PHASE_SECONDS[(analysis, name)] = perf_counter() - start
+
+def _self_metrics_tables():
+    """The tables of the analyser's own metrics"""
+    calls = CounterTable('s3analyser_api_calls_total', 'Number of AWS API calls', _API_STATS_LABELS)
+    errors = CounterTable('s3analyser_api_errors_total', 'Number of AWS API calls that failed',
+                          _API_STATS_LABELS)
+    throttles = CounterTable('s3analyser_api_throttles_total',
+                             'Number of attempts of AWS API calls that were throttled',
+                             _API_STATS_LABELS)
+    retries = CounterTable('s3analyser_api_retries_total', 'Number of retries of AWS API calls',
+                           _API_STATS_LABELS)
+    latencies = HistogramTable('s3analyser_api_latency_seconds',
+                               'Duration of the AWS API calls including their retries',
+                               _API_STATS_LABELS, _API_LATENCY_BOUNDS)
+    with _API_STATS_LOCK[0]:
+        for key, stats in sorted(_API_STATS.items(), key=lambda item: tuple(map(str, item[0]))):
+            calls.add(key, stats['Calls'])
+            errors.add(key, stats['Errors'])
+            throttles.add(key, stats['Throttles'])
+            retries.add(key, stats['Retries'])
+            latencies.add(key, list(stats['LatencyHistogram']), stats['LatencySum'])
+    phases = GaugeTable('s3analyser_phase_seconds', 'Duration of the latest run of a phase',
+                        ('analysis', 'phase'))
+    for key, seconds in sorted(_PHASE_SECONDS.items()):
+        phases.add(key, seconds)
+    tables = [calls, errors, throttles, retries, latencies, phases]
+    if _ADAPTIVE[0]:
+        limits = GaugeTable('s3analyser_concurrency_limit',
+                            'Limit of the AWS calls in flight of the analyser process',
+                            ('service', 'region'))
+        for key, limiter in sorted(_LIMITERS.items()):
+            limits.add(key, limiter.limit)
+        tables.append(limits)
+    return tables
 
 """
 Prometheus Gauges:
@@ -67,24 +420,102 @@ Prometheus Gauges:
 Hence number of timeseries < 16*3*1000 + 16*1000 = 64k
 This number is perfectly fine with Prometheus
 """
-_OBJECT_GAUGE_SIZE_LABELS = ['region', 'storage', 'bucket']
-_OBJECT_GAUGE_NUMBER_LABELS = ['region', 'bucket']
-OBJECT_GAUGES = {}
+_OBJECT_GAUGE_SIZE_LABELS = ('region', 'storage', 'bucket')
+_OBJECT_GAUGE_NUMBER_LABELS = ('region', 'bucket')
+
+class GaugeTable:
+    """Columns of a gauge: one tuple of label values and one float per timeseries"""
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.labels = []
+        self.values = array('d')
+
+    def add(self, labels, value):
+        """Append a timeseries; the label values are in the order of labelnames"""
+        self.labels.append(labels)
+        self.values.append(value)
+
+    def family(self):
+        """The metric family exposed by the collector"""
+        family = GaugeMetricFamily(self.name, self.documentation, labels=self.labelnames)
+        for labels, value in zip(self.labels, self.values):
+            family.add_metric(labels, value)
+        return family
+
+class CounterTable(GaugeTable):
+    """Columns of a counter"""
+    def family(self):
+        """The metric family exposed by the collector"""
+        family = CounterMetricFamily(self.name, self.documentation, labels=self.labelnames)
+        for labels, value in zip(self.labels, self.values):
+            family.add_metric(labels, value)
+        return family
+
+class HistogramTable:
+    """Columns of a histogram: the counts per bucket of each timeseries are not cumulative;
+    there is one more count than bounds for +Inf"""
+    def __init__(self, name, documentation, labelnames, bounds):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.bounds = [str(bound) for bound in bounds] + ['+Inf']
+        self.labels = []
+        self.counts = []
+        self.sums = array('d')
+
+    def add(self, labels, counts, sum_value):
+        """Append a timeseries; the label values are in the order of labelnames"""
+        self.labels.append(labels)
+        self.counts.append(counts)
+        self.sums.append(sum_value)
+
+    def family(self):
+        """The metric family exposed by the collector"""
+        family = HistogramMetricFamily(self.name, self.documentation, labels=self.labelnames)
+        for labels, counts, sum_value in zip(self.labels, self.counts, self.sums):
+            cumulated = 0
+            buckets = []
+            for bound, count in zip(self.bounds, counts):
+                cumulated += count
+                buckets.append((bound, cumulated))
+            family.add_metric(labels, buckets, sum_value)
+        return family
+
+class ColumnarCollector:
+    """Prometheus collector that builds the metric families at collection time
+    from the gauge tables of the latest analysis.
+    Much lighter than one locked Gauge child per set of labels"""
+    def __init__(self):
+        # name of the set -> tables
+        self._table_sets = {}
+
+    def replace(self, name, tables):
+        """Replace the whole set of tables of an analysis at once:
+        'cloudwatch', 's3' or 'self' for the analyser's own metrics.
+        A table has a name and builds its metric family"""
+        self._table_sets = dict(self._table_sets, **{name: list(tables)})
+
+    def collect(self):
+        """Called by the registry when the metrics are exposed"""
+        for tables in self._table_sets.values():
+            for table in tables:
+                yield table.family()
+
 REGISTRY = [None]
-def _set_object_gauge(name, value, **kwargs):
-    """Set the value of a gauge; be careful to only do this from a single
-    thread and to push to gateway before the thread is over"""
+COLLECTOR = [None]
+def _get_collector():
+    """The collector is registered once in the registry of the analyser"""
     if REGISTRY[0] is None:
         REGISTRY[0] = CollectorRegistry()
-    if name not in OBJECT_GAUGES:
-        OBJECT_GAUGES[name] = Gauge(
-            name, 'Number of buckets',
-            _OBJECT_GAUGE_SIZE_LABELS if 'size' in name else _OBJECT_GAUGE_NUMBER_LABELS,
-            registry=REGISTRY[0])
-    OBJECT_GAUGES[name].labels(**kwargs).set(value)
+    if COLLECTOR[0] is None:
+        COLLECTOR[0] = ColumnarCollector()
+        REGISTRY[0].register(COLLECTOR[0])
+    return COLLECTOR[0]
 
 def stop_pool():
-    """Stop the pool of sub processes"""
+    """Stop the pool of workers"""
     if __POOL[0] is not None:
         __POOL[0].close()
         __POOL[0] = None
@@ -103,16 +534,93 @@ def _is_glob(prefix):
 
 def list_buckets(prefix=None):
     """Return the list of buckets {'Name','CreationDate'} """
-    resp = boto3.client('s3').list_buckets()
+    resp = _get_client('s3').list_buckets()
     buckets = resp['Buckets']
+    listed = set(bucket['Name'] for bucket in buckets)
     if prefix is not None:
         bucket_name = _extract_bucket_from_prefix(prefix)
         buckets = [bucket for bucket in buckets if fnmatchcase(bucket['Name'], bucket_name)]
         if not buckets:
             raise ValueError(f'Invalid prefix "{prefix}"; no bucket selected')
-    buckets = list(_conc_map(fetch_bucket_info, buckets))
+    buckets = resolve_regions(buckets, listed=listed)
     return sorted(buckets, key=itemgetter('Name'))
 
+# ------------ Regions of the buckets
+# name -> [CreationDate timestamp, region]: a recreated bucket has another CreationDate
+# followed by [probe timestamp, storage keys] once its metrics were probed, see plan_metrics
+_REGION_CACHE = {}
+_REGION_CACHE_LOADED = [None]
+
+def _region_cache_path():
+    """S3ANALYSER_REGION_CACHE: JSON file where the regions are kept between runs.
+    Unset or empty: they are only kept in memory"""
+    return os.getenv('S3ANALYSER_REGION_CACHE', '')
+
+def _load_region_cache():
+    path = _region_cache_path()
+    if not path or _REGION_CACHE_LOADED[0] == path:
+        return
+    _REGION_CACHE_LOADED[0] = path
+    try:
+        with open(path) as file:
+            _REGION_CACHE.update(json.load(file))
+    except (OSError, ValueError):
+        # missing or corrupt: the regions are fetched again
+        pass
+
+def _save_region_cache():
+    path = _region_cache_path()
+    if not path:
+        return
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        _write_json_atomic(path, _REGION_CACHE)
+    except OSError as err:
+        print(f'Unable to save the regions of the buckets in {path}: {err}')
+
+def _cached_region(bucket):
+    """Add the Region of a bucket from the cache; False when it is missing"""
+    cached = _REGION_CACHE.get(bucket['Name'])
+    if cached is not None and cached[0] == bucket['CreationDate'].timestamp():
+        bucket['Region'] = cached[1]
+        return True
+    return False
+
+def _cache_region(bucket):
+    _REGION_CACHE[bucket['Name']] = [bucket['CreationDate'].timestamp(), bucket['Region']]
+
+def _forget_regions(listed):
+    """Forget the buckets that are not listed anymore; True when some were forgotten"""
+    forgotten = [name for name in _REGION_CACHE if name not in listed]
+    for name in forgotten:
+        del _REGION_CACHE[name]
+    return bool(forgotten)
+
+def resolve_regions(buckets, listed=None):
+    """Add the Region of the buckets from the cache.
+    Only the new or recreated buckets are resolved; the GetBucketLocation calls run in threads.
+    listed is the names of all the buckets of the account: the others are forgotten"""
+    _load_region_cache()
+    missing = [bucket for bucket in buckets if not _cached_region(bucket)]
+    forgotten = listed is not None and _forget_regions(listed)
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(len(missing), _IO_POOL_SIZE)) as executor:
+            list(executor.map(fetch_bucket_info, missing))
+        for bucket in missing:
+            _cache_region(bucket)
+    if missing or forgotten:
+        _save_region_cache()
+    return buckets
+
+def _normalize_location(location):
+    """GetBucketLocation returns no LocationConstraint for us-east-1
+    and EU for the oldest buckets of eu-west-1"""
+    if not location:
+        return 'us-east-1'
+    if location == 'EU':
+        return 'eu-west-1'
+    return location
+
 def _get_bucket_name(metric):
     for dimension in metric['Dimensions']:
         if dimension['Name'] == 'BucketName':
@@ -127,17 +635,18 @@ def list_metrics(buckets, prefix=None):
         'prefix': _extract_bucket_from_prefix(prefix),
         'region': region
     } for region in regions]
-    return sum(_conc_map(_list_regional_metrics, kwargs_list), [])
+    return sum(conc_map(_list_regional_metrics, kwargs_list), [])
 
-def _list_regional_metrics(params):
-    """ return the list of S3 metrics for a given region """
-    region = params['region']
-    prefix = params['prefix']
-    kwargs = {'Namespace': 'AWS/S3', '_region': region}
+def _list_metrics_kwargs(prefix):
+    kwargs = {'Namespace': 'AWS/S3'}
     if prefix is not None and not _is_glob(prefix):
         kwargs['Dimensions'] = [{'Name': 'BucketName', 'Value': prefix}]
+    return kwargs
+
+def _select_metrics(page, prefix, region):
+    """The metrics of a page that match the prefix"""
     metrics = []
-    for metric in _list_metrics(**kwargs):
+    for metric in page:
         # skip the buckets we are not interested in
         bucket_name = _get_bucket_name(metric)
         if prefix != None and not fnmatchcase(bucket_name, prefix):
@@ -147,29 +656,111 @@ def _list_regional_metrics(params):
         metrics.append(metric)
     return metrics
 
+def _list_regional_metrics(params):
+    """ return the list of S3 metrics for a given region """
+    region = params['region']
+    prefix = params['prefix']
+    metrics = []
+    for page in _list_metrics(_region=region, **_list_metrics_kwargs(prefix)):
+        metrics.extend(_select_metrics(page, prefix, region))
+    return metrics
+
 def _get_cw_client(region):
     assert region is not None
-    return boto3.client('cloudwatch', region_name=region)
-
-def _list_metrics(**kwargs):
-    """Generator to iterate the metrics found in a bucket. yield one metric at a time"""
-    region = kwargs.pop('_region')
-    res = _get_cw_client(region).list_metrics(**kwargs)
+    return _get_client('cloudwatch', region)
 
-    metrics = res['Metrics']
-    for metric in metrics:
-        yield metric
+def _paginate(call, next_page, **kwargs):
+    """Generator of the responses of a paginated AWS call.
+    next_page(kwargs, res) returns the kwargs of the next call or None on the last page.
+    The next page is fetched in a background thread while the current one is consumed"""
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(call, **kwargs)
+        while future is not None:
+            res = future.result()
+            kwargs = next_page(dict(kwargs), res)
+            future = None if kwargs is None else executor.submit(call, **kwargs)
+            yield res
 
+def _next_metrics_page(kwargs, res):
     # The moto library has some issue returning a strange next token
     # when there should be none
     if 'NextToken' in res and not res['NextToken'].startswith('\n '):
         kwargs['NextToken'] = res['NextToken']
-        kwargs['_region'] = region
-        for i in _list_metrics(**kwargs):
-            yield i
+        return kwargs
+    return None
+
+def _list_metrics(**kwargs):
+    """Generator to iterate the metrics found in a region. yield one page of metrics at a time"""
+    region = kwargs.pop('_region')
+    for res in _paginate(_get_cw_client(region).list_metrics, _next_metrics_page, **kwargs):
+        yield res['Metrics']
+
+# ------------ Metric queries planned from the bucket list
+# The keys of FOLDED_KEYS queried even when a bucket did not report them at its last probe:
+# a bucket that was empty shows up again
+_ALWAYS_PLANNED_KEYS = ['NumberOfObjects:AllStorageTypes', 'BucketSizeBytes:AllStorageTypes']
 
-def get_metrics_data(metrics, buckets):
-    """Fetches the datapoints of the corresponding metrics"""
+def _probe_max_age():
+    """S3ANALYSER_PROBE_DAYS: days after which all the storage types of a bucket are queried again"""
+    return float(os.getenv('S3ANALYSER_PROBE_DAYS', '7')) * 86400
+
+def _planned_keys(bucket, now):
+    """The FOLDED_KEYS to query for a bucket; None when all of them are probed"""
+    cached = _REGION_CACHE.get(bucket['Name'])
+    if cached is None or len(cached) < 4 or now - cached[2] >= _probe_max_age():
+        return None
+    return sorted(set(cached[3]).union(_ALWAYS_PLANNED_KEYS))
+
+def plan_metrics(buckets):
+    """Return the metrics of the buckets in the shape of list_metrics without calling ListMetrics.
+    A bucket is probed with all the FOLDED_KEYS when it is new or its last probe is too old;
+    otherwise only the storage types it reported are queried"""
+    now = datetime.utcnow().timestamp()
+    metrics = []
+    for bucket in buckets:
+        keys = _planned_keys(bucket, now)
+        for key in FOLDED_KEYS if keys is None else keys:
+            metric_name, storage_type = key.split(':')
+            metrics.append({
+                'Namespace': 'AWS/S3',
+                'MetricName': metric_name,
+                'Dimensions': [
+                    {'Name': 'StorageType', 'Value': storage_type},
+                    {'Name': 'BucketName', 'Value': bucket['Name']}
+                ],
+                '_region': bucket['Region']
+            })
+    return metrics
+
+def remember_storage_types(buckets, metrics_data):
+    """Keep the storage types reported by the probed buckets in the region cache.
+    A bucket that reports another set than the one kept is probed again at the next analysis"""
+    now = datetime.utcnow().timestamp()
+    reported = {}
+    for datapoint in metrics_data:
+        reported.setdefault(datapoint['BucketName'], set()).add(
+            f"{datapoint['MetricName']}:{datapoint['StorageType']}")
+    changed = False
+    for bucket in buckets:
+        cached = _REGION_CACHE.get(bucket['Name'])
+        if cached is None:
+            continue
+        keys = sorted(reported.get(bucket['Name'], ()))
+        if _planned_keys(bucket, now) is None:
+            cached[2:] = [now, keys]
+            changed = True
+        elif keys != sorted(cached[3]):
+            del cached[2:]
+            changed = True
+    if changed:
+        _save_region_cache()
+
+# MetricName -> Unit of the datapoints
+_METRIC_UNITS = {'NumberOfObjects': 'Count', 'BucketSizeBytes': 'Bytes'}
+
+def get_metrics_data(metrics, buckets, batch=False):
+    """Fetches the datapoints of the corresponding metrics
+    When batch is True, the requests are grouped per region into GetMetricData calls"""
     regions_bybucket = {}
     for bucket in buckets:
         regions_bybucket[bucket['Name']] = bucket['Region']
@@ -180,12 +771,14 @@ def get_metrics_data(metrics, buckets):
             pending_requests.append(_make_req(metric, 'Count', regions_bybucket))
         elif metric_name == 'BucketSizeBytes':
             pending_requests.append(_make_req(metric, 'Bytes', regions_bybucket))
+    if batch:
+        return _run_batched_requests(pending_requests, buckets)
     return _run_requests(pending_requests, buckets)
 
 def _today():
     return datetime.combine(datetime.utcnow().date(), time.min)
 
-def _make_req(metric, unit, regions_bybucket):
+def _make_req(metric, unit, regions_bybucket, days=1):
     # Add the region to the dictionary.
     # The dictionary is executed by a python pool of processes,
     # passing the region directly on the dictionary
@@ -203,7 +796,7 @@ def _make_req(metric, unit, regions_bybucket):
             'Average'
         ],
         # http://docs.aws.amazon.com/AmazonS3/latest/dev/cloudwatch-monitoring.html#cloudwatch-monitoring-accessing
-        'StartTime': today - timedelta(days=1),
+        'StartTime': today - timedelta(days=days),
         'EndTime': today,
         'Period': 86400, # 1 day
         'Unit': unit,
@@ -212,7 +805,7 @@ def _make_req(metric, unit, regions_bybucket):
 
 def _run_requests(reqs, buckets):
     """Exectutes the requests"""
-    data = list(filter(None, _conc_map(get_metric, reqs)))
+    data = list(filter(None, conc_map(get_metric, reqs)))
     _add_bucket_info(data, buckets)
     return data
 
@@ -222,7 +815,9 @@ def get_metric(req):
     if len(resp['Datapoints']) == 0:
         # Empty bucket or bucket that contains folders only
         return None
-    average = resp['Datapoints'][0]['Average']
+    return _make_datapoint(req, resp['Datapoints'][0]['Average'])
+
+def _make_datapoint(req, average):
     for dimension in req['Dimensions']:
         if dimension['Name'] == 'BucketName':
             bucket_name = dimension['Value']
@@ -244,6 +839,219 @@ def _get_metric_statistics(**kwargs):
     res = _get_cw_client(region).get_metric_statistics(**kwargs)
     return res
 
+# http://docs.aws.amazon.com/AmazonCloudWatch/latest/APIReference/API_GetMetricData.html
+_METRIC_DATA_MAX_QUERIES = 500
+
+def _make_batches(reqs):
+    """Group the requests by region and by time window
+    into batches of at most _METRIC_DATA_MAX_QUERIES queries"""
+    grouped = {}
+    for req in reqs:
+        key = (req['_region'], req['StartTime'], req['EndTime'])
+        grouped.setdefault(key, []).append(req)
+    batches = []
+    for (region, start_time, end_time), group in grouped.items():
+        for index in range(0, len(group), _METRIC_DATA_MAX_QUERIES):
+            batches.append({
+                '_region': region,
+                'StartTime': start_time,
+                'EndTime': end_time,
+                'Requests': group[index:index + _METRIC_DATA_MAX_QUERIES]
+            })
+    return batches
+
+def _run_batched_requests(reqs, buckets):
+    """Exectutes the requests grouped in GetMetricData batches"""
+    data = sum(conc_map(get_metric_batch, _make_batches(reqs)), [])
+    _add_bucket_info(data, buckets)
+    return data
+
+def get_metric_batch(batch):
+    """Fetch the data for a batch of metrics of the same region
+    Return the datapoints in the same shape as get_metric"""
+    queries = []
+    for index, req in enumerate(batch['Requests']):
+        queries.append({
+            'Id': f'm{index}',
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': req['Namespace'],
+                    'MetricName': req['MetricName'],
+                    'Dimensions': req['Dimensions']
+                },
+                'Period': req['Period'],
+                'Stat': req['Statistics'][0],
+                'Unit': req['Unit']
+            },
+            'ReturnData': True
+        })
+    values = {}
+    for result in _get_metric_data(
+            _region=batch['_region'],
+            MetricDataQueries=queries,
+            StartTime=batch['StartTime'],
+            EndTime=batch['EndTime']):
+        values.setdefault(result['Id'], []).extend(result['Values'])
+    data = []
+    for index, req in enumerate(batch['Requests']):
+        query_values = values.get(f'm{index}')
+        if not query_values:
+            # Empty bucket or bucket that contains folders only
+            continue
+        data.append(_make_datapoint(req, query_values[0]))
+    return data
+
+def _get_metric_data(**kwargs):
+    """Generator to iterate the results of boto3.get_metric_data
+    A query may return its values over several pages"""
+    region = kwargs.pop('_region')
+    client = _get_cw_client(region)
+    while True:
+        res = client.get_metric_data(**kwargs)
+        for result in res['MetricDataResults']:
+            yield result
+        if not res.get('NextToken'):
+            break
+        kwargs['NextToken'] = res['NextToken']
+
+# ------------ Local snapshots of the Cloudwatch metrics
+class SnapshotStore:
+    """Daily datapoints of the Cloudwatch storage metrics in a SQLite database:
+    one row per (date, bucket, metric, storage type).
+    The days fetched without a datapoint are kept apart so they are not fetched again"""
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS datapoints (
+                date TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                region TEXT,
+                metric TEXT NOT NULL,
+                storage TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (date, bucket, metric, storage))""")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS fetched (
+                date TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                storage TEXT NOT NULL,
+                PRIMARY KEY (date, bucket, metric, storage))""")
+
+    def add(self, datapoints):
+        """Keep the datapoints {'Date','BucketName','Region','MetricName','StorageType','Value'}"""
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO datapoints VALUES (?, ?, ?, ?, ?, ?)', [
+                (data['Date'], data['BucketName'], str(data['Region']), data['MetricName'],
+                 data['StorageType'], data['Value']) for data in datapoints])
+
+    def add_fetched(self, fetched):
+        """Keep the (date, bucket, metric, storage) that were fetched with or without a datapoint"""
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO fetched VALUES (?, ?, ?, ?)', fetched)
+
+    def known(self, since):
+        """The (date, bucket, metric, storage) kept or fetched since a date"""
+        return set(self._db.execute(
+            'SELECT date, bucket, metric, storage FROM datapoints WHERE date >= ?'
+            ' UNION SELECT date, bucket, metric, storage FROM fetched WHERE date >= ?',
+            (since, since)))
+
+    def datapoints(self, date):
+        """The datapoints of a day in the shape of get_metric"""
+        return [{
+            'MetricName': metric,
+            'BucketName': bucket,
+            'StorageType': storage,
+            'Value': value
+        } for bucket, metric, storage, value in self._db.execute(
+            'SELECT bucket, metric, storage, value FROM datapoints WHERE date = ?'
+            ' ORDER BY bucket, metric, storage', (date,))]
+
+    def growth(self, days):
+        """Size and number of objects of each bucket at the first and the last day
+        kept within days of the latest one: [{'Bucket','Region','From','To','Bytes','Files'}]
+        where Bytes and Files are (first, last)"""
+        latest = self._db.execute('SELECT MAX(date) FROM datapoints').fetchone()[0]
+        if latest is None:
+            return []
+        since = (datetime.strptime(latest, '%Y-%m-%d') - timedelta(days=days)).date().isoformat()
+        # (bucket, date) -> [bytes of the storage types, bytes of AllStorageTypes, files]
+        bydate = {}
+        regions = {}
+        for date, bucket, region, metric, storage, value in self._db.execute(
+                'SELECT date, bucket, region, metric, storage, value FROM datapoints'
+                ' WHERE date >= ?', (since,)):
+            regions[bucket] = region
+            totals = bydate.setdefault((bucket, date), [0.0, 0.0, 0.0])
+            if metric == 'NumberOfObjects':
+                totals[2] += value
+            elif storage == 'AllStorageTypes':
+                totals[1] += value
+            else:
+                totals[0] += value
+        bybucket = {}
+        for (bucket, date), (storage_bytes, all_bytes, files) in sorted(bydate.items()):
+            growth = bybucket.setdefault(bucket, {'Bucket': bucket, 'Region': regions[bucket],
+                                                  'From': date, 'Bytes': [], 'Files': []})
+            growth['To'] = date
+            growth['Bytes'].append(storage_bytes or all_bytes)
+            growth['Files'].append(files)
+        return [dict(growth, Bytes=(growth['Bytes'][0], growth['Bytes'][-1]),
+                     Files=(growth['Files'][0], growth['Files'][-1]))
+                for growth in bybucket.values()]
+
+    def close(self):
+        self._db.close()
+
+def _datapoint_key(req):
+    """(bucket, metric, storage) of a request"""
+    datapoint = _make_datapoint(req, None)
+    return datapoint['BucketName'], datapoint['MetricName'], datapoint['StorageType']
+
+def get_metrics_snapshots(metrics, buckets, store, days=1):
+    """Fetch the days of the last days that are missing from the store with one
+    GetMetricStatistics call per metric, keep them
+    and return the datapoints of the latest day from the store.
+    The days without a datapoint are remembered and not fetched again, except the latest one"""
+    regions_bybucket = {}
+    for bucket in buckets:
+        regions_bybucket[bucket['Name']] = bucket['Region']
+    today = _today()
+    dates = [(today - timedelta(days=day)).date().isoformat() for day in range(days, 0, -1)]
+    known = store.known(dates[0])
+    pending_requests = []
+    # (date, bucket, metric, storage) of the days requested.
+    # Cloudwatch publishes the latest day hours late: it is fetched until it has a datapoint
+    requested = []
+    for metric in metrics:
+        unit = _METRIC_UNITS.get(metric['MetricName'])
+        if unit is None:
+            continue
+        req = _make_req(metric, unit, regions_bybucket, days=days)
+        key = _datapoint_key(req)
+        missing = [date for date in dates if (date,) + key not in known]
+        if not missing:
+            continue
+        req['StartTime'] = datetime.strptime(missing[0], '%Y-%m-%d')
+        pending_requests.append(req)
+        requested.extend((date,) + key for date in dates[dates.index(missing[0]):-1])
+    fetched = sum(conc_map(get_metric_history, pending_requests), [])
+    _add_bucket_info(fetched, buckets)
+    store.add(fetched)
+    store.add_fetched(requested)
+    data = [datapoint for datapoint in store.datapoints(dates[-1])
+            if datapoint['BucketName'] in regions_bybucket]
+    _add_bucket_info(data, buckets)
+    return data
+
+def get_metric_history(req):
+    """Fetch the daily datapoints of a metric between StartTime and EndTime"""
+    resp = _get_metric_statistics(**req)
+    return [dict(_make_datapoint(req, point['Average']),
+                 Date=point['Timestamp'].date().isoformat())
+            for point in resp['Datapoints']]
+
 def _add_bucket_info(datapoints, buckets):
     """Adds the region, creation date"""
     buckets_indexed = {}
@@ -257,8 +1065,8 @@ def fetch_bucket_info(bucket):
     """Fetches some extra info about the bucket: adds the region"""
     name = bucket['Name']
     try:
-        bucket_location = boto3.client('s3').get_bucket_location(Bucket=name)['LocationConstraint']
-        bucket.update({'Region': bucket_location})
+        bucket_location = _get_client('s3').get_bucket_location(Bucket=name)['LocationConstraint']
+        bucket.update({'Region': _normalize_location(bucket_location)})
         return bucket
     except Exception as err:
         msg = err.__str__()
@@ -270,12 +1078,16 @@ def update_gauges(metrics_data):
     cloudwatchs3_objects_total region,bucket
     cloudwatchs3_size_bytes    region,bucket,storage
     """
+    objects = GaugeTable('cloudwatch_s3_objects_total', 'Number of objects',
+                         _OBJECT_GAUGE_NUMBER_LABELS)
+    sizes = GaugeTable('cloudwatch_s3_size_bytes', 'Size of the objects',
+                       _OBJECT_GAUGE_SIZE_LABELS)
     for data in metrics_data:
         bucket = data['BucketName']
-        region = data['Region']
+        region = str(data['Region'])
         value = data['Value']
         if data['MetricName'] == 'NumberOfObjects':
-            _set_object_gauge(f'cloudwatch_s3_objects_total', value, region=region, bucket=bucket)
+            objects.add((region, bucket), value)
         # name = '_size_bytes'
         storage_type = data['StorageType']
         st_abr = None
@@ -289,8 +1101,8 @@ def update_gauges(metrics_data):
             # we could store it as a separate timeseries;
             # but we can compute it easily on the prom server by doing a sum
             continue
-        _set_object_gauge(f'cloudwatch_s3_size_bytes', value,
-                          region=region, bucket=bucket, storage=st_abr)
+        sizes.add((region, st_abr, bucket), value)
+    _get_collector().replace('cloudwatch', [objects, sizes])
     commit_cloudwatch_gauges()
 
 def get_metrics_prom(s3=False):
@@ -299,11 +1111,58 @@ def get_metrics_prom(s3=False):
 
 def commit_cloudwatch_gauges():
     """Either push the gauges to a gateway if PROM_GATEWAY is set
-    or write them into a file if PROM_TEXT is set"""
+    or write them into a file if PROM_TEXT is set.
+    The analyser's own metrics are exported with them"""
+    _get_collector().replace('self', _self_metrics_tables())
     if 'PROM_GATEWAY' in os.environ:
         push_to_gateway(os.environ['PROM_GATEWAY'], job='s3analyser', registry=REGISTRY[0])
         return
     write_to_textfile(get_metrics_prom(), REGISTRY[0])
+    _swap_exposition(s3=False)
+
+TEXT_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Latest exposition of the gauges for the /metrics (False) and /s3-metrics (True) endpoints
+_EXPOSITIONS = {}
+
+def _make_exposition(text, openmetrics=None, source=None):
+    exposition = {
+        'Source': source,
+        'ETag': hashlib.sha1(text).hexdigest(),
+        'Bodies': {TEXT_CONTENT_TYPE: text},
+        'Gzipped': {}
+    }
+    if openmetrics is not None:
+        exposition['Bodies'][OPENMETRICS_CONTENT_TYPE] = openmetrics
+    return exposition
+
+def _prom_mtime(s3):
+    path = get_metrics_prom(s3=s3)
+    return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+def _swap_exposition(s3=False):
+    """Keep the exposition that was just written in memory; replace the previous one at once"""
+    _EXPOSITIONS[s3] = _make_exposition(
+        generate_latest(REGISTRY[0]),
+        openmetrics=generate_latest_openmetrics(REGISTRY[0]),
+        source=_prom_mtime(s3))
+
+def get_exposition(s3=False):
+    """Return the latest exposition of the gauges {'ETag','Bodies','Gzipped'} or None.
+    The metrics file is read again only when another process wrote it"""
+    exposition = _EXPOSITIONS.get(s3)
+    mtime = _prom_mtime(s3)
+    if mtime is None or (exposition is not None and exposition['Source'] == mtime):
+        return exposition
+    with open(get_metrics_prom(s3=s3), 'rb') as file:
+        exposition = _make_exposition(file.read(), source=mtime)
+    _EXPOSITIONS[s3] = exposition
+    return exposition
+
+def gzip_exposition(exposition, content_type):
+    """Compress a body of the exposition once"""
+    if content_type not in exposition['Gzipped']:
+        exposition['Gzipped'][content_type] = gzip.compress(exposition['Bodies'][content_type])
+    return exposition['Gzipped'][content_type]
 
 FOLDED_KEYS = {
     # MetricName-StorageType -> Folded column name
@@ -314,12 +1173,15 @@ FOLDED_KEYS = {
     'BucketSizeBytes:ReducedRedundancyStorage': 'Bytes-RR'
 }
 
-def fold_metrics_data(metrics_data):
+def fold_metrics_data(metrics_data, folded=None):
     """Fold the datapoints into rows with multiple dimension values
-    Prepare row by buckets; aggregates rows per regions and per storage"""
-    bystorage = {}
-    byregion = {}
-    bybucket = {}
+    Prepare row by buckets; aggregates rows per regions and per storage.
+    The datapoints are added to folded when it is given"""
+    if folded is None:
+        folded = {'bybucket': {}, 'byregion': {}, 'bystorage': {}}
+    bystorage = folded['bystorage']
+    byregion = folded['byregion']
+    bybucket = folded['bybucket']
     # Folds some column
     for data in metrics_data:
         region = data['Region']
@@ -375,16 +1237,11 @@ def fold_metrics_data(metrics_data):
     #     'Bytes-IA': sum(map(attrgetter('Bytes-IA'), byregion.values()))
     # }
 
-    return {
-        'bybucket': bybucket,
-        'byregion': byregion,
-        'bystorage': bystorage,
-        # 'world': world
-    }
+    # folded['world'] = world
+    return folded
 
-def _format_buckets(buckets_data, unit='MB'):
-    """Formate the buckets for the tabulate library"""
-    headers = [
+def _format_headers(unit='MB'):
+    return [
         'Bucket',
         'Region',
         'Files',
@@ -394,9 +1251,11 @@ def _format_buckets(buckets_data, unit='MB'):
         f'IA({unit})',
         'Creation(UTC)'
     ]
-    rows = []
+
+def _iter_bucket_rows(buckets_data, unit='MB'):
+    """Generator of the row of each bucket"""
     for data in buckets_data:
-        rows.append([
+        yield [
             data['Bucket'],
             data['Region'],
             data['Files'],
@@ -405,44 +1264,399 @@ def _format_buckets(buckets_data, unit='MB'):
             convert_bytes(data['Bytes-RR'], unit),
             convert_bytes(data['Bytes-IA'], unit),
             data['CreationDate'].replace(tzinfo=None).isoformat('T', 'seconds')
-        ])
-    return headers, rows
+        ]
+
+def _format_buckets(buckets_data, unit='MB'):
+    """Formate the buckets for the tabulate library"""
+    return _format_headers(unit), list(_iter_bucket_rows(buckets_data, unit))
+
+def _json_bucket(data):
+    # Do not modify the folded data: it may be rendered again in another format
+    return dict(data, CreationDate=data['CreationDate'].replace(tzinfo=None).isoformat('T', 'seconds'))
 
 def _json_dumps(buckets_data, pretty=False):
-    for data in buckets_data.values():
-        data['CreationDate'] = data['CreationDate'].replace(tzinfo=None).isoformat('T', 'seconds')
-    res = {'Buckets': list(buckets_data.values())}
+    buckets = [_json_bucket(data) for data in buckets_data.values()]
+    res = {'Buckets': buckets}
     if pretty:
         return json.dumps(res, sort_keys=True, indent=2)
     else:
         return json.dumps(res, sort_keys=True, separators=(',', ':'))
 
-def analyse(prefix=None, unit='MB', conc=None, fmt='plain'):
-    """Generates a formatted report"""
-    if conc is not None:
-        _POOL_SIZE[0] = conc
-    buckets = list_buckets(prefix=prefix)
-    metrics = list_metrics(buckets, prefix=prefix)
-    metrics_data = get_metrics_data(metrics, buckets)
+# ------------ Pipelined Cloudwatch analysis
+# Buckets per ListBuckets page: the first buckets are resolved while the next ones are listed
+_LIST_BUCKETS_PAGE_SIZE = 1000
+
+def _literal_prefix(bucket_name):
+    """The start of a bucket name or glob before its first special character"""
+    return re.split(r'[?*\[!]', bucket_name, maxsplit=1)[0]
+
+def _list_buckets_page(**kwargs):
+    """A page of ListBuckets.
+    The botocore releases that do not know its pagination parameters return all the buckets"""
+    client = _get_client('s3')
+    try:
+        return client.list_buckets(**kwargs)
+    except ParamValidationError:
+        return client.list_buckets()
+
+def _next_buckets_page(kwargs, res):
+    if res.get('ContinuationToken'):
+        kwargs['ContinuationToken'] = res['ContinuationToken']
+        return kwargs
+    return None
+
+class _MetricsPipeline:
+    """Cloudwatch analysis without barriers between its stages:
+    ListBuckets page -> region of each bucket -> ListMetrics pages of its region
+    (or the metrics planned for the bucket when direct) -> datapoints folded as they arrive.
+    Each call is submitted as soon as its input is ready; the results are handled in the
+    calling thread so the state is never shared with the threads of the executor.
+    A bucket is complete once its metrics are listed (or planned) and all their datapoints
+    are folded: its folded row does not change anymore and can be reported"""
+    def __init__(self, executor, prefix=None, batch=False, direct=False, folded=None):
+        self._executor = executor
+        self._prefix = prefix
+        self._bucket_name = _extract_bucket_from_prefix(prefix)
+        self._batch = batch
+        self._direct = direct
+        # future -> (handler of its result, whether it is upstream of the datapoints)
+        self._futures = {}
+        self._upstream = 0
+        self._listed = set()
+        self._buckets = {}
+        self._regions_bybucket = {}
+        # the regions whose metrics are listed; and the ones whose listing is over
+        self._regions = set()
+        self._listed_regions = set()
+        # bucket name -> requests whose datapoints are not folded yet
+        self._pending = {}
+        # the complete buckets; and the ones not reported yet
+        self._complete = set()
+        self._completed = []
+        # bucket name -> metrics listed before the region of the bucket was known
+        self._held = {}
+        # (region, StartTime, EndTime) -> requests waiting for a GetMetricData batch
+        self._batches = {}
+        self._cache_changed = False
+        self.metrics_data = []
+        self.folded = fold_metrics_data([], folded)
+
+    def _submit(self, handler, fct, *args, upstream=True, **kwargs):
+        self._futures[self._executor.submit(fct, *args, **kwargs)] = (handler, upstream)
+        if upstream:
+            self._upstream += 1
+
+    def cancel(self):
+        """Cancel the calls that did not start yet"""
+        for future in self._futures:
+            future.cancel()
+
+    def run(self):
+        """Return the selected buckets sorted by name"""
+        for _rows in self.iter_completed():
+            pass
+        return self.buckets
+
+    def iter_completed(self):
+        """Run the pipeline: generator of the lists of the folded rows of the buckets
+        that became complete, in the order they complete.
+        Once it is exhausted, the buckets are selected and folded is sorted by bucket"""
+        _load_region_cache()
+        kwargs = {'MaxBuckets': _LIST_BUCKETS_PAGE_SIZE}
+        if self._bucket_name is not None and _literal_prefix(self._bucket_name):
+            kwargs['Prefix'] = _literal_prefix(self._bucket_name)
+        self._list_buckets_page(kwargs)
+        while self._futures:
+            done, _pending = wait(self._futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                handler, upstream = self._futures.pop(future)
+                if upstream:
+                    self._upstream -= 1
+                handler(future.result())
+            if self._upstream == 0:
+                # nothing else will join the batches
+                for key in list(self._batches):
+                    self._submit_batch(key)
+            rows = [self.folded['bybucket'][name] for name in self._completed
+                    if name in self.folded['bybucket']]
+            self._completed = []
+            if rows:
+                yield rows
+        # only a complete listing tells which buckets are gone
+        forgotten = 'Prefix' not in kwargs and _forget_regions(self._listed)
+        if self._cache_changed or forgotten:
+            _save_region_cache()
+        if self._prefix is not None and not self._buckets:
+            raise ValueError(f'Invalid prefix "{self._prefix}"; no bucket selected')
+        bybucket = sorted(self.folded['bybucket'].items())
+        self.folded['bybucket'].clear()
+        self.folded['bybucket'].update(bybucket)
+        self.buckets = sorted(self._buckets.values(), key=itemgetter('Name'))
+
+    def _list_buckets_page(self, kwargs):
+        self._submit(partial(self._on_buckets_page, kwargs), _list_buckets_page, **kwargs)
+
+    def _on_buckets_page(self, kwargs, res):
+        next_kwargs = _next_buckets_page(dict(kwargs), res)
+        if next_kwargs is not None:
+            self._list_buckets_page(next_kwargs)
+        for bucket in res['Buckets']:
+            self._listed.add(bucket['Name'])
+            if self._bucket_name is not None and not fnmatchcase(bucket['Name'], self._bucket_name):
+                continue
+            # the paginated ListBuckets returns the region of the buckets
+            bucket_region = bucket.pop('BucketRegion', None)
+            if _cached_region(bucket):
+                self._on_region(bucket)
+            elif bucket_region is not None:
+                bucket['Region'] = _normalize_location(bucket_region)
+                self._on_fetched_region(bucket)
+            else:
+                self._submit(self._on_fetched_region, fetch_bucket_info, bucket)
+
+    def _on_fetched_region(self, bucket):
+        _cache_region(bucket)
+        self._cache_changed = True
+        self._on_region(bucket)
+
+    def _on_region(self, bucket):
+        name = bucket['Name']
+        region = bucket['Region']
+        self._buckets[name] = bucket
+        self._regions_bybucket[name] = region
+        if self._direct:
+            for metric in plan_metrics([bucket]):
+                self._request(metric)
+        else:
+            for metric in self._held.pop(name, []):
+                if metric['_region'] == region:
+                    self._request(metric)
+            if region not in self._regions:
+                self._regions.add(region)
+                self._list_metrics_page(region, _list_metrics_kwargs(self._bucket_name))
+        self._check_complete(name)
+
+    def _check_complete(self, name):
+        if name in self._complete or self._pending.get(name):
+            return
+        if not self._direct and self._regions_bybucket[name] not in self._listed_regions:
+            return
+        self._complete.add(name)
+        self._completed.append(name)
+
+    def _list_metrics_page(self, region, kwargs):
+        self._submit(partial(self._on_metrics_page, region, kwargs),
+                     _get_cw_client(region).list_metrics, **kwargs)
+
+    def _on_metrics_page(self, region, kwargs, res):
+        next_kwargs = _next_metrics_page(dict(kwargs), res)
+        if next_kwargs is not None:
+            self._list_metrics_page(region, next_kwargs)
+        for metric in _select_metrics(res['Metrics'], self._bucket_name, region):
+            name = _get_bucket_name(metric)
+            if name not in self._buckets:
+                # its bucket is not resolved yet, not selected or gone
+                self._held.setdefault(name, []).append(metric)
+            elif self._regions_bybucket[name] == region:
+                self._request(metric)
+        if next_kwargs is None:
+            self._listed_regions.add(region)
+            for name, bucket_region in self._regions_bybucket.items():
+                if bucket_region == region:
+                    self._check_complete(name)
+
+    def _request(self, metric):
+        unit = _METRIC_UNITS.get(metric['MetricName'])
+        if unit is None:
+            return
+        req = _make_req(metric, unit, self._regions_bybucket)
+        name = _get_bucket_name(metric)
+        self._pending[name] = self._pending.get(name, 0) + 1
+        if not self._batch:
+            self._submit(partial(self._on_datapoint, name), get_metric, req, upstream=False)
+            return
+        key = (req['_region'], req['StartTime'], req['EndTime'])
+        self._batches.setdefault(key, []).append(req)
+        if len(self._batches[key]) == _METRIC_DATA_MAX_QUERIES:
+            self._submit_batch(key)
+
+    def _submit_batch(self, key):
+        region, start_time, end_time = key
+        requests = self._batches.pop(key)
+        self._submit(partial(self._on_batch, requests), get_metric_batch, {
+            '_region': region,
+            'StartTime': start_time,
+            'EndTime': end_time,
+            'Requests': requests
+        }, upstream=False)
+
+    def _on_datapoint(self, name, datapoint):
+        if datapoint is not None:
+            self._fold([datapoint])
+        self._on_folded(name)
+
+    def _on_batch(self, requests, data):
+        self._fold(data)
+        for req in requests:
+            self._on_folded(_get_bucket_name(req))
+
+    def _on_folded(self, name):
+        self._pending[name] -= 1
+        self._check_complete(name)
+
+    def _fold(self, data):
+        for datapoint in data:
+            datapoint.update(self._buckets[datapoint['BucketName']])
+        fold_metrics_data(data, self.folded)
+        self.metrics_data.extend(data)
+
+def _pipeline_size():
+    """The threads of the pipeline: --conc unless the workers are processes"""
+    if _EXECUTOR[0] != 'process' and _POOL_SIZE[0]:
+        return _POOL_SIZE[0]
+    return _IO_POOL_SIZE
+
+def iter_pipeline_folded(folded, prefix=None, batch=False, direct=False):
+    """Run the Cloudwatch analysis as a pipeline in threads and fold its datapoints into folded:
+    generator of the lists of the folded rows of the buckets as soon as they are complete.
+    The gauges are updated once it is exhausted"""
+    executor = ThreadPoolExecutor(max_workers=_pipeline_size())
+    pipeline = _MetricsPipeline(executor, prefix=prefix, batch=batch, direct=direct,
+                                folded=folded)
+    try:
+        with timed_phase('cloudwatch', 'pipeline'):
+            for rows in pipeline.iter_completed():
+                yield rows
+    finally:
+        # after a failed call: do not wait for the calls queued behind it
+        pipeline.cancel()
+        executor.shutdown()
+    if direct:
+        remember_storage_types(pipeline.buckets, pipeline.metrics_data)
+    update_gauges(pipeline.metrics_data)
+
+def analyse_folded(prefix=None, conc=None, batch=False, executor=None, adaptive=None,
+                   snapshots=None, backfill=1, direct=False, pipeline=False):
+    """Fetches the datapoints, updates the gauges and returns the folded datapoints
+    When snapshots is set, the datapoints of the last backfill days are kept in that
+    SQLite database and only the missing days are fetched.
+    When direct is set, the metrics are planned from the buckets instead of listed.
+    When pipeline is set, the stages overlap; it does not apply to the snapshots"""
+    set_pool(conc, executor, adaptive)
+    if pipeline and snapshots is None:
+        folded = fold_metrics_data([])
+        for _rows in iter_pipeline_folded(folded, prefix=prefix, batch=batch, direct=direct):
+            pass
+        return folded
+    with timed_phase('cloudwatch', 'list_buckets'):
+        buckets = list_buckets(prefix=prefix)
+    if direct:
+        with timed_phase('cloudwatch', 'plan_metrics'):
+            metrics = plan_metrics(buckets)
+    else:
+        with timed_phase('cloudwatch', 'list_metrics'):
+            metrics = list_metrics(buckets, prefix=prefix)
+    with timed_phase('cloudwatch', 'get_metrics_data'):
+        if snapshots is not None:
+            store = SnapshotStore(snapshots)
+            try:
+                metrics_data = get_metrics_snapshots(metrics, buckets, store, days=backfill)
+            finally:
+                store.close()
+        else:
+            metrics_data = get_metrics_data(metrics, buckets, batch=batch)
+    if direct:
+        remember_storage_types(buckets, metrics_data)
+    with timed_phase('cloudwatch', 'fold'):
+        folded = fold_metrics_data(metrics_data)
     update_gauges(metrics_data)
-    folded = fold_metrics_data(metrics_data)
+    return folded
+
+# The formats written one bucket at a time
+STREAM_FORMATS = ['csv', 'tsv', 'ndjson']
+
+def report_header_line(unit='MB', fmt='csv'):
+    """The first line of a csv or tsv report; None for ndjson"""
+    if fmt == 'ndjson':
+        return None
+    return ('\t' if fmt == 'tsv' else ',').join(_format_headers(unit))
+
+def iter_bucket_lines(buckets_data, unit='MB', fmt='csv'):
+    """Generator of the lines of the folded rows of some buckets without their line feed.
+    A line is formatted only when it is consumed"""
+    if fmt == 'ndjson':
+        for data in buckets_data:
+            yield json.dumps(_json_bucket(data), sort_keys=True, separators=(',', ':'))
+        return
+    sep = '\t' if fmt == 'tsv' else ','
+    for row in _iter_bucket_rows(buckets_data, unit):
+        yield sep.join(str(x) for x in row)
+
+def iter_report_lines(folded, unit='MB', fmt='csv'):
+    """Generator of the lines of a csv, tsv or ndjson report without their line feed"""
+    header = report_header_line(unit=unit, fmt=fmt)
+    if header is not None:
+        yield header
+    for line in iter_bucket_lines(folded['bybucket'].values(), unit=unit, fmt=fmt):
+        yield line
+
+def write_report(folded, file, unit='MB', fmt='csv'):
+    """Write a csv, tsv or ndjson report one line at a time"""
+    write_report_rows([folded['bybucket'].values()], file, unit=unit, fmt=fmt)
+
+def write_report_rows(row_groups, file, unit='MB', fmt='csv'):
+    """Write a csv, tsv or ndjson report from groups of folded rows of buckets
+    such as the ones of iter_pipeline_folded; the file is flushed after each group"""
+    header = report_header_line(unit=unit, fmt=fmt)
+    if header is not None:
+        file.write(header + '\n')
+    for rows in row_groups:
+        for line in iter_bucket_lines(rows, unit=unit, fmt=fmt):
+            file.write(line + '\n')
+        file.flush()
+
+def format_report(folded, unit='MB', fmt='plain'):
+    """Formats the folded datapoints"""
     if fmt == 'json' or fmt == 'json_pretty':
         return _json_dumps(folded['bybucket'], pretty=True if fmt == 'json_pretty' else False)
+    if fmt in STREAM_FORMATS:
+        return '\n'.join(iter_report_lines(folded, unit=unit, fmt=fmt))
     headers, rows = _format_buckets(folded['bybucket'].values(), unit=unit)
-    if fmt == 'tsv' or fmt == 'csv':
-        sep = '\t' if fmt == 'tsv' else ','
-        lines = [sep.join(str(x) for x in row) for row in rows]
-        return sep.join(headers) + '\n' + '\n'.join(lines)
     tabulated = tabulate.tabulate(rows, headers=headers, tablefmt=fmt)
     return tabulated
 
+def format_growth_report(growth, unit='GB', fmt='plain'):
+    """Table of the growth of each bucket between the first and the last day of the snapshots"""
+    rows = []
+    for data in growth:
+        bytes_from, bytes_to = data['Bytes']
+        files_from, files_to = data['Files']
+        rows.append([
+            data['Bucket'],
+            data['Region'],
+            data['From'],
+            data['To'],
+            convert_bytes(bytes_to, unit),
+            convert_bytes(bytes_to - bytes_from, unit),
+            round(100.0 * (bytes_to - bytes_from) / bytes_from, 2) if bytes_from else None,
+            files_to - files_from
+        ])
+    headers = ['Bucket', 'Region', 'From', 'To', f'Total({unit})', f'Growth({unit})',
+               'Growth(%)', 'Files']
+    return tabulate.tabulate(rows, headers=headers, tablefmt=fmt)
+
+def analyse(prefix=None, unit='MB', conc=None, fmt='plain', batch=False, executor=None,
+            adaptive=None, snapshots=None, backfill=1, direct=False, pipeline=False):
+    """Generates a formatted report"""
+    folded = analyse_folded(prefix=prefix, conc=conc, batch=batch, executor=executor,
+                            adaptive=adaptive, snapshots=snapshots, backfill=backfill,
+                            direct=direct, pipeline=pipeline)
+    # exported with the gauges of the next analysis
+    with timed_phase('cloudwatch', 'format_report'):
+        return format_report(folded, unit=unit, fmt=fmt)
+
 # ------------ S3 API long running job
-def traverse_bucket(bucket, max_keys=None): # prefix=None,
-    """Paginates through the objects in the bucket
-    keep track of the number of files; sum the size of each file"""
-    total_bytes = 0
-    total_files = 0
-    last_modified = datetime(1970, 1, 1, tzinfo=timezone.utc)
+def _new_storage_stats():
     storage_type_stats = {}
     for _type in STORAGE_TYPES:
         storage_type_stats[_type] = {
@@ -450,71 +1664,644 @@ def traverse_bucket(bucket, max_keys=None): # prefix=None,
             'TotalFiles': 0,
             'LastModified': datetime(1970, 1, 1, tzinfo=timezone.utc)
         }
+    return storage_type_stats
+
+# Upper bounds of the histograms of the objects per storage type:
+# log2 of the size in bytes up to 4 TiB and age in days for the lifecycle rules
+_SIZE_HISTOGRAM_BOUNDS = [2 ** exp for exp in range(0, 43)]
+_AGE_HISTOGRAM_BOUNDS = [1, 7, 30, 90, 180, 365, 730, 1825]
+
+def _new_histograms(storage_type_stats):
+    """Add the fixed size histograms to the stats per storage type"""
+    for stats in storage_type_stats.values():
+        stats['SizeHistogram'] = [0] * (len(_SIZE_HISTOGRAM_BOUNDS) + 1)
+        stats['AgeHistogram'] = [0] * (len(_AGE_HISTOGRAM_BOUNDS) + 1)
+        # integer seconds: the sums of the key ranges merge exactly whenever they were scanned.
+        # The ages are computed from it once, at the export
+        stats['LastModifiedSecondsSum'] = 0
+    return storage_type_stats
+
+def _merge_histograms(merged, stats):
+    for name in ('SizeHistogram', 'AgeHistogram'):
+        merged[name] = [total + count for total, count in zip(merged[name], stats[name])]
+    merged['LastModifiedSecondsSum'] += stats['LastModifiedSecondsSum']
+
+# Number of prefixes kept per bucket and per key range
+_PREFIX_TREE_MAX_NODES = 10000
+
+class PrefixTree:
+    """Size, number of objects and newest LastModified of each prefix ('directory')
+    of the keys down to depth levels.
+
+    The memory is bounded: past 2 * max_nodes prefixes, only the max_nodes heaviest are kept.
+    A prefix is pruned only when max_nodes prefixes are heavier at the time of the pruning;
+    once pruned and seen again it is undercounted by at most 'error' bytes."""
+    def __init__(self, depth, max_nodes=_PREFIX_TREE_MAX_NODES):
+        self.depth = depth
+        self.max_nodes = max_nodes
+        self.error = 0
+        # prefix -> [bytes, objects, last_modified timestamp]
+        self.nodes = {}
+
+    def add(self, key, size, last_modified):
+        """Count an object in each of its prefixes"""
+        parts = key.split('/', self.depth)
+        prefix = ''
+        # the last part is the name of the object or the rest of the key past depth
+        for part in parts[:-1]:
+            prefix += part + '/'
+            node = self.nodes.get(prefix)
+            if node is None:
+                self.nodes[prefix] = [size, 1, last_modified]
+                if len(self.nodes) > 2 * self.max_nodes:
+                    self._prune()
+                continue
+            node[0] += size
+            node[1] += 1
+            if last_modified > node[2]:
+                node[2] = last_modified
+
+    def merge(self, other):
+        """Add the prefixes of another key range of the bucket"""
+        for prefix, (size, objects, last_modified) in other.nodes.items():
+            node = self.nodes.get(prefix)
+            if node is None:
+                self.nodes[prefix] = [size, objects, last_modified]
+                continue
+            node[0] += size
+            node[1] += objects
+            if last_modified > node[2]:
+                node[2] = last_modified
+        self.error += other.error
+        if len(self.nodes) > 2 * self.max_nodes:
+            self._prune()
+
+    def _prune(self):
+        # only called past 2 * max_nodes: select the heaviest without sorting all of them
+        heaviest = heapq.nlargest(self.max_nodes + 1, self.nodes.items(),
+                                  key=lambda item: item[1][0])
+        self.error += heaviest[self.max_nodes][1][0]
+        self.nodes = dict(heaviest[:self.max_nodes])
+
+    def top(self, count):
+        """The count heaviest prefixes of each level, heaviest first"""
+        bylevel = {}
+        for prefix, (size, objects, last_modified) in self.nodes.items():
+            bylevel.setdefault(prefix.count('/'), []).append({
+                'Prefix': prefix,
+                'TotalSize': size,
+                'TotalFiles': objects,
+                'LastModified': datetime.fromtimestamp(last_modified, tz=timezone.utc)
+            })
+        top = []
+        for level in sorted(bylevel.keys()):
+            top.extend(sorted(bylevel[level], key=itemgetter('TotalSize'), reverse=True)[:count])
+        return top
+
+    def to_json(self):
+        """Serializable state for the checkpoints"""
+        return {
+            'Depth': self.depth,
+            'MaxNodes': self.max_nodes,
+            'Error': self.error,
+            'Nodes': [[prefix, size, objects, last_modified]
+                      for prefix, (size, objects, last_modified) in self.nodes.items()]
+        }
+
+    @staticmethod
+    def from_json(state):
+        """Reverse of to_json"""
+        tree = PrefixTree(state['Depth'], max_nodes=state['MaxNodes'])
+        tree.error = state['Error']
+        for prefix, size, objects, last_modified in state['Nodes']:
+            tree.nodes[prefix] = [size, objects, last_modified]
+        return tree
+
+class TraversalCancelled(Exception):
+    """The traversal of a key range was cancelled before its end"""
+
+def traverse_bucket(bucket, max_keys=None): # prefix=None,
+    """Paginates through the objects in the bucket
+    keep track of the number of files; sum the size of each file"""
+    partial_stats = traverse_key_range({'Bucket': bucket}, max_keys=max_keys)
+    return _merge_storage_stats(bucket, [partial_stats])
+
+def traverse_key_range(key_range, max_keys=None):
+    """Paginates through the objects of a range of keys of a bucket:
+    StartAfter < Key <= EndKey. Either bound is optional.
+    Return the partial stats {'StorageStats', 'Prefixes'} of the range
+
+    When the key range carries a '_checkpoint', the last key and the partial stats
+    are saved every N pages and a resumed traversal starts after the last saved key.
+    When it carries a '_prefix_tree' {'depth', 'max_nodes'}, the objects are also
+    aggregated per prefix.
+    When it carries '_fast_list', the pages are parsed by _parse_objects_page.
+    When it carries a '_cancel' threading.Event, TraversalCancelled is raised
+    at the next page once it is set"""
+    # LastModified is a timestamp until the partial stats are returned
+    storage_type_stats = _new_histograms(_new_storage_stats())
+    for stats in storage_type_stats.values():
+        stats['LastModified'] = 0.0
+    # the age buckets are in days: the start of the scan of the range is precise enough
+    now = datetime.now(timezone.utc).timestamp()
+    max_size_bucket = len(_SIZE_HISTOGRAM_BOUNDS)
+    tree_options = key_range.get('_prefix_tree')
+    prefix_tree = None
+    if tree_options is not None:
+        prefix_tree = PrefixTree(tree_options['depth'], max_nodes=tree_options['max_nodes'])
     # prefix = _extract_prefix_arg(prefix)
-    kwargs = {'Bucket': bucket['Name']}
+    kwargs = {'Bucket': key_range['Bucket']['Name']}
     # if prefix is not None:
     #     kwargs['Prefix'] = prefix
+    if key_range.get('StartAfter') is not None:
+        kwargs['StartAfter'] = key_range['StartAfter']
+    end_key = key_range.get('EndKey')
     if max_keys is not None:
         kwargs['MaxKeys'] = max_keys
-    for obj in _list_objects(**kwargs):
-        if obj['Size'] != 0:
-            total_bytes += obj['Size']
-            total_files += 1
-            ts = obj['LastModified']
-            if ts > last_modified:
-                last_modified = ts
-            stats = storage_type_stats[obj['StorageClass']]
-            stats['TotalSize'] += obj['Size']
-            stats['TotalFiles'] += 1
-            if ts > stats['LastModified']:
-                stats['LastModified'] = ts
+    kwargs['_fast_list'] = key_range.get('_fast_list', False)
+    checkpoint = key_range.get('_checkpoint')
+    if checkpoint is not None:
+        state_path = _checkpoint_path(checkpoint, key_range)
+        state = _load_checkpoint(state_path) if checkpoint['resume'] else None
+        if state is not None:
+            storage_type_stats = state['StorageStats']
+            prefix_tree = state['Prefixes']
+            if state['Done']:
+                return _make_partial_stats(storage_type_stats, prefix_tree)
+            if state['LastKey'] is not None:
+                kwargs['StartAfter'] = state['LastKey']
+    cancel = key_range.get('_cancel')
+    pages = 0
+    for contents in _list_objects(**kwargs):
+        if cancel is not None and cancel.is_set():
+            raise TraversalCancelled(f"{key_range['Bucket']['Name']} after {pages} pages")
+        reached_end = end_key is not None and contents and contents[-1][0] > end_key
+        if reached_end:
+            contents = [obj for obj in contents if obj[0] <= end_key]
+        for key, size, timestamp, storage_class in contents:
+            if size != 0:
+                stats = storage_type_stats[storage_class]
+                stats['TotalSize'] += size
+                stats['TotalFiles'] += 1
+                if timestamp > stats['LastModified']:
+                    stats['LastModified'] = timestamp
+                # (size - 1).bit_length() is the index of the smallest power of 2 >= size
+                stats['SizeHistogram'][min((size - 1).bit_length(), max_size_bucket)] += 1
+                stats['AgeHistogram'][bisect_left(_AGE_HISTOGRAM_BOUNDS,
+                                                  (now - timestamp) / 86400)] += 1
+                stats['LastModifiedSecondsSum'] += int(timestamp)
+                if prefix_tree is not None:
+                    prefix_tree.add(key, size, timestamp)
+        if reached_end:
+            break
+        pages += 1
+        if checkpoint is not None and contents and pages % checkpoint['pages'] == 0:
+            _save_checkpoint(state_path, storage_type_stats, prefix_tree, contents[-1][0])
+    if checkpoint is not None:
+        _save_checkpoint(state_path, storage_type_stats, prefix_tree, None, done=True)
+    return _make_partial_stats(storage_type_stats, prefix_tree)
+
+def _make_partial_stats(storage_type_stats, prefix_tree):
+    """The partial stats of a key range with LastModified as a datetime"""
+    storage_stats = {}
+    for _type, stats in storage_type_stats.items():
+        storage_stats[_type] = dict(
+            stats, LastModified=datetime.fromtimestamp(stats['LastModified'], tz=timezone.utc))
+    return {'StorageStats': storage_stats, 'Prefixes': prefix_tree}
+
+def partial_stats_to_json(partial_stats):
+    """Serializable partial stats of a key range: LastModified is a timestamp"""
+    storage_stats = {}
+    for _type, stats in partial_stats['StorageStats'].items():
+        storage_stats[_type] = dict(stats, LastModified=stats['LastModified'].timestamp())
+    prefixes = partial_stats['Prefixes'].to_json() \
+        if partial_stats.get('Prefixes') is not None else None
+    return {'StorageStats': storage_stats, 'Prefixes': prefixes}
+
+def partial_stats_from_json(state):
+    """Reverse of partial_stats_to_json"""
+    prefixes = PrefixTree.from_json(state['Prefixes']) if state['Prefixes'] is not None else None
+    return _make_partial_stats(state['StorageStats'], prefixes)
+
+def _checkpoint_path(checkpoint, key_range):
+    """One state file per key range"""
+    bounds = f"{key_range.get('StartAfter')}\n{key_range.get('EndKey')}"
+    digest = hashlib.sha1(bounds.encode()).hexdigest()[:12]
+    return os.path.join(checkpoint['dir'], f"{key_range['Bucket']['Name']}-{digest}.json")
+
+def _split_plan_path(checkpoint, bucket_name):
+    return os.path.join(checkpoint['dir'], f'{bucket_name}.ranges.json')
+
+def _write_json_atomic(path, data):
+    """Write to a temporary file then rename it: a crash never leaves half a file"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+def _save_checkpoint(path, storage_type_stats, prefix_tree, last_key, done=False):
+    """Save the partial stats of a key range and the last key they include.
+    LastModified is saved as a timestamp"""
+    prefixes = prefix_tree.to_json() if prefix_tree is not None else None
+    _write_json_atomic(path, {
+        'LastKey': last_key,
+        'Done': done,
+        'StorageStats': storage_type_stats,
+        'Prefixes': prefixes
+    })
+
+def _load_checkpoint(path):
+    """Return the saved state of a key range or None"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        state = json.load(file)
+    if state['Prefixes'] is not None:
+        state['Prefixes'] = PrefixTree.from_json(state['Prefixes'])
+    return state
+
+def _clear_checkpoints(checkpoint, key_ranges):
+    """Remove the state files once the whole analysis is complete"""
+    paths = set()
+    for key_range in key_ranges:
+        paths.add(_checkpoint_path(checkpoint, key_range))
+        paths.add(_split_plan_path(checkpoint, key_range['Bucket']['Name']))
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def _merge_storage_stats(bucket, partial_stats, top_prefixes=10):
+    """Sum the stats per storage type and per prefix of the key ranges of a bucket
+    and update the bucket with the totals.
+    The histograms are merged when the partial stats have them"""
+    storage_type_stats = _new_storage_stats()
+    prefix_tree = None
+    for range_stats in partial_stats:
+        if range_stats.get('Prefixes') is not None:
+            if prefix_tree is None:
+                prefix_tree = PrefixTree(range_stats['Prefixes'].depth,
+                                         range_stats['Prefixes'].max_nodes)
+            prefix_tree.merge(range_stats['Prefixes'])
+        for _type, stats in range_stats['StorageStats'].items():
+            if _type not in storage_type_stats:
+                # The inventory reports more storage classes than the ones we track
+                storage_type_stats[_type] = _new_storage_stats()[STORAGE_TYPES[0]]
+            merged = storage_type_stats[_type]
+            merged['TotalSize'] += stats['TotalSize']
+            merged['TotalFiles'] += stats['TotalFiles']
+            if stats['LastModified'] > merged['LastModified']:
+                merged['LastModified'] = stats['LastModified']
+            if 'SizeHistogram' in stats:
+                if 'SizeHistogram' not in merged:
+                    _new_histograms({_type: merged})
+                _merge_histograms(merged, stats)
     bucket.update({
-        'TotalSize': total_bytes,
-        'TotalFiles': total_files,
-        'LastModified': last_modified,
+        'TotalSize': sum(stats['TotalSize'] for stats in storage_type_stats.values()),
+        'TotalFiles': sum(stats['TotalFiles'] for stats in storage_type_stats.values()),
+        'LastModified': max(stats['LastModified'] for stats in storage_type_stats.values()),
         'StorageStats': storage_type_stats
     })
+    if prefix_tree is not None:
+        bucket['TopPrefixes'] = prefix_tree.top(top_prefixes)
+        bucket['TopPrefixesError'] = prefix_tree.error
     return bucket
 
+def _list_common_prefixes(bucket_name, prefix, delimiter='/'):
+    """Return the 'directories' directly under a prefix (first page only)"""
+    res = _get_client('s3').list_objects_v2(
+        Bucket=bucket_name, Prefix=prefix, Delimiter=delimiter)
+    return [common['Prefix'] for common in res.get('CommonPrefixes', [])]
+
+_SPLIT_MAX_DEPTH = 3
+
+def split_bucket(params):
+    """Split the key space of a bucket in up to params['ranges'] key ranges.
+    The boundaries are the common prefixes discovered level by level
+    with a delimiter; the ranges are contiguous so every key belongs to exactly one.
+    A bucket without any 'directory' is not split."""
+    bucket = params['bucket']
+    checkpoint = params.get('_checkpoint')
+    boundaries = None
+    if checkpoint is not None:
+        # Resume with the same ranges even if the bucket changed since
+        plan_path = _split_plan_path(checkpoint, bucket['Name'])
+        if checkpoint['resume'] and os.path.exists(plan_path):
+            with open(plan_path) as file:
+                boundaries = json.load(file)
+    if boundaries is None:
+        boundaries = _find_split_boundaries(bucket['Name'], params['ranges'])
+        if checkpoint is not None:
+            _write_json_atomic(plan_path, boundaries)
+    key_ranges = []
+    start_after = None
+    for end_key in boundaries + [None]:
+        key_ranges.append({
+            'Bucket': bucket,
+            'StartAfter': start_after,
+            'EndKey': end_key,
+            '_checkpoint': checkpoint
+        })
+        start_after = end_key
+    return key_ranges
+
+def _find_split_boundaries(bucket_name, max_ranges):
+    prefixes = ['']
+    for _ in range(0, _SPLIT_MAX_DEPTH):
+        if len(prefixes) >= max_ranges:
+            break
+        expanded = []
+        for prefix in prefixes:
+            children = _list_common_prefixes(bucket_name, prefix)
+            expanded.extend(children if children else [prefix])
+        if expanded == prefixes:
+            break
+        prefixes = expanded
+    boundaries = sorted(prefix for prefix in prefixes if prefix)
+    if len(boundaries) >= max_ranges:
+        # keep max_ranges - 1 boundaries evenly spread
+        step = len(boundaries) / max_ranges
+        boundaries = [boundaries[int(step * (i + 1))] for i in range(0, max_ranges - 1)]
+    return boundaries
+
+def _next_objects_page(kwargs, res):
+    if res['IsTruncated'] is not True:
+        return None
+    if 'NextContinuationToken' in res:
+        kwargs['ContinuationToken'] = res['NextContinuationToken']
+    elif 'FastContents' in res:
+        kwargs['StartAfter'] = res['FastContents'][-1][0]
+    else:
+        kwargs['StartAfter'] = res['Contents'][-1]['Key']
+    return kwargs
+
 def _list_objects(**kwargs):
     """Generator to iterate the objects found in a bucket.
-    yield one object at a time
-    bucket, prefix=None, max_keys=1000, Marker=None"""
-    objects = boto3.client('s3').list_objects_v2(**kwargs)
-    contents = objects['Contents']
-    for content in contents:
-        yield content
-
-    if objects['IsTruncated'] is True:
-        if 'ContinuationToken' in objects:
-            kwargs['ContinuationToken'] = objects['NextContinuationToken']
-        else:
-            kwargs['StartAfter'] = contents[-1]['Key']
-        for i in _list_objects(**kwargs):
-            yield i
+    yield one page (list) of (Key, Size, LastModified timestamp, StorageClass) at a time
+    bucket, prefix=None, max_keys=1000, Marker=None.
+    With _fast_list the pages are parsed by _parse_objects_page instead of botocore"""
+    client = _get_client('s3', fast_list=kwargs.pop('_fast_list', False))
+    for res in _paginate(client.list_objects_v2, _next_objects_page, **kwargs):
+        yield _object_tuples(res)
+
+def _object_tuples(res):
+    """(Key, Size, LastModified timestamp, StorageClass) of the objects of a page"""
+    if 'FastContents' in res:
+        return res['FastContents']
+    # An empty bucket or key range has no Contents
+    return [(obj['Key'], obj['Size'], obj['LastModified'].timestamp(), obj['StorageClass'])
+            for obj in res.get('Contents', [])]
+
+# The elements of an object are searched in its Contents block: S3 does not document their order
+_CONTENTS = re.compile(rb'<Contents>(.*?)</Contents>', re.S)
+_KEY = re.compile(rb'<Key>([^<]*)</Key>')
+_LAST_MODIFIED = re.compile(rb'<LastModified>([^<]*)</LastModified>')
+_SIZE = re.compile(rb'<Size>([0-9]+)</Size>')
+_STORAGE_CLASS = re.compile(rb'<StorageClass>([^<]*)</StorageClass>')
+_IS_TRUNCATED = re.compile(rb'<IsTruncated>([^<]*)</IsTruncated>')
+_NEXT_CONTINUATION_TOKEN = re.compile(rb'<NextContinuationToken>([^<]*)</NextContinuationToken>')
+_ENCODING_TYPE = re.compile(rb'<EncodingType>([^<]*)</EncodingType>')
+_EMPTY_LIST_BUCKET_RESULT = (b'<?xml version="1.0" encoding="UTF-8"?>'
+                             b'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                             b'</ListBucketResult>')
+# Timestamps of the days 'YYYY-MM-DD' seen by the process
+_DAY_TIMESTAMPS = {}
+
+def _parse_iso_timestamp(value):
+    """Timestamp of an ISO 8601 UTC date YYYY-MM-DDTHH:MM:SS[.fff]Z"""
+    day = _DAY_TIMESTAMPS.get(value[:10])
+    if day is None:
+        day = _DAY_TIMESTAMPS[value[:10]] = datetime(
+            int(value[0:4]), int(value[5:7]), int(value[8:10]), tzinfo=timezone.utc).timestamp()
+    return day + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + float(value[17:-1])
+
+def _parse_objects_page(response_dict, customized_response_dict, **_kwargs):
+    """botocore before-parse handler of ListObjectsV2.
+    Extract (Key, Size, LastModified timestamp, StorageClass) from the XML body into
+    FastContents and leave an empty body to botocore: it is much slower to build a dict
+    and a datetime per object.
+    A page with a missing element or an unmatched Contents block is left to botocore"""
+    if response_dict['status_code'] >= 300:
+        return
+    body = response_dict['body']
+    is_truncated = _IS_TRUNCATED.search(body)
+    if is_truncated is None:
+        return
+    url_encoded = _ENCODING_TYPE.search(body)
+    url_encoded = url_encoded is not None and url_encoded.group(1) == b'url'
+    storage_classes = {}
+    contents = []
+    for block in _CONTENTS.findall(body):
+        elements = (_KEY.search(block), _LAST_MODIFIED.search(block),
+                    _SIZE.search(block), _STORAGE_CLASS.search(block))
+        if None in elements:
+            # Something unexpected: botocore parses the whole page
+            return
+        key, last_modified, size, storage_class = (element.group(1) for element in elements)
+        key = key.decode()
+        if url_encoded:
+            key = unquote_plus(key)
+        elif '&' in key:
+            key = html_unescape(key)
+        name = storage_classes.get(storage_class)
+        if name is None:
+            name = storage_classes[storage_class] = storage_class.decode()
+        contents.append((key, int(size), _parse_iso_timestamp(last_modified), name))
+    if len(contents) != body.count(b'<Contents>'):
+        return
+    customized_response_dict['FastContents'] = contents
+    customized_response_dict['IsTruncated'] = is_truncated.group(1) == b'true'
+    token = _NEXT_CONTINUATION_TOKEN.search(body)
+    if token is not None:
+        customized_response_dict['NextContinuationToken'] = html_unescape(token.group(1).decode())
+    response_dict['body'] = _EMPTY_LIST_BUCKET_RESULT
+
+# ------------ S3 sampling estimates
+# Half width of the 95% confidence interval in standard deviations
+_CONFIDENCE_Z = 1.96
+# Sorts after any character of a key
+_MAX_KEY_CHAR = '\U0010ffff'
+
+class _BudgetExhausted(Exception):
+    pass
+
+class _KeyTrieSampler:
+    """Estimate the stats of a bucket with a budget of LIST calls.
+
+    The keys are seen as a trie of characters. A node is listed with its prefix:
+    the children whose keys all fit in the pages are counted exactly and the pages skip
+    the other children with StartAfter. Each walk descends from the root into a child
+    that was not counted, drawn at random among the ones not explored yet,
+    until the budget is spent or the whole trie is listed.
+
+    The total of a node is its exact part plus the number of children that were not counted
+    times the mean of the explored ones: a two stage sample (Knuth, Cochran)"""
+    def __init__(self, client, bucket_name, budget, page_size=1000, seed=None):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.budget = budget
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.calls = 0
+        # storage class -> newest timestamp of the objects seen
+        self.newest = {}
+        # prefix -> (storage class -> [bytes, objects] counted exactly, children not counted)
+        self.nodes = {}
+        # prefix -> children explored in the order they were drawn
+        self.explored = {}
+        # prefixes whose whole subtree is listed
+        self.complete = set()
+
+    def _list_page(self, **kwargs):
+        if self.calls >= self.budget:
+            raise _BudgetExhausted()
+        self.calls += 1
+        res = self.client.list_objects_v2(Bucket=self.bucket_name, MaxKeys=self.page_size,
+                                          **kwargs)
+        return _object_tuples(res), res['IsTruncated']
+
+    def node(self, prefix):
+        """The stats of the children of prefix that fit in the pages
+        and the children that do not"""
+        node = self.nodes.get(prefix)
+        if node is not None:
+            return node
+        exact = {}
+        big = []
+        depth = len(prefix)
+        kwargs = {'Prefix': prefix}
+        while True:
+            objects, truncated = self._list_page(**kwargs)
+            # the last child of a truncated page may have more keys
+            last_child = objects[-1][0][depth:depth + 1] if truncated else None
+            for key, size, timestamp, storage_class in objects:
+                if last_child and key[depth:depth + 1] == last_child:
+                    break
+                if timestamp > self.newest.get(storage_class, 0.0):
+                    self.newest[storage_class] = timestamp
+                if size != 0:
+                    for stats_key in (storage_class, None):
+                        stats = exact.setdefault(stats_key, [0, 0])
+                        stats[0] += size
+                        stats[1] += 1
+            if not truncated:
+                break
+            if last_child:
+                big.append(last_child)
+                kwargs['StartAfter'] = prefix + last_child + _MAX_KEY_CHAR
+            else:
+                # the page ends with the key equal to the prefix
+                kwargs['StartAfter'] = prefix
+        self.nodes[prefix] = (exact, big)
+        return self.nodes[prefix]
+
+    def walk(self):
+        """Explore one more path of the trie"""
+        path = []
+        prefix = ''
+        while True:
+            path.append(prefix)
+            _exact, big = self.node(prefix)
+            explored = self.explored.setdefault(prefix, [])
+            unexplored = [child for child in big if child not in explored]
+            if unexplored:
+                child = self.random.choice(unexplored)
+                explored.append(child)
+            else:
+                incomplete = [child for child in explored if prefix + child not in self.complete]
+                if not incomplete:
+                    break
+                child = self.random.choice(incomplete)
+            prefix += child
+        for prefix in reversed(path):
+            _exact, big = self.nodes[prefix]
+            if len(self.explored[prefix]) < len(big) or any(
+                    prefix + child not in self.complete for child in big):
+                break
+            self.complete.add(prefix)
+
+    def estimate(self, prefix=''):
+        """The estimated totals of a prefix and their variances:
+        storage class -> [bytes, objects]; None is the key of all the storage classes"""
+        exact, big = self.nodes[prefix]
+        totals = {stats_key: list(stats) for stats_key, stats in exact.items()}
+        variances = {}
+        children = [self.estimate(prefix + child) for child in self.explored.get(prefix, [])
+                    if prefix + child in self.nodes]
+        if not children:
+            # out of budget: only a lower bound
+            return totals, variances
+        nb_big = len(big)
+        nb_children = len(children)
+        for stats_key in set().union(*(child[0] for child in children)):
+            for index in (0, 1):
+                values = [child[0].get(stats_key, [0, 0])[index] for child in children]
+                mean = sum(values) / nb_children
+                if nb_children > 1:
+                    spread = sum((value - mean) ** 2 for value in values) / (nb_children - 1)
+                else:
+                    # a single child tells nothing of the others
+                    spread = mean ** 2
+                within = sum(child[1].get(stats_key, [0, 0])[index] for child in children)
+                variance = nb_big ** 2 * ((1 - nb_children / nb_big) * spread / nb_children +
+                                          within / nb_children ** 2)
+                totals.setdefault(stats_key, [0, 0])[index] += nb_big * mean
+                variances.setdefault(stats_key, [0, 0])[index] += variance
+        return totals, variances
+
+def sample_bucket(params):
+    """Estimate the stats of a bucket with at most 'budget' LIST calls.
+    The stats are exact when the whole bucket is listed within the budget.
+    params: {'bucket', 'budget', 'page_size', '_fast_list', '_seed'}"""
+    bucket = params['bucket']
+    client = _get_client('s3', fast_list=params.get('_fast_list', False))
+    sampler = _KeyTrieSampler(client, bucket['Name'], params['budget'],
+                              page_size=params.get('page_size', 1000), seed=params.get('_seed'))
+    try:
+        while '' not in sampler.complete:
+            sampler.walk()
+    except _BudgetExhausted:
+        pass
+    totals, variances = sampler.estimate() if '' in sampler.nodes else ({}, {})
+    storage_type_stats = {}
+    for storage_class in set(STORAGE_TYPES).union(sampler.newest, totals):
+        if storage_class is None:
+            continue
+        size, files = totals.get(storage_class, [0, 0])
+        storage_type_stats[storage_class] = {
+            'TotalSize': round(size),
+            'TotalFiles': round(files),
+            'LastModified': datetime.fromtimestamp(sampler.newest.get(storage_class, 0.0),
+                                                   tz=timezone.utc)
+        }
+    bucket = _merge_storage_stats(bucket, [{'StorageStats': storage_type_stats}])
+    sampled = '' not in sampler.complete
+    bucket.update({'Sampled': sampled, 'SampleCalls': sampler.calls})
+    if sampled:
+        for stats_key, stats in [(None, bucket)] + list(bucket['StorageStats'].items()):
+            size_variance, files_variance = variances.get(stats_key, [0, 0])
+            stats.update({
+                'TotalSizeError': round(_CONFIDENCE_Z * math.sqrt(size_variance)),
+                'TotalFilesError': round(_CONFIDENCE_Z * math.sqrt(files_variance))
+            })
+    return bucket
 
 def commit_s3_gauges():
     """Either push the gauges to a gateway if PROM_GATEWAY is set
-    or write them into a file if PROM_TEXT is set"""
+    or write them into a file if PROM_TEXT is set.
+    The analyser's own metrics are exported with them"""
+    _get_collector().replace('self', _self_metrics_tables())
     if 'PROM_GATEWAY' in os.environ:
         push_to_gateway(os.environ['PROM_GATEWAY'], job='s3rawanalyser', registry=REGISTRY[0])
         return
     write_to_textfile(get_metrics_prom(s3=True), REGISTRY[0])
+    _swap_exposition(s3=True)
 
-def _set_s3_object_gauge(name, value, **kwargs):
-    """Set the value of a gauge; be careful to only do this from a single
-    thread and to push to gateway before the thread is over"""
-    if REGISTRY[0] is None:
-        REGISTRY[0] = CollectorRegistry()
-    if name not in OBJECT_GAUGES:
-        OBJECT_GAUGES[name] = Gauge(
-            name, 'Number of buckets',
-            ['region', 'storage', 'bucket'], registry=REGISTRY[0])
-    OBJECT_GAUGES[name].labels(**kwargs).set(value)
+_PREFIX_GAUGE_LABELS = ('region', 'bucket', 'prefix')
 
-def update_s3_gauges(bucket_stats):
+def update_s3_gauges(bucket_stats, prefix_gauges=False):
     """
     Set the values of the s3 gauges
+    and of the heaviest prefixes gauges when prefix_gauges is set
 
     Ideally this could be done by the workers but
     prometheus seems clumsy with regard to sub-processes.
@@ -531,47 +2318,430 @@ def update_s3_gauges(bucket_stats):
     'TotalFiles': 4,
     'TotalSize': 24}
     """
+    sizes = GaugeTable('s3_size_bytes', 'Size of the objects', _OBJECT_GAUGE_SIZE_LABELS)
+    files = GaugeTable('s3_files_total', 'Number of objects', _OBJECT_GAUGE_SIZE_LABELS)
+    last_modified = GaugeTable('s3_last_modified', 'Last modification of an object',
+                               _OBJECT_GAUGE_SIZE_LABELS)
     for stat in bucket_stats:
-        # _set_s3_object_gauge() cloudwatch_s3_size_bytes cloudwatch_s3_objects_total
         storage_stats = stat['StorageStats']
+        region = str(stat['Region'])
         for index, _type in enumerate(STORAGE_TYPES):
-            abr = STORAGE_TYPES_ABR[index]
-            _set_s3_object_gauge(
-                's3_size_bytes', storage_stats[_type]['TotalSize'],
-                region=stat['Region'], bucket=stat['Name'], storage=abr)
-            _set_s3_object_gauge(
-                's3_files_total', storage_stats[_type]['TotalFiles'],
-                region=stat['Region'], bucket=stat['Name'], storage=abr)
-            _set_s3_object_gauge(
-                's3_last_modified', storage_stats[_type]['LastModified'].timestamp(),
-                region=stat['Region'], bucket=stat['Name'], storage=abr)
-
-def s3_bucket_stats(prefix=None, conc=None):
-    if conc is not None:
-        _POOL_SIZE[0] = conc
-    buckets = list_buckets(prefix=prefix)
-    return list(_conc_map(traverse_bucket, buckets))
+            labels = (region, STORAGE_TYPES_ABR[index], stat['Name'])
+            sizes.add(labels, storage_stats[_type]['TotalSize'])
+            files.add(labels, storage_stats[_type]['TotalFiles'])
+            last_modified.add(labels, storage_stats[_type]['LastModified'].timestamp())
+    tables = [sizes, files, last_modified]
+    if any('Sampled' in stat for stat in bucket_stats):
+        sampled = GaugeTable('s3_sampled', '1 when the stats of the bucket are estimated',
+                             _OBJECT_GAUGE_NUMBER_LABELS)
+        size_errors = GaugeTable('s3_size_bytes_error',
+                                 'Half width of the 95% confidence interval of s3_size_bytes',
+                                 _OBJECT_GAUGE_SIZE_LABELS)
+        files_errors = GaugeTable('s3_files_total_error',
+                                  'Half width of the 95% confidence interval of s3_files_total',
+                                  _OBJECT_GAUGE_SIZE_LABELS)
+        for stat in bucket_stats:
+            region = str(stat['Region'])
+            sampled.add((region, stat['Name']), 1 if stat.get('Sampled') else 0)
+            for index, _type in enumerate(STORAGE_TYPES):
+                labels = (region, STORAGE_TYPES_ABR[index], stat['Name'])
+                size_errors.add(labels, stat['StorageStats'][_type].get('TotalSizeError', 0))
+                files_errors.add(labels, stat['StorageStats'][_type].get('TotalFilesError', 0))
+        tables.extend([sampled, size_errors, files_errors])
+    size_histograms = HistogramTable('s3_object_size_bytes', 'Distribution of the object sizes',
+                                     _OBJECT_GAUGE_SIZE_LABELS, _SIZE_HISTOGRAM_BOUNDS)
+    age_histograms = HistogramTable('s3_object_age_days',
+                                    'Distribution of the days since the last modification',
+                                    _OBJECT_GAUGE_SIZE_LABELS, _AGE_HISTOGRAM_BOUNDS)
+    # the sum of the ages is taken against a single time for all the buckets
+    now = int(datetime.now(timezone.utc).timestamp())
+    for stat in bucket_stats:
+        region = str(stat['Region'])
+        for index, _type in enumerate(STORAGE_TYPES):
+            storage_stats = stat['StorageStats'][_type]
+            if 'SizeHistogram' not in storage_stats:
+                # The inventory reports do not compute the histograms
+                continue
+            labels = (region, STORAGE_TYPES_ABR[index], stat['Name'])
+            size_histograms.add(labels, storage_stats['SizeHistogram'],
+                                storage_stats['TotalSize'])
+            age_seconds_sum = now * sum(storage_stats['AgeHistogram']) \
+                - storage_stats['LastModifiedSecondsSum']
+            age_histograms.add(labels, storage_stats['AgeHistogram'], age_seconds_sum / 86400)
+    tables.extend([size_histograms, age_histograms])
+    if prefix_gauges:
+        prefix_sizes = GaugeTable('s3_prefix_size_bytes', 'Size of the objects under a prefix',
+                                  _PREFIX_GAUGE_LABELS)
+        prefix_files = GaugeTable('s3_prefix_files_total', 'Number of objects under a prefix',
+                                  _PREFIX_GAUGE_LABELS)
+        prefix_last_modified = GaugeTable('s3_prefix_last_modified',
+                                          'Last modification of an object under a prefix',
+                                          _PREFIX_GAUGE_LABELS)
+        for stat in bucket_stats:
+            for top in stat.get('TopPrefixes', []):
+                labels = (str(stat['Region']), stat['Name'], top['Prefix'])
+                prefix_sizes.add(labels, top['TotalSize'])
+                prefix_files.add(labels, top['TotalFiles'])
+                prefix_last_modified.add(labels, top['LastModified'].timestamp())
+        tables.extend([prefix_sizes, prefix_files, prefix_last_modified])
+    _get_collector().replace('s3', tables)
+
+def s3_bucket_stats(prefix=None, conc=None, ranges=None,
+                    checkpoint_dir=None, checkpoint_pages=100, resume=False, executor=None,
+                    prefix_depth=0, top_prefixes=10, fast_list=False, sample=None, adaptive=None):
+    """Traverse the buckets.
+    When ranges is more than 1, each bucket is split in key ranges that are
+    handed over one at a time to the idle workers; the partial stats are merged per bucket.
+    When checkpoint_dir is set, the progress is saved there and can be resumed.
+    When prefix_depth is set, the top_prefixes heaviest prefixes of each level are reported.
+    When fast_list is set, the pages of objects are parsed without botocore.
+    When sample is set, the stats are estimated with at most sample LIST calls per bucket.
+    When adaptive is set, the AWS calls in flight are limited according to the throttling"""
+    set_pool(conc, executor, adaptive)
+    checkpoint = None
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpoint = {'dir': checkpoint_dir, 'pages': checkpoint_pages, 'resume': resume}
+    with timed_phase('s3', 'list_buckets'):
+        buckets = list_buckets(prefix=prefix)
+    if sample is not None:
+        with timed_phase('s3', 'sample'):
+            return list(conc_map(sample_bucket, [{
+                'bucket': bucket,
+                'budget': sample,
+                '_fast_list': fast_list
+            } for bucket in buckets], chunksize=1))
+    with timed_phase('s3', 'split_buckets'):
+        key_ranges = plan_key_ranges(buckets, ranges=ranges, checkpoint=checkpoint,
+                                     prefix_depth=prefix_depth, fast_list=fast_list)
+    with timed_phase('s3', 'traverse'):
+        partial_stats = list(conc_map(traverse_key_range, key_ranges, chunksize=1))
+    with timed_phase('s3', 'merge'):
+        if checkpoint is not None:
+            _clear_checkpoints(checkpoint, key_ranges)
+        return merge_key_range_stats(buckets, key_ranges, partial_stats, top_prefixes)
+
+def plan_key_ranges(buckets, ranges=None, checkpoint=None, prefix_depth=0, fast_list=False):
+    """The key ranges to traverse: one per bucket or up to ranges per bucket"""
+    if ranges is None or ranges <= 1:
+        key_ranges = [{'Bucket': bucket, '_checkpoint': checkpoint} for bucket in buckets]
+    else:
+        key_ranges = sum(conc_map(split_bucket, [{
+            'bucket': bucket,
+            'ranges': ranges,
+            '_checkpoint': checkpoint
+        } for bucket in buckets]), [])
+    for key_range in key_ranges:
+        key_range['_fast_list'] = fast_list
+        if prefix_depth > 0:
+            key_range['_prefix_tree'] = {'depth': prefix_depth, 'max_nodes': _PREFIX_TREE_MAX_NODES}
+    return key_ranges
+
+def merge_key_range_stats(buckets, key_ranges, partial_stats, top_prefixes=10):
+    """Merge the partial stats of the key ranges into the stats of their buckets"""
+    partials_bybucket = {}
+    for key_range, stats in zip(key_ranges, partial_stats):
+        partials_bybucket.setdefault(key_range['Bucket']['Name'], []).append(stats)
+    return [_merge_storage_stats(bucket, partials_bybucket.get(bucket['Name'], []), top_prefixes)
+            for bucket in buckets]
 
-def s3_analysis(conc=None):
+def s3_analysis(conc=None, ranges=None, checkpoint_dir=None, checkpoint_pages=100, resume=False,
+                executor=None, prefix_depth=0, top_prefixes=10, prefix_gauges=False,
+                fast_list=False, sample=None, adaptive=None):
     """
     Long running job where more information is collected.
 
     Use S3 get_object_list_v2 to get a list of the objects
     """
-    bucket_stats = s3_bucket_stats()
+    bucket_stats = s3_bucket_stats(conc=conc, ranges=ranges, checkpoint_dir=checkpoint_dir,
+                                   checkpoint_pages=checkpoint_pages, resume=resume,
+                                   executor=executor, prefix_depth=prefix_depth,
+                                   top_prefixes=top_prefixes, fast_list=fast_list,
+                                   sample=sample, adaptive=adaptive)
+    with timed_phase('s3', 'update_gauges'):
+        update_s3_gauges(bucket_stats, prefix_gauges=prefix_gauges)
+    commit_s3_gauges()
+    return bucket_stats
+
+def format_sample_report(bucket_stats, unit='GB'):
+    """Table of the estimated totals of each bucket with their 95% confidence interval"""
+    rows = []
+    for stat in bucket_stats:
+        rows.append([
+            stat['Name'],
+            'estimated' if stat['Sampled'] else 'exact',
+            convert_bytes(stat['TotalSize'], unit),
+            convert_bytes(stat.get('TotalSizeError', 0), unit),
+            stat['TotalFiles'],
+            stat.get('TotalFilesError', 0),
+            stat['SampleCalls']
+        ])
+    return tabulate.tabulate(rows, headers=['Bucket', 'Stats', f'Size ({unit})', '+/-',
+                                            'Files', '+/-', 'LIST calls'])
+
+def format_prefix_report(bucket_stats, unit='GB'):
+    """Table of the heaviest prefixes of each bucket"""
+    rows = []
+    for stat in bucket_stats:
+        for top in stat.get('TopPrefixes', []):
+            rows.append([
+                stat['Name'],
+                top['Prefix'],
+                convert_bytes(top['TotalSize'], unit),
+                top['TotalFiles'],
+                top['LastModified'].isoformat()
+            ])
+    return tabulate.tabulate(rows, headers=['Bucket', 'Prefix', f'Size ({unit})',
+                                            'Files', 'Last Modified'])
+
+# ------------ S3 Inventory reports
+# https://docs.aws.amazon.com/AmazonS3/latest/dev/storage-inventory.html
+# CSV column names and their Parquet/ORC equivalents
+_INVENTORY_COLUMNS = {
+    'Bucket': 'bucket',
+    'Size': 'size',
+    'LastModifiedDate': 'last_modified_date',
+    'StorageClass': 'storage_class',
+    'IsLatest': 'is_latest',
+    'IsDeleteMarker': 'is_delete_marker'
+}
+
+def _inventory_location_path(location):
+    if location.startswith('file://'):
+        return urlparse(location).path
+    return location
+
+def find_inventory_manifests(location):
+    """Return the latest manifest.json of each source bucket
+    found in a directory (or the manifest itself)"""
+    path = _inventory_location_path(location)
+    if os.path.isfile(path):
+        manifest_paths = [path]
+    else:
+        manifest_paths = []
+        for dirpath, _, filenames in os.walk(path):
+            if 'manifest.json' in filenames:
+                manifest_paths.append(os.path.join(dirpath, 'manifest.json'))
+    latest = {}
+    for manifest_path in manifest_paths:
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        manifest['_path'] = manifest_path
+        source_bucket = manifest['sourceBucket']
+        if source_bucket not in latest or \
+                int(manifest['creationTimestamp']) > int(latest[source_bucket]['creationTimestamp']):
+            latest[source_bucket] = manifest
+    return [latest[name] for name in sorted(latest.keys())]
+
+def _find_inventory_file(root, manifest_path, key):
+    """The keys in the manifest are relative to the destination bucket.
+    Look for them in a local copy of that bucket or next to the manifest"""
+    manifest_dir = os.path.dirname(manifest_path)
+    filename = os.path.basename(key)
+    for candidate in [os.path.join(root, key),
+                      os.path.join(os.path.dirname(manifest_dir), 'data', filename),
+                      os.path.join(manifest_dir, filename)]:
+        if os.path.exists(candidate):
+            return candidate
+    raise ValueError(f'Unable to find the inventory file {key}')
+
+def _make_inventory_tasks(location, prefix=None):
+    root = _inventory_location_path(location)
+    if os.path.isfile(root):
+        root = os.path.dirname(root)
+    bucket_name = _extract_bucket_from_prefix(prefix)
+    tasks = []
+    for manifest in find_inventory_manifests(location):
+        if bucket_name is not None and not fnmatchcase(manifest['sourceBucket'], bucket_name):
+            continue
+        for inventory_file in manifest['files']:
+            tasks.append({
+                'Bucket': manifest['sourceBucket'],
+                'Path': _find_inventory_file(root, manifest['_path'], inventory_file['key']),
+                'Format': manifest['fileFormat'],
+                'Schema': manifest.get('fileSchema')
+            })
+    return tasks
+
+def _parse_inventory_date(value):
+    """'2017-11-28T10:12:09.000Z'"""
+    fmt = '%Y-%m-%dT%H:%M:%S.%fZ' if '.' in value else '%Y-%m-%dT%H:%M:%SZ'
+    return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc)
+
+def parse_inventory_file(task):
+    """Stream the rows of an inventory data file; return the stats
+    per bucket and per storage class of the latest version of the objects"""
+    if task['Format'] == 'CSV':
+        return _parse_inventory_csv(task['Path'], task['Schema'])
+    if task['Format'] in ('Parquet', 'ORC'):
+        return _parse_inventory_arrow(task['Path'], task['Format'])
+    raise ValueError(f'Unsupported inventory format {task["Format"]}')
+
+def _parse_inventory_csv(path, schema):
+    columns = [column.strip() for column in schema.split(',')]
+    bucket_col = columns.index('Bucket')
+    size_col = columns.index('Size')
+    date_col = columns.index('LastModifiedDate')
+    storage_col = columns.index('StorageClass')
+    latest_col = columns.index('IsLatest') if 'IsLatest' in columns else None
+    marker_col = columns.index('IsDeleteMarker') if 'IsDeleteMarker' in columns else None
+    bybucket = {}
+    with gzip.open(path, 'rt', newline='') as file:
+        for row in csv.reader(file):
+            if latest_col is not None and row[latest_col] == 'false':
+                continue
+            if marker_col is not None and row[marker_col] == 'true':
+                continue
+            size = int(row[size_col] or 0)
+            if size == 0:
+                continue
+            bucket_stats = bybucket.get(row[bucket_col])
+            if bucket_stats is None:
+                bucket_stats = bybucket[row[bucket_col]] = {}
+            stats = bucket_stats.get(row[storage_col])
+            if stats is None:
+                stats = bucket_stats[row[storage_col]] = {
+                    'TotalSize': 0, 'TotalFiles': 0, 'LastModified': ''}
+            stats['TotalSize'] += size
+            stats['TotalFiles'] += 1
+            # ISO 8601 UTC dates compare as strings: parse only the max
+            if row[date_col] > stats['LastModified']:
+                stats['LastModified'] = row[date_col]
+    for bucket_stats in bybucket.values():
+        for stats in bucket_stats.values():
+            stats['LastModified'] = _parse_inventory_date(stats['LastModified']) \
+                if stats['LastModified'] else datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return bybucket
+
+def _parse_inventory_arrow(path, file_format):
+    """Parquet and ORC reports are aggregated record batch by record batch with pyarrow"""
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        raise ValueError(f'pyarrow is required to read {file_format} inventory reports')
+    names = list(_INVENTORY_COLUMNS.values())
+    if file_format == 'Parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        names = [name for name in names if name in parquet_file.schema_arrow.names]
+        batches = parquet_file.iter_batches(columns=names)
+    else:
+        import pyarrow.orc as orc
+        orc_file = orc.ORCFile(path)
+        names = [name for name in names if name in orc_file.schema.names]
+        batches = (orc_file.read_stripe(index, columns=names)
+                   for index in range(0, orc_file.nstripes))
+    bybucket = {}
+    for batch in batches:
+        table = pa.Table.from_batches([batch])
+        mask = pc.greater(pc.fill_null(table['size'], 0), 0)
+        if 'is_latest' in names:
+            mask = pc.and_(mask, pc.fill_null(table['is_latest'], True))
+        if 'is_delete_marker' in names:
+            mask = pc.and_(mask, pc.invert(pc.fill_null(table['is_delete_marker'], False)))
+        grouped = table.filter(mask).group_by(['bucket', 'storage_class']).aggregate([
+            ('size', 'sum'), ('size', 'count'), ('last_modified_date', 'max')])
+        for row in grouped.to_pylist():
+            bucket_stats = bybucket.setdefault(row['bucket'], {})
+            stats = bucket_stats.setdefault(row['storage_class'], {
+                'TotalSize': 0,
+                'TotalFiles': 0,
+                'LastModified': datetime(1970, 1, 1, tzinfo=timezone.utc)
+            })
+            stats['TotalSize'] += row['size_sum']
+            stats['TotalFiles'] += row['size_count']
+            last_modified = row['last_modified_date_max']
+            # The max of an empty or null column
+            if last_modified is None:
+                continue
+            if last_modified.tzinfo is None:
+                last_modified = last_modified.replace(tzinfo=timezone.utc)
+            if last_modified > stats['LastModified']:
+                stats['LastModified'] = last_modified
+    return bybucket
+
+def inventory_bucket_stats(location, prefix=None, conc=None, executor=None):
+    """Aggregate the S3 Inventory reports found at location.
+    The data files are parsed in parallel; the stats have the same shape as s3_bucket_stats"""
+    set_pool(conc, executor)
+    tasks = _make_inventory_tasks(location, prefix=prefix)
+    # The buckets come from the manifests: no AWS credentials are needed
+    partials_bybucket = {task['Bucket']: [] for task in tasks}
+    for bybucket in conc_map(parse_inventory_file, tasks, chunksize=1):
+        for name, storage_stats in bybucket.items():
+            partials_bybucket.setdefault(name, []).append(storage_stats)
+    bucket_stats = []
+    for name in sorted(partials_bybucket.keys()):
+        # The inventory does not know about the regions and creation dates
+        bucket = {'Name': name, 'Region': 'unknown'}
+        bucket_stats.append(_merge_storage_stats(
+            bucket, [{'StorageStats': stats} for stats in partials_bybucket[name]]))
+    return bucket_stats
+
+def inventory_analysis(location, prefix=None, conc=None, executor=None):
+    """Same as s3_analysis but reads the S3 Inventory reports instead of listing the objects"""
+    bucket_stats = inventory_bucket_stats(location, prefix=prefix, conc=conc, executor=executor)
     update_s3_gauges(bucket_stats)
     commit_s3_gauges()
 
 def main():
     """CLI entry point"""
     args = parse_args()
+    if args.inventory:
+        return inventory_analysis(args.inventory, prefix=args.prefix, conc=args.conc,
+                                  executor=args.executor)
     if args.raws3:
-        return s3_analysis(conc=args.conc)
+        bucket_stats = s3_analysis(conc=args.conc, ranges=args.ranges,
+                                   checkpoint_dir=args.checkpoint,
+                                   checkpoint_pages=args.checkpoint_pages, resume=args.resume,
+                                   executor=args.executor, prefix_depth=args.prefix_depth,
+                                   top_prefixes=args.top_prefixes,
+                                   prefix_gauges=args.prefix_gauges,
+                                   fast_list=args.fast_list, sample=args.sample,
+                                   adaptive=args.adaptive)
+        if args.prefix_depth > 0:
+            print(format_prefix_report(bucket_stats, unit=args.unit))
+        if args.sample is not None:
+            print(format_sample_report(bucket_stats, unit=args.unit))
+        return None
+    if args.growth is not None:
+        if args.snapshots is None:
+            raise ValueError('--growth reads the --snapshots database')
+        store = SnapshotStore(args.snapshots)
+        try:
+            growth = store.growth(args.growth)
+        finally:
+            store.close()
+        print(format_growth_report(growth, unit=args.unit,
+                                   fmt=args.fmt if args.fmt in tabulate.tabulate_formats else 'plain'))
+        return None
+    if args.fmt in STREAM_FORMATS and args.pipeline and args.snapshots is None:
+        # each bucket is written as soon as it is complete
+        set_pool(args.conc, args.executor, args.adaptive)
+        write_report_rows(iter_pipeline_folded(fold_metrics_data([]), prefix=args.prefix,
+                                               batch=args.batch, direct=args.direct),
+                          sys.stdout, unit=args.unit, fmt=args.fmt)
+        return None
+    if args.fmt in STREAM_FORMATS:
+        folded = analyse_folded(prefix=args.prefix, conc=args.conc, batch=args.batch,
+                                executor=args.executor, adaptive=args.adaptive,
+                                snapshots=args.snapshots, backfill=args.backfill,
+                                direct=args.direct, pipeline=args.pipeline)
+        write_report(folded, sys.stdout, unit=args.unit, fmt=args.fmt)
+        return None
     analysis = analyse(
         prefix=args.prefix,
         unit=args.unit,
         conc=args.conc,
-        fmt=args.fmt
+        fmt=args.fmt,
+        batch=args.batch,
+        executor=args.executor,
+        adaptive=args.adaptive,
+        snapshots=args.snapshots,
+        backfill=args.backfill,
+        direct=args.direct,
+        pipeline=args.pipeline
     )
     print(analysis)
 
@@ -2,43 +2,58 @@
 Simple HTTP endpoint that invokes the command-line tool
 """
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 from urllib.parse import urlparse
+from itertools import chain
 import threading
+import time
 import os
 
 from s3_storage_analyser import (
-    analyse, parse_args, stop_pool, get_metrics_prom)
+    analyse_folded, iter_pipeline_folded, fold_metrics_data, format_report, report_header_line,
+    iter_bucket_lines, parse_args, set_pool, stop_pool, get_exposition, gzip_exposition,
+    STREAM_FORMATS, TEXT_CONTENT_TYPE, OPENMETRICS_CONTENT_TYPE)
 
 # Run a single analysis at a time
 LOCK_ANALYSIS = threading.Lock()
 
+# The analyses running or waiting for LOCK_ANALYSIS, by prefix.
+# The requests for a prefix already in flight wait for its result.
+IN_FLIGHT = {}
+LOCK_IN_FLIGHT = threading.Lock()
+# Number of analyses of other prefixes that can wait for the running one
+MAX_QUEUED = [int(os.getenv('S3ANALYSER_MAX_QUEUED', '4'))]
+
+# The Cloudwatch storage metrics are updated once a day:
+# keep the folded analysis of each prefix for S3ANALYSER_CACHE_TTL seconds (0: no cache)
+CACHE_TTL = [int(os.getenv('S3ANALYSER_CACHE_TTL', '0'))]
+# Refresh an entry in the background once it is older than this part of the TTL
+CACHE_REFRESH_RATIO = 0.8
+ANALYSIS_CACHE = {}
+
+# Size of the chunks of the streamed reports
+STREAM_CHUNK_SIZE = 64 * 1024
+
 class RequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive and chunked responses: every response has a Content-Length or is chunked
+    protocol_version = 'HTTP/1.1'
 
     def do_HEAD(self):
         self.send_response(200)
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
     def do_GET(self):
         if 'ico' in self.path:
             # Ignore favicon.ico
-            self.send_response(404)
-            self.end_headers()
+            self._send_body(404, b'')
             return
 
-        metrics_prom = None
         if self.path.startswith('/metrics'):
-            metrics_prom = get_metrics_prom(s3=False)
-        elif self.path.startswith('/s3-metrics'):
-            metrics_prom = get_metrics_prom(s3=True)
-
-        if metrics_prom is not None:
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            if os.path.exists(metrics_prom):
-                file = open(metrics_prom, 'rb')
-                self.wfile.write(file.read())
-                file.close()
+            self._send_metrics(s3=False)
+            return
+        if self.path.startswith('/s3-metrics'):
+            self._send_metrics(s3=True)
             return
 
         token = os.environ['TOKEN']
@@ -48,6 +63,7 @@ class RequestHandler(BaseHTTPRequestHandler):
             'unit': None,
             'prefix': None,
             'conc': None,
+            'executor': None,
             'fmt': None,
             'pretty': None
         }
@@ -59,17 +75,25 @@ class RequestHandler(BaseHTTPRequestHandler):
             # redirect to github if the token is missing
             self.send_response(302)
             self.send_header('Location', 'https://github.com/hmalphettes/s3-storage-analyser')
+            self.send_header('Content-Length', '0')
             self.end_headers()
             return
 
         unit = query_components['unit']
         prefix = query_components['prefix']
         conc = query_components['conc']
+        executor = query_components['executor']
         fmt = query_components['fmt']
         echo = 'echo' in query_components
+        batch = 'batch' in query_components
+        adaptive = 'adaptive' in query_components
+        direct = 'direct' in query_components
+        pipeline = 'pipeline' in query_components
         if fmt is None:
             accept = self.headers['Accept'] if 'Accept' in self.headers else ''
-            if 'json' in accept:
+            if 'ndjson' in accept:
+                fmt = 'ndjson'
+            elif 'json' in accept:
                 fmt = 'json'
             elif 'csv' in accept:
                 fmt = 'csv'
@@ -83,15 +107,73 @@ class RequestHandler(BaseHTTPRequestHandler):
                 fmt = 'json'
 
         try:
-            out = _run_analysis(unit=unit, prefix=prefix, conc=conc, fmt=fmt, echo=echo)
+            out = _run_analysis(unit=unit, prefix=prefix, conc=conc, fmt=fmt, echo=echo,
+                                batch=batch, executor=executor, adaptive=adaptive,
+                                direct=direct, pipeline=pipeline)
+            if not isinstance(out, bytes):
+                # a streamed analysis fails before its first chunk: the status is still 500
+                out = iter(out)
+                out = chain([next(out, b'')], out)
+        except Exception as err:
+            self._send_body(500, err.__str__().encode())
+            return
+        if isinstance(out, bytes):
+            self._send_body(200, out)
+        elif self.request_version == 'HTTP/1.0':
+            # no chunked encoding
+            self._send_body(200, b''.join(out))
+        else:
+            self._send_chunked(200, out)
+        return
+
+    def _send_body(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunked(self, status, chunks):
+        """Send the chunks as they are produced"""
+        self.send_response(status)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _send_metrics(self, s3=False):
+        """Serve the latest exposition from memory; gzip and conditional GET"""
+        exposition = get_exposition(s3=s3)
+        if exposition is None:
             self.send_response(200)
+            self.send_header('Content-type', TEXT_CONTENT_TYPE)
+            self.send_header('Content-Length', '0')
             self.end_headers()
-            self.wfile.write(out)
-        except Exception as err:
-            self.send_response(500)
+            return
+        accept = self.headers.get('Accept', '')
+        content_type = TEXT_CONTENT_TYPE
+        if 'application/openmetrics-text' in accept and \
+                OPENMETRICS_CONTENT_TYPE in exposition['Bodies']:
+            content_type = OPENMETRICS_CONTENT_TYPE
+        etag = f'"{exposition["ETag"]}-{"om" if content_type != TEXT_CONTENT_TYPE else "text"}"'
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
             self.end_headers()
-            self.wfile.write(err.__str__().encode())
-        return
+            return
+        body = exposition['Bodies'][content_type]
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body = gzip_exposition(exposition, content_type)
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept, Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
     def log_request(self, code='-', size='-'):
         pass
@@ -99,9 +181,8 @@ class RequestHandler(BaseHTTPRequestHandler):
     def log_error(self, format, *args):
         self.log_message(format, *args)
 
-def _run_analysis(unit=None, prefix=None, conc='6', fmt=None, echo=False):
-    if not LOCK_ANALYSIS.acquire(False):
-        raise ValueError('There is already an analysis running')
+def _run_analysis(unit=None, prefix=None, conc='6', fmt=None, echo=False, batch=False,
+                  executor=None, adaptive=False, direct=False, pipeline=False):
     full_cmd = f'python3 ./s3_storage_analyser.py'
     args = []
     if fmt is not None:
@@ -120,25 +201,194 @@ def _run_analysis(unit=None, prefix=None, conc='6', fmt=None, echo=False):
         full_cmd += f' --conc "{conc}"'
         args.append('--conc')
         args.append(conc)
+    if executor is not None:
+        full_cmd += f' --executor "{executor}"'
+        args.append('--executor')
+        args.append(executor)
+    if batch:
+        full_cmd += ' --batch'
+        args.append('--batch')
+    if adaptive:
+        full_cmd += ' --adaptive'
+        args.append('--adaptive')
+    if direct:
+        full_cmd += ' --direct'
+        args.append('--direct')
+    if pipeline:
+        full_cmd += ' --pipeline'
+        args.append('--pipeline')
     full_cmd += ' '.join(args)
     print(full_cmd)
     if echo:
         return full_cmd.encode()
+    args = parse_args(args)
+    if args.fmt in STREAM_FORMATS:
+        if args.pipeline and _fresh_entry(args.prefix) is None:
+            return _render_chunks(_stream_analysis(args, full_cmd), args.unit, args.fmt)
+        entry = _cached_analysis(args, full_cmd)
+        return _render_chunks([entry['Folded']['bybucket'].values()], args.unit, args.fmt)
+    return _render(_cached_analysis(args, full_cmd), args.unit, args.fmt)
+
+def _join_flight(prefix):
+    """Return the analysis in flight for a prefix and whether the caller runs it"""
+    with LOCK_IN_FLIGHT:
+        flight = IN_FLIGHT.get(prefix)
+        if flight is not None:
+            return flight, False
+        if len(IN_FLIGHT) > MAX_QUEUED[0]:
+            raise ValueError('Too many analyses queued')
+        flight = {'Done': threading.Event(), 'Entry': None, 'Error': None}
+        IN_FLIGHT[prefix] = flight
+        return flight, True
+
+def _wait_flight(flight):
+    flight['Done'].wait()
+    if flight['Error'] is not None:
+        raise flight['Error']
+    return flight['Entry']
+
+def _land_flight(prefix, flight):
+    with LOCK_IN_FLIGHT:
+        del IN_FLIGHT[prefix]
+    flight['Done'].set()
+
+def _analyse(args, full_cmd):
+    """Run the analysis of a prefix; or wait for the one in flight and share its result"""
+    flight, leader = _join_flight(args.prefix)
+    if not leader:
+        return _wait_flight(flight)
     try:
-        print(f'Entered RUNNING_ANALYSIS {full_cmd}')
-        args = parse_args(args)
-        analysis = analyse(
-            prefix=args.prefix,
-            unit=args.unit,
-            conc=args.conc,
-            fmt=args.fmt
-        ).encode()
-        stop_pool()
-        return analysis
+        flight['Entry'] = _run_locked_analysis(args, full_cmd)
+        return flight['Entry']
+    except Exception as err:
+        flight['Error'] = err
+        raise
+    finally:
+        _land_flight(args.prefix, flight)
 
+def _stream_analysis(args, full_cmd):
+    """Run the pipelined analysis of a prefix: generator of the lists of the folded rows
+    of the buckets as soon as they are complete.
+    The analysis is tied to the response: the requests for the same prefix wait for it
+    and get its whole result at once"""
+    flight, leader = _join_flight(args.prefix)
+    if not leader:
+        yield _wait_flight(flight)['Folded']['bybucket'].values()
+        return
+    try:
+        with LOCK_ANALYSIS:
+            print(f'Entered RUNNING_ANALYSIS {full_cmd}')
+            try:
+                set_pool(args.conc, args.executor, args.adaptive)
+                folded = fold_metrics_data([])
+                for rows in iter_pipeline_folded(folded, prefix=args.prefix, batch=args.batch,
+                                                 direct=args.direct):
+                    yield rows
+                stop_pool()
+                flight['Entry'] = _keep_analysis(args.prefix, folded)
+            finally:
+                print('Exited RUNNING_ANALYSIS')
+    except Exception as err:
+        flight['Error'] = err
+        raise
     finally:
-        print('Exited RUNNING_ANALYSIS')
-        LOCK_ANALYSIS.release()
+        if flight['Entry'] is None and flight['Error'] is None:
+            # the client went away before the end of the analysis
+            flight['Error'] = ValueError('The analysis was interrupted')
+        _land_flight(args.prefix, flight)
+
+def _run_locked_analysis(args, full_cmd):
+    """Run the analysis and cache its folded datapoints"""
+    with LOCK_ANALYSIS:
+        print(f'Entered RUNNING_ANALYSIS {full_cmd}')
+        try:
+            folded = analyse_folded(
+                prefix=args.prefix,
+                conc=args.conc,
+                batch=args.batch,
+                executor=args.executor,
+                adaptive=args.adaptive,
+                direct=args.direct,
+                pipeline=args.pipeline
+            )
+            stop_pool()
+            return _keep_analysis(args.prefix, folded)
+
+        finally:
+            print('Exited RUNNING_ANALYSIS')
+
+def _keep_analysis(prefix, folded):
+    """The cache entry of the folded analysis of a prefix"""
+    entry = {'Folded': folded, 'Time': time.time(), 'Renders': {}}
+    if CACHE_TTL[0] > 0:
+        ANALYSIS_CACHE[prefix] = entry
+    return entry
+
+def _refresh_in_background(args, full_cmd, entry):
+    try:
+        _analyse(args, full_cmd)
+    except Exception as err:
+        print(f'Unable to refresh the analysis: {err}')
+        with LOCK_IN_FLIGHT:
+            entry['Refreshing'] = False
+
+def _cached_analysis(args, full_cmd):
+    """Return the cache entry of the prefix; run the analysis when it is missing or expired
+    and refresh it in the background when it is about to expire"""
+    entry = _fresh_entry(args.prefix)
+    if entry is None:
+        return _analyse(args, full_cmd)
+    if time.time() - entry['Time'] >= CACHE_TTL[0] * CACHE_REFRESH_RATIO:
+        # a single refresh per entry: its thread may not be in flight yet
+        with LOCK_IN_FLIGHT:
+            refresh = args.prefix not in IN_FLIGHT and not entry.get('Refreshing')
+            if refresh:
+                entry['Refreshing'] = True
+        if refresh:
+            threading.Thread(target=_refresh_in_background, args=(args, full_cmd, entry),
+                             daemon=True).start()
+    return entry
+
+def _fresh_entry(prefix):
+    """The cache entry of a prefix unless it is missing or expired"""
+    entry = ANALYSIS_CACHE.get(prefix)
+    if entry is None or time.time() - entry['Time'] >= CACHE_TTL[0]:
+        return None
+    return entry
+
+def _render_chunks(row_groups, unit, fmt):
+    """Generator of the report in chunks of about STREAM_CHUNK_SIZE bytes.
+    The lines are formatted as the chunks are sent; the lines of a group of rows
+    are sent without waiting for the next group"""
+    header = report_header_line(unit=unit, fmt=fmt)
+    lines = [] if header is None else [header.encode() + b'\n']
+    size = 0
+    for rows in row_groups:
+        for line in iter_bucket_lines(rows, unit=unit, fmt=fmt):
+            line = line.encode() + b'\n'
+            lines.append(line)
+            size += len(line)
+            if size >= STREAM_CHUNK_SIZE:
+                yield b''.join(lines)
+                lines = []
+                size = 0
+        if lines:
+            yield b''.join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield b''.join(lines)
+
+def _render(entry, unit, fmt):
+    """Format the folded datapoints once per format and unit"""
+    key = (fmt, unit)
+    if key not in entry['Renders']:
+        entry['Renders'][key] = format_report(entry['Folded'], unit=unit, fmt=fmt).encode()
+    return entry['Renders'][key]
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """Handle each request in a thread: concurrent requests share the analysis in flight"""
+    daemon_threads = True
 
 def make_server(do_print=False):
     """Main entrypoint"""
@@ -147,7 +397,7 @@ def make_server(do_print=False):
         port = int(os.environ['S3ANALYSER_PORT'])
     if do_print:
         print(f'Starting s3analyser endpoint at http://localhost:{port}')
-    server = HTTPServer(('localhost', port), RequestHandler)
+    server = ThreadingHTTPServer(('localhost', port), RequestHandler)
     return server
 
 if __name__ == '__main__':
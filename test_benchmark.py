@@ -0,0 +1,39 @@
+"""
+Tests of the benchmark and of its experiments
+"""
+import json
+
+from s3_storage_analyser import fold_metrics_data
+import benchmark
+
+import pytest
+
+@pytest.mark.skipif(benchmark.np is None, reason='numpy is not installed')
+def test_fold_metrics_data_columnar():
+    """Test the columnar folding gives the same result as the dict based one"""
+    datapoints = benchmark.make_datapoints(100)
+    # a bucket without any NumberOfObjects datapoint
+    datapoints = [data for data in datapoints
+                  if data['BucketName'] != 'bucket000007' or data['MetricName'] != 'NumberOfObjects']
+    expected = fold_metrics_data(datapoints)
+    folded = benchmark.fold_metrics_data_columnar(datapoints)
+    assert folded == expected
+    assert list(folded['bybucket'].keys()) == list(expected['bybucket'].keys())
+    assert json.dumps(folded['byregion']) == json.dumps(expected['byregion'])
+    assert benchmark.fold_metrics_data_columnar([]) == fold_metrics_data([])
+
+def test_benchmark(tmpdir, monkeypatch):
+    """Test the benchmark runs every stage and detects the regressions"""
+    monkeypatch.setenv('PROM_TEXT', str(tmpdir.join('s3-metrics.prom')))
+    results = benchmark.run(nb_buckets=10, nb_objects=2000, repeat=1)
+    assert set(results['stages'].keys()) == set(benchmark.STAGES.keys())
+    assert results['stages']['traverse_key_range']['items'] == 2000
+    assert benchmark.compare(results, results) == []
+    baseline = json.loads(json.dumps(results))
+    baseline['stages']['json_dumps']['ns_per_item'] /= 2
+    assert [name for name, _ratio in benchmark.compare(results, baseline)] == ['json_dumps']
+    output = str(tmpdir.join('bench.json'))
+    assert benchmark.main(['--scale', '0.0001', '--repeat', '1', '--stage', 'json_dumps',
+                           '--output', output]) == 0
+    assert benchmark.main(['--scale', '0.0001', '--repeat', '1', '--stage', 'json_dumps',
+                           '--baseline', output, '--max-slowdown', '1000']) == 0
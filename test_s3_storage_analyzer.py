@@ -1,26 +1,46 @@
 """
 Unit Tests
 """
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from io import StringIO
 import sys
 import os
+import csv
+import gzip
+import hashlib
+import json
 from pprint import pprint
 import threading
 import http.client
+from urllib.error import URLError
 from contextlib import redirect_stdout
 
 from s3_storage_analyser import (
     list_buckets, fold_metrics_data, convert_bytes, update_gauges,
-    main, list_metrics, get_metrics_data, _today, get_metrics_prom)
+    main, list_metrics, get_metrics_data, _today, get_metrics_prom, format_report)
 import s3_storage_analyser
 import server
+import benchmark
+import coordinator
 
 from moto import mock_s3, mock_cloudwatch
 import boto3
 import pytz
 import pytest
 
+@pytest.fixture(autouse=True)
+def isolated_region_cache(monkeypatch, tmp_path):
+    """Keep the regions of the buckets of each test in its own directory"""
+    monkeypatch.setenv('S3ANALYSER_REGION_CACHE', str(tmp_path / 'regions.json'))
+    monkeypatch.setattr(s3_storage_analyser, '_REGION_CACHE', {})
+    monkeypatch.setattr(s3_storage_analyser, '_REGION_CACHE_LOADED', [None])
+
+@pytest.fixture(autouse=True)
+def isolated_prom_text(monkeypatch, tmp_path):
+    """Write the metrics files of each test in its own directory"""
+    monkeypatch.setenv('PROM_TEXT', str(tmp_path / 's3-metrics.prom'))
+    monkeypatch.setenv('S3_PROM_TEXT', str(tmp_path / 's3.prom'))
+
 def test_convert_bytes():
     """Test convert bytes to a unit"""
     assert convert_bytes(1048576, 'MB', True) == '1MB'
@@ -104,6 +124,41 @@ def test_buckets_filter():
     bucket_list = list_buckets(prefix='s3://a*')
     assert len(bucket_list) == 2
 
+@mock_cloudwatch
+@mock_s3
+def test_region_cache(monkeypatch, tmpdir):
+    """Test the regions are fetched once per bucket and kept on disk"""
+    _setup(monkeypatch)
+    client = boto3.client('s3')
+    client.create_bucket(Bucket='hm.samples.eu', CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-1'})
+    calls = []
+    fetch_bucket_info = s3_storage_analyser.fetch_bucket_info
+    def _fetch_bucket_info(bucket):
+        calls.append(bucket['Name'])
+        return fetch_bucket_info(bucket)
+    monkeypatch.setattr(s3_storage_analyser, 'fetch_bucket_info', _fetch_bucket_info)
+    buckets = list_buckets()
+    assert [(bucket['Name'], bucket['Region']) for bucket in buckets] == [
+        ('hm.samples', 'us-east-1'), ('hm.samples.eu', 'eu-west-1')]
+    assert sorted(calls) == ['hm.samples', 'hm.samples.eu']
+    assert list_buckets(prefix='hm.samples') == buckets[:1]
+    # a new process reads the regions from the disk
+    s3_storage_analyser._REGION_CACHE.clear()
+    s3_storage_analyser._REGION_CACHE_LOADED[0] = None
+    assert list_buckets() == buckets
+    assert len(calls) == 2
+    # recreated bucket
+    s3_storage_analyser._REGION_CACHE['hm.samples'][0] -= 3600
+    list_buckets()
+    assert calls[2:] == ['hm.samples']
+    # deleted bucket
+    client.delete_bucket(Bucket='hm.samples.eu')
+    list_buckets()
+    assert 'hm.samples.eu' not in json.loads(tmpdir.join('regions.json').read())
+    assert s3_storage_analyser._normalize_location(None) == 'us-east-1'
+    assert s3_storage_analyser._normalize_location('EU') == 'eu-west-1'
+
 @mock_cloudwatch
 @mock_s3
 def test_get_metrics(monkeypatch):
@@ -117,6 +172,54 @@ def test_get_metrics(monkeypatch):
     assert metrics[0]['_region'] == 'us-east-1'
     s3_storage_analyser._POOL_SIZE[0] = None
 
+@mock_cloudwatch
+@mock_s3
+def test_plan_metrics(monkeypatch):
+    """Test the metrics are planned from the buckets and only the reported ones are queried again"""
+    s3_storage_analyser.stop_pool()
+    s3_storage_analyser._POOL_SIZE[0] = 1
+    boto3.client('s3').create_bucket(Bucket='hm.samples')
+    reported = {'NumberOfObjects:AllStorageTypes': 4.0, 'BucketSizeBytes:AllStorageTypes': 24.0,
+                'BucketSizeBytes:StandardStorage': 24.0}
+    calls = []
+    def _mock_get_stats(**req):
+        key = f"{req['MetricName']}:{req['Dimensions'][0]['Value']}"
+        calls.append(key)
+        if key not in reported:
+            return {'Datapoints': []}
+        return {'Datapoints': [{'Average': reported[key]}]}
+    monkeypatch.setattr(s3_storage_analyser, '_get_metric_statistics', _mock_get_stats)
+    def _list_metrics(*_args, **_kwargs):
+        raise AssertionError('ListMetrics is not called')
+    monkeypatch.setattr(s3_storage_analyser, 'list_metrics', _list_metrics)
+    try:
+        # probe: all the storage types
+        folded = s3_storage_analyser.analyse_folded(direct=True)
+        assert sorted(calls) == sorted(s3_storage_analyser.FOLDED_KEYS)
+        assert folded['bybucket']['hm.samples']['Bytes-ST'] == 24.0
+        # the storage types are kept on disk
+        s3_storage_analyser._REGION_CACHE.clear()
+        s3_storage_analyser._REGION_CACHE_LOADED[0] = None
+        calls.clear()
+        assert s3_storage_analyser.analyse_folded(direct=True)['bybucket'] == folded['bybucket']
+        assert sorted(calls) == sorted(reported)
+        # another set of storage types is reported: the bucket is probed again
+        reported['NumberOfObjects:AllStorageTypes'] = 5.0
+        del reported['BucketSizeBytes:StandardStorage']
+        calls.clear()
+        s3_storage_analyser.analyse_folded(direct=True)
+        assert len(calls) == 3
+        calls.clear()
+        s3_storage_analyser.analyse_folded(direct=True)
+        assert len(calls) == len(s3_storage_analyser.FOLDED_KEYS)
+        # too old
+        s3_storage_analyser._REGION_CACHE['hm.samples'][2] -= 8 * 86400
+        calls.clear()
+        s3_storage_analyser.analyse_folded(direct=True)
+        assert len(calls) == len(s3_storage_analyser.FOLDED_KEYS)
+    finally:
+        s3_storage_analyser._POOL_SIZE[0] = None
+
 @mock_cloudwatch
 @mock_s3
 def test_get_metrics_data(monkeypatch):
@@ -403,3 +506,1043 @@ def test_main_raws3(monkeypatch):
     """Test main raws3"""
     _setup(monkeypatch)
     _call_main('s3_storage_analyser.py --raws3')
+
+def _fake_buckets_metrics(nb_buckets, region='us-east-1'):
+    """Generate some buckets and their metrics without calling AWS"""
+    buckets = []
+    metrics = []
+    for i in range(0, nb_buckets):
+        name = f'hm.bucket{i:05d}'
+        buckets.append({
+            'Name': name,
+            'Region': region,
+            'CreationDate': pytz.utc.localize(datetime(2017, 11, 16))
+        })
+        for metric_name, storage_type in [('NumberOfObjects', 'AllStorageTypes'),
+                                          ('BucketSizeBytes', 'AllStorageTypes'),
+                                          ('BucketSizeBytes', 'StandardStorage')]:
+            metrics.append({
+                'Namespace': 'AWS/S3',
+                'MetricName': metric_name,
+                'Dimensions': [
+                    {'Name': 'StorageType', 'Value': storage_type},
+                    {'Name': 'BucketName', 'Value': name}
+                ],
+                '_region': region
+            })
+    return buckets, metrics
+
+class _FakeCloudwatch:
+    """Answers get_metric_data over 2 pages"""
+    def __init__(self):
+        self.calls = []
+
+    def get_metric_data(self, **kwargs):
+        self.calls.append(kwargs)
+        results = [{'Id': query['Id'], 'Values': [4.0]}
+                   for query in kwargs['MetricDataQueries']]
+        if 'NextToken' not in kwargs:
+            return {'MetricDataResults': results[:10], 'NextToken': 'page2'}
+        return {'MetricDataResults': results[10:]}
+
+def test_get_metrics_data_batch(monkeypatch):
+    """Check the GetMetricData batches and the shape of the datapoints"""
+    s3_storage_analyser.stop_pool()
+    s3_storage_analyser._POOL_SIZE[0] = 1
+    cloudwatch = _FakeCloudwatch()
+    monkeypatch.setattr(s3_storage_analyser, '_get_cw_client', lambda region: cloudwatch)
+    try:
+        buckets, metrics = _fake_buckets_metrics(200)
+        data = get_metrics_data(metrics, buckets, batch=True)
+        # 600 queries: 2 batches of 2 pages each
+        assert len(cloudwatch.calls) == 4
+        assert len(cloudwatch.calls[0]['MetricDataQueries']) == 500
+        assert len(data) == 600
+        assert data[0]['BucketName'] == 'hm.bucket00000'
+        assert data[0]['MetricName'] == 'NumberOfObjects'
+        assert data[0]['StorageType'] == 'AllStorageTypes'
+        assert data[0]['Region'] == 'us-east-1'
+        assert data[0]['Value'] == 4.0
+        folded = fold_metrics_data(data)
+        assert folded['bybucket']['hm.bucket00199']['Files'] == 4.0
+    finally:
+        s3_storage_analyser._POOL_SIZE[0] = None
+
+class _FakeRegionalCloudwatch(_FakeCloudwatch):
+    """Lists the metrics of its buckets over 2 pages"""
+    def __init__(self, names):
+        super().__init__()
+        self.metrics = []
+        for name in names:
+            for metric in _fake_buckets_metrics(1)[1]:
+                metric['Dimensions'][1]['Value'] = name
+                del metric['_region']
+                self.metrics.append(metric)
+
+    def list_metrics(self, **kwargs):
+        self.calls.append(kwargs)
+        if 'NextToken' not in kwargs:
+            return {'Metrics': self.metrics[:4], 'NextToken': 'page2'}
+        return {'Metrics': self.metrics[4:]}
+
+@mock_cloudwatch
+@mock_s3
+def test_pipeline(monkeypatch):
+    """Test the pipelined analysis folds the same datapoints as the one stage at a time"""
+    s3_storage_analyser.stop_pool()
+    s3_storage_analyser._POOL_SIZE[0] = 1
+    client = boto3.client('s3')
+    client.create_bucket(Bucket='hm.samples')
+    client.create_bucket(Bucket='hm.samples2')
+    client.create_bucket(Bucket='hm.samples.eu', CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-1'})
+    cloudwatch = {
+        'us-east-1': _FakeRegionalCloudwatch(['hm.samples', 'hm.samples2']),
+        'eu-west-1': _FakeRegionalCloudwatch(['hm.samples.eu'])
+    }
+    monkeypatch.setattr(s3_storage_analyser, '_get_cw_client', lambda region: cloudwatch[region])
+    def _mock_get_stats(**req):
+        return {'Datapoints': [{'Average': 2.0 if req['_region'] == 'us-east-1' else 3.0}]}
+    monkeypatch.setattr(s3_storage_analyser, '_get_metric_statistics', _mock_get_stats)
+    try:
+        staged = s3_storage_analyser.analyse_folded()
+        # the metrics of a deleted bucket are still listed
+        cloudwatch['us-east-1'].metrics.extend(_fake_buckets_metrics(1)[1])
+        cloudwatch['us-east-1'].calls.clear()
+        folded = s3_storage_analyser.analyse_folded(pipeline=True)
+        assert list(folded['bybucket']) == ['hm.samples', 'hm.samples.eu', 'hm.samples2']
+        assert folded['bybucket'] == staged['bybucket']
+        assert folded['byregion'] == staged['byregion']
+        assert folded['bystorage'] == staged['bystorage']
+        # one listing of the metrics per region
+        assert len(cloudwatch['us-east-1'].calls) == 2
+        folded = s3_storage_analyser.analyse_folded(pipeline=True, batch=True)
+        assert folded['bybucket']['hm.samples.eu']['Bytes-ST'] == 4.0
+        assert folded['byregion']['us-east-1']['Buckets'] == 2
+        folded = s3_storage_analyser.analyse_folded(pipeline=True, prefix='s3://hm.samples.*')
+        assert list(folded['bybucket']) == ['hm.samples.eu']
+        with pytest.raises(ValueError):
+            s3_storage_analyser.analyse_folded(pipeline=True, prefix='s3://nothing*')
+        # a botocore that does not know the pagination of ListBuckets
+        s3_client = s3_storage_analyser._get_client('s3')
+        list_buckets = s3_client.list_buckets
+        def _list_buckets(**kwargs):
+            if kwargs:
+                raise s3_storage_analyser.ParamValidationError(report='MaxBuckets')
+            return list_buckets()
+        monkeypatch.setattr(s3_client, 'list_buckets', _list_buckets)
+        folded = s3_storage_analyser.analyse_folded(pipeline=True)
+        assert list(folded['bybucket']) == ['hm.samples', 'hm.samples.eu', 'hm.samples2']
+        # the buckets of us-east-1 are reported while the metrics of eu-west-1 are listed
+        reported = threading.Event()
+        eu_list_metrics = cloudwatch['eu-west-1'].list_metrics
+        def _list_metrics(**kwargs):
+            assert reported.wait(5)
+            return eu_list_metrics(**kwargs)
+        monkeypatch.setattr(cloudwatch['eu-west-1'], 'list_metrics', _list_metrics)
+        folded = fold_metrics_data([])
+        groups = []
+        for rows in s3_storage_analyser.iter_pipeline_folded(folded):
+            groups.append(sorted(row['Bucket'] for row in rows))
+            reported.set()
+        assert 'hm.samples.eu' not in groups[0]
+        assert sum(groups, [])[-1] == 'hm.samples.eu'
+        assert sorted(sum(groups, [])) == ['hm.samples', 'hm.samples.eu', 'hm.samples2']
+        assert list(folded['bybucket']) == ['hm.samples', 'hm.samples.eu', 'hm.samples2']
+        # a failed call stops the analysis
+        def _failed_get_stats(**_req):
+            raise ValueError('Throttled')
+        monkeypatch.setattr(s3_storage_analyser, '_get_metric_statistics', _failed_get_stats)
+        with pytest.raises(ValueError):
+            s3_storage_analyser.analyse_folded(pipeline=True)
+    finally:
+        s3_storage_analyser._POOL_SIZE[0] = None
+
+@mock_cloudwatch
+@mock_s3
+def test_raw_s3_key_ranges(monkeypatch):
+    """Test splitting the buckets in key ranges gives the same stats"""
+    _setup(monkeypatch)
+    client = boto3.client('s3')
+    for folder in ['a', 'b', 'c/d', 'c/e']:
+        for i in range(0, 3):
+            client.put_object(Bucket='hm.samples', Body=b'abc', Key=f'{folder}/{i}.txt')
+    key_ranges = s3_storage_analyser.split_bucket({
+        'bucket': {'Name': 'hm.samples'},
+        'ranges': 4
+    })
+    assert len(key_ranges) == 4
+    assert key_ranges[0]['StartAfter'] is None
+    assert key_ranges[-1]['EndKey'] is None
+    whole = s3_storage_analyser.s3_bucket_stats(conc=1)
+    split = s3_storage_analyser.s3_bucket_stats(conc=1, ranges=4)
+    assert split[0]['TotalFiles'] == whole[0]['TotalFiles'] == 16
+    assert split[0]['TotalSize'] == whole[0]['TotalSize'] == 60
+    assert split[0]['LastModified'] == whole[0]['LastModified']
+    assert split[0]['StorageStats'] == whole[0]['StorageStats']
+    s3_storage_analyser._POOL_SIZE[0] = None
+
+@mock_cloudwatch
+@mock_s3
+def test_raw_s3_prefixes(monkeypatch):
+    """Test the heaviest prefixes are the same whether the bucket is split or not"""
+    _setup(monkeypatch)
+    client = boto3.client('s3')
+    for folder in ['a', 'b', 'c/d', 'c/e']:
+        for i in range(0, 3):
+            client.put_object(Bucket='hm.samples', Body=b'abc', Key=f'{folder}/{i}.txt')
+    whole = s3_storage_analyser.s3_bucket_stats(conc=1, prefix_depth=2)
+    split = s3_storage_analyser.s3_bucket_stats(conc=1, ranges=4, prefix_depth=2)
+    assert split[0]['TopPrefixes'] == whole[0]['TopPrefixes']
+    tops = {top['Prefix']: top for top in whole[0]['TopPrefixes']}
+    assert sorted(tops.keys()) == ['a/', 'b/', 'c/', 'c/d/', 'c/e/', 'sub/']
+    assert tops['c/']['TotalFiles'] == 6
+    assert tops['c/']['TotalSize'] == 18
+    assert whole[0]['TopPrefixesError'] == 0
+    s3_storage_analyser.update_s3_gauges(whole, prefix_gauges=True)
+    sizes = [metric for metric in s3_storage_analyser._get_collector().collect()
+             if metric.name == 's3_prefix_size_bytes'][0]
+    assert len(sizes.samples) == 6
+    s3_storage_analyser._POOL_SIZE[0] = None
+
+@mock_cloudwatch
+@mock_s3
+def test_raw_s3_histograms(monkeypatch):
+    """Test the size and age histograms are merged across the key ranges and exported"""
+    _setup(monkeypatch)
+    client = boto3.client('s3')
+    for folder in ['a', 'b', 'c/d', 'c/e']:
+        client.put_object(Bucket='hm.samples', Body=b'abc', Key=f'{folder}/small.txt')
+        client.put_object(Bucket='hm.samples', Body=b'a' * 1000, Key=f'{folder}/large.txt')
+    whole = s3_storage_analyser.s3_bucket_stats(conc=1)
+    split = s3_storage_analyser.s3_bucket_stats(conc=1, ranges=4)
+    stats = whole[0]['StorageStats']['STANDARD']
+    assert split[0]['StorageStats']['STANDARD']['SizeHistogram'] == stats['SizeHistogram']
+    assert sum(stats['SizeHistogram']) == stats['TotalFiles']
+    # 3 bytes <= 4 and 1000 bytes <= 1024
+    assert stats['SizeHistogram'][2] >= 4
+    assert stats['SizeHistogram'][10] == 4
+    # all the objects were just created
+    assert stats['AgeHistogram'][0] == stats['TotalFiles']
+    assert isinstance(stats['LastModifiedSecondsSum'], int)
+    assert split[0]['StorageStats']['STANDARD']['LastModifiedSecondsSum'] == \
+        stats['LastModifiedSecondsSum']
+    s3_storage_analyser.update_s3_gauges(whole)
+    histograms = [metric for metric in s3_storage_analyser._get_collector().collect()
+                  if metric.name == 's3_object_size_bytes'][0]
+    counts = [sample for sample in histograms.samples if sample.name.endswith('_count')
+              and sample.labels['storage'] == 'ST']
+    assert counts[0].value == stats['TotalFiles']
+    ages = [metric for metric in s3_storage_analyser._get_collector().collect()
+            if metric.name == 's3_object_age_days'][0]
+    age_sums = [sample for sample in ages.samples if sample.name.endswith('_sum')
+                and sample.labels['storage'] == 'ST']
+    # all the objects were just created
+    assert 0 <= age_sums[0].value < stats['TotalFiles'] / 24
+    s3_storage_analyser._POOL_SIZE[0] = None
+
+@mock_cloudwatch
+@mock_s3
+def test_raw_s3_fast_list(monkeypatch):
+    """Test the fast parser of the pages of objects gives the same stats as botocore"""
+    _setup(monkeypatch)
+    client = boto3.client('s3')
+    for key in ['a/x y.txt', 'a&b<c>.txt', 'é+.txt', 'c/d/"q".txt']:
+        client.put_object(Bucket='hm.samples', Body=b'abc', Key=key)
+    pages = list(s3_storage_analyser._list_objects(Bucket='hm.samples', MaxKeys=2))
+    fast_pages = list(s3_storage_analyser._list_objects(Bucket='hm.samples', MaxKeys=2,
+                                                        _fast_list=True))
+    assert fast_pages == pages
+    whole = s3_storage_analyser.s3_bucket_stats(conc=1, prefix_depth=1)
+    fast = s3_storage_analyser.s3_bucket_stats(conc=1, ranges=4, prefix_depth=1, fast_list=True)
+    assert fast[0]['StorageStats'] == whole[0]['StorageStats']
+    assert fast[0]['TopPrefixes'] == whole[0]['TopPrefixes']
+    s3_storage_analyser._POOL_SIZE[0] = None
+
+def test_parse_objects_page():
+    """Test the fast parser on a page formatted like S3 without url encoding"""
+    body = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            b'<Name>bucket</Name><Prefix></Prefix><KeyCount>2</KeyCount><MaxKeys>2</MaxKeys>'
+            b'<IsTruncated>true</IsTruncated>'
+            b'<NextContinuationToken>1a&amp;b=</NextContinuationToken>'
+            b'<Contents><Key>a&amp;b&quot;.txt</Key>'
+            b'<LastModified>2017-11-28T10:12:09.239Z</LastModified>'
+            b'<ETag>&quot;900150983cd24fb0d6963f7d28e17f72&quot;</ETag>'
+            b'<ChecksumAlgorithm>CRC32</ChecksumAlgorithm><Size>3</Size>'
+            b'<Owner><ID>abc</ID><DisplayName>me</DisplayName></Owner>'
+            b'<StorageClass>STANDARD</StorageClass></Contents>'
+            b'<Contents><Key>b</Key><LastModified>2018-01-01T00:00:00.000Z</LastModified>'
+            b'<ETag>&quot;x&quot;</ETag><Size>0</Size><StorageClass>GLACIER</StorageClass>'
+            b'</Contents></ListBucketResult>')
+    response_dict = {'status_code': 200, 'body': body}
+    customized = {}
+    s3_storage_analyser._parse_objects_page(response_dict, customized)
+    expected = datetime(2017, 11, 28, 10, 12, 9, 239000, tzinfo=timezone.utc).timestamp()
+    assert customized['FastContents'] == [
+        ('a&b".txt', 3, expected, 'STANDARD'),
+        ('b', 0, datetime(2018, 1, 1, tzinfo=timezone.utc).timestamp(), 'GLACIER')
+    ]
+    assert customized['IsTruncated'] is True
+    assert customized['NextContinuationToken'] == '1a&b='
+    assert b'Contents' not in response_dict['body']
+
+def test_parse_objects_page_fallback():
+    """Test the fast parser with elements in another order and the pages left to botocore"""
+    head = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">')
+    reordered = (b'<Contents><StorageClass>STANDARD_IA</StorageClass><Size>7</Size>'
+                 b'<ETag>&quot;x&quot;</ETag><LastModified>2018-01-01T00:00:00.000Z</LastModified>'
+                 b'<Key>c</Key></Contents>')
+    response_dict = {'status_code': 200,
+                     'body': head + b'<IsTruncated>false</IsTruncated>' + reordered +
+                             b'</ListBucketResult>'}
+    customized = {}
+    s3_storage_analyser._parse_objects_page(response_dict, customized)
+    assert customized == {
+        'FastContents': [('c', 7, datetime(2018, 1, 1, tzinfo=timezone.utc).timestamp(),
+                          'STANDARD_IA')],
+        'IsTruncated': False}
+    for body in (
+            # no IsTruncated
+            head + reordered + b'</ListBucketResult>',
+            # no Size
+            head + b'<IsTruncated>false</IsTruncated>' + reordered.replace(b'<Size>7</Size>', b'') +
+            b'</ListBucketResult>',
+            # a Contents block that is not closed
+            head + b'<IsTruncated>false</IsTruncated>' + reordered + b'<Contents><Key>d</Key>'
+            b'</ListBucketResult>'):
+        response_dict = {'status_code': 200, 'body': body}
+        customized = {}
+        s3_storage_analyser._parse_objects_page(response_dict, customized)
+        assert customized == {}
+        assert response_dict['body'] == body
+
+@mock_cloudwatch
+@mock_s3
+def test_raw_s3_sample(monkeypatch):
+    """Test the sampled estimates are close to the exact stats"""
+    _setup(monkeypatch)
+    client = boto3.client('s3')
+    for i in range(0, 600):
+        key = hashlib.md5(str(i).encode()).hexdigest()
+        client.put_object(Bucket='hm.samples', Body=b'0123456789', Key=key)
+    exact = s3_storage_analyser.s3_bucket_stats(conc=1)[0]
+    assert exact['TotalFiles'] == 604
+    bucket = {'Name': 'hm.samples', 'Region': 'us-east-1'}
+    estimate = s3_storage_analyser.sample_bucket({
+        'bucket': dict(bucket), 'budget': 60, 'page_size': 20, '_seed': 1})
+    assert estimate['Sampled'] is True
+    assert estimate['SampleCalls'] == 60
+    assert abs(estimate['TotalFiles'] - 604) <= max(2 * estimate['TotalFilesError'], 120)
+    assert abs(estimate['TotalSize'] - exact['TotalSize']) <= max(
+        2 * estimate['TotalSizeError'], 1200)
+    # the whole trie fits in the budget
+    listed = s3_storage_analyser.sample_bucket({
+        'bucket': dict(bucket), 'budget': 1000, 'page_size': 20, '_seed': 1})
+    assert listed['Sampled'] is False
+    for key in ['TotalSize', 'TotalFiles', 'LastModified']:
+        assert listed[key] == exact[key]
+    small = s3_storage_analyser.sample_bucket({'bucket': dict(bucket), 'budget': 60})
+    assert small['Sampled'] is False
+    assert small['SampleCalls'] == 1
+    assert small['TotalFiles'] == 604
+    report = s3_storage_analyser.format_sample_report([estimate, small])
+    assert 'estimated' in report and 'exact' in report
+    s3_storage_analyser._POOL_SIZE[0] = None
+
+def test_prefix_tree_pruning():
+    """Test the memory of the prefix tree is bounded and keeps the heaviest prefixes"""
+    now = datetime.now(timezone.utc).timestamp()
+    tree = s3_storage_analyser.PrefixTree(1, max_nodes=10)
+    tree.add('heavy/object', 1000, now)
+    for i in range(0, 100):
+        tree.add(f'light{i}/object', 1, now)
+    assert len(tree.nodes) <= 20
+    assert tree.nodes['heavy/'] == [1000, 1, now]
+    assert tree.error >= 1
+    restored = s3_storage_analyser.PrefixTree.from_json(json.loads(json.dumps(tree.to_json())))
+    assert restored.nodes == tree.nodes
+    assert restored.error == tree.error
+
+@mock_cloudwatch
+@mock_s3
+def test_raw_s3_checkpoint_resume(monkeypatch, tmpdir):
+    """Test resuming an interrupted traversal from its checkpoint"""
+    _setup(monkeypatch)
+    client = boto3.client('s3')
+    for i in range(0, 20):
+        client.put_object(Bucket='hm.samples', Body=b'abc', Key=f'many/{i:02d}.txt')
+    checkpoint = {'dir': str(tmpdir), 'pages': 2, 'resume': False}
+    key_range = {'Bucket': {'Name': 'hm.samples'}, '_checkpoint': checkpoint}
+    expected = s3_storage_analyser.traverse_key_range(dict(key_range, _checkpoint=None), max_keys=3)
+
+    save_checkpoint = s3_storage_analyser._save_checkpoint
+    def _crash_after_first_save(*args, **kwargs):
+        save_checkpoint(*args, **kwargs)
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(s3_storage_analyser, '_save_checkpoint', _crash_after_first_save)
+    with pytest.raises(KeyboardInterrupt):
+        s3_storage_analyser.traverse_key_range(key_range, max_keys=3)
+    state_path = s3_storage_analyser._checkpoint_path(checkpoint, key_range)
+    state = s3_storage_analyser._load_checkpoint(state_path)
+    assert not state['Done']
+    assert state['StorageStats']['STANDARD']['TotalFiles'] == 6
+
+    monkeypatch.setattr(s3_storage_analyser, '_save_checkpoint', save_checkpoint)
+    checkpoint['resume'] = True
+    resumed = s3_storage_analyser.traverse_key_range(key_range, max_keys=3)
+    assert resumed == expected
+    assert s3_storage_analyser._load_checkpoint(state_path)['Done']
+
+_INVENTORY_SCHEMA = 'Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size, LastModifiedDate, StorageClass'
+_INVENTORY_ROWS = [
+    ['hm.samples', '0.txt', 'v1', 'true', 'false', '6', '2017-11-28T10:12:09.000Z', 'STANDARD'],
+    ['hm.samples', '1.txt', 'v1', 'true', 'false', '6', '2017-11-29T10:12:09.000Z', 'STANDARD'],
+    ['hm.samples', '1.txt', 'v0', 'false', 'false', '6', '2017-11-27T10:12:09.000Z', 'STANDARD'],
+    ['hm.samples', '2.txt', 'v1', 'true', 'true', '', '2017-11-30T10:12:09.000Z', 'STANDARD'],
+    ['hm.samples', 'old.txt', 'v1', 'true', 'false', '10', '2016-01-01T00:00:00.000Z', 'GLACIER'],
+    ['hm.samples', 'ia.txt', 'v1', 'true', 'false', '7', '2016-01-01T00:00:00.000Z', 'STANDARD_IA'],
+]
+
+def _write_inventory_manifest(tmpdir, file_format, data_keys):
+    manifest_dir = tmpdir.mkdir('hm.samples').mkdir('daily').mkdir('2017-12-01T00-00Z')
+    manifest_dir.join('manifest.json').write(json.dumps({
+        'sourceBucket': 'hm.samples',
+        'destinationBucket': 'arn:aws:s3:::hm.inventory',
+        'version': '2016-11-30',
+        'creationTimestamp': '1512086400000',
+        'fileFormat': file_format,
+        'fileSchema': _INVENTORY_SCHEMA,
+        'files': [{'key': key, 'size': 0, 'MD5checksum': ''} for key in data_keys]
+    }))
+    return tmpdir.join('hm.samples', 'daily').mkdir('data')
+
+def _no_aws(monkeypatch):
+    """The inventory reports are read without AWS credentials"""
+    s3_storage_analyser.stop_pool()
+    def _get_client(*args, **kwargs):
+        raise AssertionError('No AWS call expected')
+    monkeypatch.setattr(s3_storage_analyser, '_get_client', _get_client)
+
+def _check_inventory_stats(tmpdir):
+    stats = s3_storage_analyser.inventory_bucket_stats(f'file://{tmpdir}', conc=1)
+    s3_storage_analyser._POOL_SIZE[0] = None
+    assert len(stats) == 1
+    assert stats[0]['Name'] == 'hm.samples'
+    assert stats[0]['Region'] == 'unknown'
+    assert stats[0]['TotalFiles'] == 6
+    assert stats[0]['TotalSize'] == 41
+    storage_stats = stats[0]['StorageStats']
+    assert storage_stats['STANDARD']['TotalFiles'] == 4
+    assert storage_stats['STANDARD']['LastModified'] == datetime(2017, 11, 29, 10, 12, 9, tzinfo=pytz.utc)
+    assert storage_stats['GLACIER']['TotalSize'] == 10
+    assert storage_stats['STANDARD_IA']['TotalSize'] == 7
+    s3_storage_analyser.update_s3_gauges(stats)
+
+def test_inventory_csv(monkeypatch, tmpdir):
+    """Test aggregating gzipped CSV inventory reports"""
+    _no_aws(monkeypatch)
+    keys = ['hm.samples/daily/data/a.csv.gz', 'hm.samples/daily/data/b.csv.gz']
+    data_dir = _write_inventory_manifest(tmpdir, 'CSV', keys)
+    for key, rows in zip(keys, [_INVENTORY_ROWS, _INVENTORY_ROWS[:2]]):
+        with gzip.open(str(data_dir.join(os.path.basename(key))), 'wt', newline='') as file:
+            csv.writer(file, quoting=csv.QUOTE_ALL).writerows(rows)
+    _check_inventory_stats(tmpdir)
+
+def test_inventory_parquet(monkeypatch, tmpdir):
+    """Test aggregating parquet inventory reports"""
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    _no_aws(monkeypatch)
+    keys = ['hm.samples/daily/data/a.parquet', 'hm.samples/daily/data/b.parquet']
+    data_dir = _write_inventory_manifest(tmpdir, 'Parquet', keys)
+    # undated.parquet has no dates: its max is None
+    undated = [row[:6] + [None] + row[7:] for row in _INVENTORY_ROWS[:1]]
+    for key, rows in zip(keys + ['undated.parquet'], [_INVENTORY_ROWS, _INVENTORY_ROWS[:2], undated]):
+        pq.write_table(pa.table({
+            'bucket': [row[0] for row in rows],
+            'key': [row[1] for row in rows],
+            'is_latest': [row[3] == 'true' for row in rows],
+            'is_delete_marker': [row[4] == 'true' for row in rows],
+            'size': [int(row[5]) if row[5] else None for row in rows],
+            'last_modified_date': pa.array([s3_storage_analyser._parse_inventory_date(row[6])
+                                            if row[6] else None for row in rows],
+                                           pa.timestamp('ms', tz='UTC')),
+            'storage_class': [row[7] for row in rows]
+        }), str(data_dir.join(os.path.basename(key))))
+    _check_inventory_stats(tmpdir)
+    assert s3_storage_analyser.parse_inventory_file({
+        'Path': str(data_dir.join('undated.parquet')), 'Format': 'Parquet'}) == {
+            'hm.samples': {'STANDARD': {
+                'TotalSize': 6, 'TotalFiles': 1,
+                'LastModified': datetime(1970, 1, 1, tzinfo=timezone.utc)}}}
+
+def test_paginate_iterative_prefetch():
+    """Test the paginator loops over many pages and prefetches the next one"""
+    calls = []
+    prefetched = threading.Event()
+    def _call(**kwargs):
+        calls.append(kwargs['Page'])
+        if kwargs['Page'] == 1:
+            prefetched.set()
+        return {'Items': [kwargs['Page']], 'Next': kwargs['Page'] + 1}
+    def _next_page(kwargs, res):
+        if res['Next'] >= 5000:
+            return None
+        kwargs['Page'] = res['Next']
+        return kwargs
+    pages = s3_storage_analyser._paginate(_call, _next_page, Page=0)
+    first = next(pages)
+    assert first['Items'] == [0]
+    # the second page is requested before the first one is consumed
+    assert prefetched.wait(5)
+    # no recursion: more pages than the recursion limit
+    assert sum(len(page['Items']) for page in pages) == 4999
+    assert len(calls) == 5000
+
+def test_client_cache(monkeypatch):
+    """Test the clients are created once per process"""
+    client = s3_storage_analyser._get_client('cloudwatch', 'eu-west-1')
+    assert s3_storage_analyser._get_client('cloudwatch', 'eu-west-1') is client
+    assert s3_storage_analyser._get_client('cloudwatch', 'us-east-1') is not client
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    assert s3_storage_analyser._get_client('cloudwatch', 'eu-west-1') is not client
+
+def test_conc_map_executors():
+    """Test the thread pool keeps the order of the results"""
+    s3_storage_analyser.set_pool(conc=8, executor='thread')
+    try:
+        assert list(s3_storage_analyser.conc_map(abs, range(-100, 0))) == list(range(100, 0, -1))
+        assert list(s3_storage_analyser.conc_map(abs, [-1, 2], chunksize=1)) == [1, 2]
+    finally:
+        s3_storage_analyser.set_pool(executor='process')
+        s3_storage_analyser._POOL_SIZE[0] = None
+
+@mock_cloudwatch
+@mock_s3
+def test_raw_s3_thread_executor(monkeypatch):
+    """Test the raw analysis in a pool of threads"""
+    _setup(monkeypatch)
+    try:
+        stats = s3_storage_analyser.s3_bucket_stats(conc=4, ranges=2, executor='thread')
+        assert stats[0]['TotalFiles'] == 4
+    finally:
+        s3_storage_analyser.set_pool(executor='process')
+        s3_storage_analyser._POOL_SIZE[0] = None
+
+@mock_cloudwatch
+@mock_s3
+def test_raw_s3_api_stats(monkeypatch, tmpdir):
+    """Test the AWS calls of the worker processes are counted and exported with the phases"""
+    monkeypatch.setenv('S3_PROM_TEXT', str(tmpdir.join('s3.prom')))
+    _setup(monkeypatch)
+    s3_storage_analyser._API_STATS.clear()
+    s3_storage_analyser.s3_analysis(conc=2, ranges=2)
+    api_stats = s3_storage_analyser._API_STATS
+    assert api_stats[('s3', 'ListBuckets', 'us-east-1')]['Calls'] == 1
+    # listed by the workers
+    list_stats = api_stats[('s3', 'ListObjectsV2', 'us-east-1')]
+    assert list_stats['Calls'] >= 2
+    assert sum(list_stats['LatencyHistogram']) == list_stats['Calls']
+    assert list_stats['Errors'] == 0
+    text = tmpdir.join('s3.prom').read()
+    assert ('s3analyser_api_calls_total{operation="ListBuckets",region="us-east-1",service="s3"} 1.0'
+            in text)
+    assert 's3analyser_api_latency_seconds_bucket{' in text
+    assert 's3analyser_phase_seconds{analysis="s3",phase="traverse"}' in text
+    s3_storage_analyser._POOL_SIZE[0] = None
+
+def test_api_stats_throttles():
+    """Test the throttled attempts and the failed calls are counted"""
+    s3_storage_analyser._API_STATS.clear()
+    operation = type('Operation', (), {'name': 'GetMetricStatistics'})
+    http_response = type('Response', (), {'status_code': 400})
+    throttled = {'Error': {'Code': 'Throttling'}}
+    assert s3_storage_analyser._on_api_attempt(
+        'cloudwatch', 'eu-west-1', (http_response, throttled), operation) is None
+    s3_storage_analyser._on_api_attempt('cloudwatch', 'eu-west-1', (http_response, {}), operation)
+    s3_storage_analyser._on_api_attempt('cloudwatch', 'eu-west-1', None, operation)
+    s3_storage_analyser._after_api_call_error(
+        'cloudwatch', 'eu-west-1', 'after-call-error.cloudwatch.GetMetricStatistics', {})
+    stats = s3_storage_analyser._API_STATS[('cloudwatch', 'GetMetricStatistics', 'eu-west-1')]
+    assert stats['Throttles'] == 1
+    assert stats['Calls'] == 1
+    assert stats['Errors'] == 1
+
+def test_adaptive_limiter():
+    """Test the limit grows while the calls are fast and is halved once per round trip"""
+    limiter = s3_storage_analyser._AdaptiveLimiter(maximum=16, initial=2)
+    for _ in range(0, 4):
+        limiter.acquire()
+        limiter.release(latency=0.1)
+    # slow start
+    assert limiter.limit == 6
+    limiter.acquire()
+    limiter.release(latency=1.0)
+    assert limiter.limit == 6
+    start = s3_storage_analyser.perf_counter()
+    limiter.throttled(start)
+    limiter.throttled(start)
+    assert limiter.limit == 3
+    limiter.throttled(s3_storage_analyser.perf_counter())
+    assert limiter.limit == 1.5
+    # additive increase
+    for _ in range(0, 200):
+        limiter.acquire()
+        limiter.release(latency=0.1)
+    assert limiter.limit == 16
+    assert limiter.in_flight == 0
+
+def test_adaptive_retry(monkeypatch):
+    """Test a throttled call limited adaptively is retried after a jittered delay"""
+    limiter = s3_storage_analyser._AdaptiveLimiter(maximum=8)
+    operation = type('Operation', (), {'name': 'ListObjectsV2'})
+    slow_down = type('Response', (), {'status_code': 503})
+    context = {'_api_limiter': limiter, '_api_call_start': s3_storage_analyser.perf_counter()}
+    delay = s3_storage_analyser._on_api_attempt(
+        's3', 'us-east-1', (slow_down, {'Error': {'Code': 'SlowDown'}}), operation,
+        attempts=5, request_dict={'context': context})
+    assert 0 <= delay <= 0.1 * 2 ** 5
+    assert limiter.limit == 2
+    assert s3_storage_analyser._on_api_attempt(
+        's3', 'us-east-1', (slow_down, {}), operation,
+        attempts=s3_storage_analyser._ADAPTIVE_MAX_ATTEMPTS, request_dict={'context': context}) is None
+
+@mock_cloudwatch
+@mock_s3
+def test_raw_s3_adaptive(monkeypatch, tmpdir):
+    """Test the raw analysis with the adaptive limits of the AWS calls"""
+    monkeypatch.setenv('S3_PROM_TEXT', str(tmpdir.join('s3.prom')))
+    _setup(monkeypatch)
+    try:
+        stats = s3_storage_analyser.s3_analysis(conc=4, ranges=2, executor='thread', adaptive=True)
+        assert stats[0]['TotalFiles'] == 4
+        limiter = s3_storage_analyser._LIMITERS[('s3', 'us-east-1')]
+        assert limiter.in_flight == 0
+        assert limiter.limit > s3_storage_analyser._ADAPTIVE_INITIAL_LIMIT
+        assert 's3analyser_concurrency_limit{region="us-east-1",service="s3"}' in \
+            tmpdir.join('s3.prom').read()
+    finally:
+        s3_storage_analyser.set_pool(executor='process', adaptive=False)
+        s3_storage_analyser._POOL_SIZE[0] = None
+
+@mock_cloudwatch
+@mock_s3
+def test_coordinator(monkeypatch, tmpdir):
+    """Test the shards scanned by the workers of a coordinator give the stats of a local scan"""
+    _setup(monkeypatch)
+    client = boto3.client('s3')
+    for folder in ['a', 'b', 'c/d']:
+        client.put_object(Bucket='hm.samples', Body=b'abc', Key=f'{folder}/small.txt')
+    expected = s3_storage_analyser.s3_bucket_stats(conc=1, prefix_depth=1)
+    buckets = s3_storage_analyser.list_buckets()
+    queue = coordinator.ShardQueue(str(tmpdir.join('shards.sqlite')))
+    queue.add(buckets, s3_storage_analyser.plan_key_ranges(buckets, ranges=3, prefix_depth=1))
+    assert queue.counts() == {'pending': 3, 'leased': 0, 'done': 0, 'failed': 0}
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(s3_storage_analyser.TraversalCancelled):
+        s3_storage_analyser.traverse_key_range({'Bucket': buckets[0], '_cancel': cancel})
+    server = coordinator.CoordinatorServer(queue, host='localhost', port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f'http://localhost:{server.server_address[1]}'
+        assert coordinator.work(url, conc=1) == 3
+        assert server.finished.is_set()
+        assert coordinator._post(url, '/lease')[0] == 410
+    finally:
+        server.shutdown()
+        server.server_close()
+    # the results are kept in the database
+    queue.close()
+    queue = coordinator.ShardQueue(str(tmpdir.join('shards.sqlite')))
+    stats = queue.bucket_stats()
+    assert stats[0]['TotalFiles'] == expected[0]['TotalFiles'] == 7
+    assert stats[0]['StorageStats'] == expected[0]['StorageStats']
+    assert stats[0]['TopPrefixes'] == expected[0]['TopPrefixes']
+    assert stats[0]['CreationDate'] == expected[0]['CreationDate']
+    queue.close()
+    s3_storage_analyser._POOL_SIZE[0] = None
+
+def test_shard_queue_leases(monkeypatch, tmpdir):
+    """Test an expired lease is leased again and only the holder of a lease completes its shard"""
+    queue = coordinator.ShardQueue(str(tmpdir.join('shards.sqlite')), lease_seconds=-1)
+    bucket = {'Name': 'hm.samples', 'Region': 'us-east-1',
+              'CreationDate': datetime(2017, 11, 16, tzinfo=timezone.utc)}
+    queue.add([bucket], [{'Bucket': bucket, '_checkpoint': None}])
+    lease = queue.lease()
+    assert lease['KeyRange']['Bucket']['Name'] == 'hm.samples'
+    assert '_checkpoint' not in lease['KeyRange']
+    # the worker died: its lease expired
+    second = queue.lease()
+    assert second['Id'] == lease['Id']
+    assert not queue.renew(lease['Id'], lease['Lease'])
+    queue.lease_seconds = 300
+    assert queue.renew(second['Id'], second['Lease'])
+    assert queue.lease() is None
+    # only the holder of the lease completes or releases the shard
+    assert not queue.complete(lease['Id'], lease['Lease'], {'StorageStats': {}, 'Prefixes': None})
+    assert not queue.release(lease['Id'], lease['Lease'])
+    assert queue.release(second['Id'], second['Lease'])
+    for _attempt in range(3, coordinator.MAX_ATTEMPTS):
+        third = queue.lease()
+        assert queue.release(third['Id'], third['Lease'])
+    assert queue.counts()['pending'] == 1
+    last = queue.lease()
+    assert queue.release(last['Id'], last['Lease'])
+    assert queue.counts() == {'pending': 0, 'leased': 0, 'done': 0, 'failed': 1}
+    assert queue.finished()
+    # the shard crashes its workers: its leases expire
+    queue.add([bucket], [{'Bucket': bucket}])
+    queue.lease_seconds = -1
+    for _attempt in range(0, coordinator.MAX_ATTEMPTS):
+        assert queue.lease() is not None
+    assert queue.lease() is None
+    assert queue.counts()['failed'] == 1
+    assert queue.finished()
+    queue.lease_seconds = 300
+    queue.add([bucket], [{'Bucket': bucket}])
+    lease = queue.lease()
+    assert queue.complete(lease['Id'], lease['Lease'], {'StorageStats': {}, 'Prefixes': None})
+    assert not queue.complete(lease['Id'], lease['Lease'], {'StorageStats': {}, 'Prefixes': None})
+    assert queue.finished()
+    # no token: only served on localhost
+    monkeypatch.delenv('TOKEN', raising=False)
+    with pytest.raises(ValueError):
+        coordinator.CoordinatorServer(queue, host='', port=0)
+    queue.close()
+
+def test_coordinator_worker_failures(monkeypatch):
+    """Test a failed scan releases its shard, a lost lease cancels the scan
+    and a worker carries on when the coordinator cannot be reached"""
+    lease = {'Id': 1, 'Lease': 'lease', 'LeaseSeconds': 0.03, 'KeyRange': {'Bucket': {
+        'Name': 'hm.samples', 'Region': 'us-east-1', 'CreationDate': 1510790400.0}}}
+    leases = iter([(200, lease)] * 4 + [(410, None)])
+    posts = []
+    scans = []
+    def _post(_url, path, _params=None):
+        posts.append(path)
+        if path == '/lease':
+            return next(leases)
+        if path.endswith('/release'):
+            return 204, None
+        # the second scan loses its lease at its first renewal;
+        # the coordinator is unreachable for the others
+        if path.endswith('/renew') and len(scans) == 2:
+            return 409, None
+        raise URLError('Connection refused')
+    monkeypatch.setattr(coordinator, '_post', _post)
+    def _traverse_key_range(key_range):
+        scans.append(key_range)
+        if len(scans) == 1:
+            raise ValueError('Access Denied')
+        if len(scans) == 3:
+            return {'StorageStats': {}, 'Prefixes': None}
+        assert key_range['_cancel'].wait(5)
+        raise s3_storage_analyser.TraversalCancelled()
+    monkeypatch.setattr(coordinator, 'traverse_key_range', _traverse_key_range)
+    assert coordinator._work_loop({'url': 'http://localhost:8001'}) == 0
+    assert len(scans) == 4
+    assert [path for path in posts if not path.endswith('/renew')] == [
+        '/lease', '/shards/1/release', '/lease', '/lease', '/shards/1', '/lease', '/lease']
+    # the lease is lost once it expired without being renewed
+    assert posts[-2:] == ['/shards/1/renew', '/lease']
+
+def test_snapshots(monkeypatch, tmpdir):
+    """Test the backfill keeps one datapoint per day and only the missing days are fetched"""
+    buckets, metrics = _fake_buckets_metrics(2)
+    calls = []
+    def _mock_get_stats(**req):
+        calls.append(req['StartTime'])
+        days = (req['EndTime'] - req['StartTime']).days
+        growth = 1000.0 if req['MetricName'] == 'BucketSizeBytes' else 10.0
+        return {'Datapoints': [{
+            'Average': growth * (30 - day),
+            'Timestamp': pytz.utc.localize(req['EndTime'] - timedelta(days=day))
+        } for day in range(1, days + 1)]}
+    monkeypatch.setattr(s3_storage_analyser, '_get_metric_statistics', _mock_get_stats)
+    store = s3_storage_analyser.SnapshotStore(str(tmpdir.join('snapshots.sqlite')))
+    data = s3_storage_analyser.get_metrics_snapshots(metrics, buckets, store, days=7)
+    assert len(calls) == len(metrics)
+    assert len(data) == len(metrics)
+    folded = fold_metrics_data(data)
+    assert folded['bybucket']['hm.bucket00001']['Files'] == 290.0
+    assert folded['bybucket']['hm.bucket00001']['Bytes-ST'] == 29000.0
+    assert len(store.known('2000-01-01')) == 7 * len(metrics)
+    # nothing is missing
+    calls.clear()
+    assert s3_storage_analyser.get_metrics_snapshots(metrics, buckets, store, days=7) == data
+    assert calls == []
+    # 3 more days of history: one call per metric from the first missing day
+    s3_storage_analyser.get_metrics_snapshots(metrics, buckets, store, days=10)
+    assert calls == [_today() - timedelta(days=10)] * len(metrics)
+    growth = store.growth(9)
+    assert growth[0]['Bucket'] == 'hm.bucket00000'
+    assert growth[0]['From'] == (_today() - timedelta(days=10)).date().isoformat()
+    # the size of the storage types; not counted twice with AllStorageTypes
+    assert growth[0]['Bytes'] == (20000.0, 29000.0)
+    assert growth[0]['Files'] == (200.0, 290.0)
+    report = s3_storage_analyser.format_growth_report(growth, unit='KB')
+    assert '8.79' in report
+    store.close()
+
+def test_snapshots_empty_days(monkeypatch, tmpdir):
+    """Test the days without a datapoint are fetched once"""
+    buckets, metrics = _fake_buckets_metrics(1)
+    calls = []
+    published = [False]
+    def _mock_get_stats(**req):
+        calls.append(req['StartTime'])
+        # only the latest day has a datapoint, once it is published
+        if not published[0]:
+            return {'Datapoints': []}
+        return {'Datapoints': [{
+            'Average': 1.0, 'Timestamp': pytz.utc.localize(req['EndTime'] - timedelta(days=1))}]}
+    monkeypatch.setattr(s3_storage_analyser, '_get_metric_statistics', _mock_get_stats)
+    store = s3_storage_analyser.SnapshotStore(str(tmpdir.join('snapshots.sqlite')))
+    assert s3_storage_analyser.get_metrics_snapshots(metrics, buckets, store, days=7) == []
+    assert len(calls) == len(metrics)
+    assert len(store.known('2000-01-01')) == 6 * len(metrics)
+    # the latest day is fetched again until it is published
+    calls.clear()
+    published[0] = True
+    data = s3_storage_analyser.get_metrics_snapshots(metrics, buckets, store, days=7)
+    assert calls == [_today() - timedelta(days=1)] * len(metrics)
+    assert len(data) == len(metrics)
+    calls.clear()
+    assert s3_storage_analyser.get_metrics_snapshots(metrics, buckets, store, days=7) == data
+    assert calls == []
+    store.close()
+
+def test_server_cache(monkeypatch):
+    """Test the folded analysis is cached per prefix and rendered in every format"""
+    buckets, metrics = _fake_buckets_metrics(2)
+    data = [dict(bucket, BucketName=bucket['Name'], MetricName='NumberOfObjects',
+                 StorageType='AllStorageTypes', Value=4.0) for bucket in buckets]
+    calls = []
+    def _analyse_folded(**kwargs):
+        calls.append(kwargs['prefix'])
+        return fold_metrics_data(data)
+    monkeypatch.setattr(server, 'analyse_folded', _analyse_folded)
+    monkeypatch.setattr(server, 'CACHE_TTL', [100])
+    monkeypatch.setattr(server, 'ANALYSIS_CACHE', {})
+    json_out = server._run_analysis(fmt='json')
+    assert server._run_analysis(fmt='json') is json_out
+    assert b'hm.bucket00001' in b''.join(server._run_analysis(fmt='csv', unit='KB'))
+    assert b'hm.bucket00001' in server._run_analysis(fmt='json_pretty')
+    assert calls == [None]
+    server._run_analysis(fmt='json', prefix='hm.bucket0000*')
+    assert calls == [None, 'hm.bucket0000*']
+
+    # about to expire: served from the cache and refreshed in the background
+    server.ANALYSIS_CACHE[None]['Time'] -= 90
+    assert server._run_analysis(fmt='json') is json_out
+    for _ in range(0, 50):
+        if len(calls) == 3 and not server.LOCK_ANALYSIS.locked():
+            break
+        threading.Event().wait(0.1)
+    assert calls == [None, 'hm.bucket0000*', None]
+    assert server._run_analysis(fmt='json') is not json_out
+
+def test_server_cache_single_refresh(monkeypatch):
+    """Test the concurrent requests of an entry about to expire start a single refresh"""
+    monkeypatch.setattr(server, 'analyse_folded', lambda **_kwargs: fold_metrics_data([]))
+    monkeypatch.setattr(server, 'CACHE_TTL', [100])
+    monkeypatch.setattr(server, 'ANALYSIS_CACHE', {})
+    server._run_analysis(fmt='json')
+    server.ANALYSIS_CACHE[None]['Time'] -= 90
+    refreshes = []
+    release = threading.Event()
+    def _refresh_in_background(args, full_cmd, entry):
+        # not in flight yet
+        refreshes.append(args.prefix)
+        release.wait(5)
+        with server.LOCK_IN_FLIGHT:
+            entry['Refreshing'] = False
+    monkeypatch.setattr(server, '_refresh_in_background', _refresh_in_background)
+    threads = [threading.Thread(target=server._run_analysis, kwargs={'fmt': 'json'})
+               for _ in range(0, 8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    release.set()
+    assert refreshes == [None]
+
+def test_stream_formats():
+    """Test the streamed reports are the same as the formatted ones"""
+    buckets, _ = _fake_buckets_metrics(3)
+    folded = fold_metrics_data([dict(bucket, BucketName=bucket['Name'], MetricName='NumberOfObjects',
+                                     StorageType='AllStorageTypes', Value=4.0) for bucket in buckets])
+    for fmt in ['csv', 'tsv', 'ndjson']:
+        out = StringIO()
+        s3_storage_analyser.write_report(folded, out, unit='KB', fmt=fmt)
+        assert out.getvalue() == format_report(folded, unit='KB', fmt=fmt) + '\n'
+    lines = list(s3_storage_analyser.iter_report_lines(folded, fmt='ndjson'))
+    assert len(lines) == 3
+    assert json.loads(lines[2])['Bucket'] == 'hm.bucket00002'
+    assert json.loads(lines[2])['CreationDate'] == '2017-11-16T00:00:00'
+
+def test_server_chunked(monkeypatch):
+    """Test the csv, tsv and ndjson reports are sent in chunks"""
+    buckets, _ = _fake_buckets_metrics(50)
+    data = [dict(bucket, BucketName=bucket['Name'], MetricName='NumberOfObjects',
+                 StorageType='AllStorageTypes', Value=4.0) for bucket in buckets]
+    monkeypatch.setattr(server, 'analyse_folded', lambda **_kwargs: fold_metrics_data(data))
+    monkeypatch.setattr(server, 'ANALYSIS_CACHE', {})
+    monkeypatch.setattr(server, 'STREAM_CHUNK_SIZE', 256)
+    monkeypatch.setenv('S3ANALYSER_PORT', '0')
+    monkeypatch.setenv('TOKEN', 'hi')
+    chunks = list(server._run_analysis(fmt='ndjson'))
+    assert len(chunks) > 1
+    http_server = server.make_server()
+    threading.Thread(target=http_server.serve_forever).start()
+    try:
+        conn = http.client.HTTPConnection('localhost', http_server.server_address[1])
+        conn.request('GET', '/api/?token=hi', headers={'Accept': 'application/x-ndjson'})
+        res = conn.getresponse()
+        assert res.status == 200
+        assert res.getheader('Transfer-Encoding') == 'chunked'
+        assert res.read() == b''.join(chunks)
+        # the connection is kept alive
+        conn.request('GET', '/api/?token=hi&fmt=json')
+        res = conn.getresponse()
+        assert json.loads(res.read())['Buckets'][49]['Bucket'] == 'hm.bucket00049'
+        conn.close()
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+
+def test_server_streamed_pipeline(monkeypatch):
+    """Test the first chunk of a pipelined analysis is sent before the analysis is over"""
+    buckets, _ = _fake_buckets_metrics(2)
+    folded = fold_metrics_data([dict(bucket, BucketName=bucket['Name'], MetricName='NumberOfObjects',
+                                     StorageType='AllStorageTypes', Value=4.0) for bucket in buckets])
+    received = threading.Event()
+    def _iter_pipeline_folded(_folded, **_kwargs):
+        yield [folded['bybucket']['hm.bucket00000']]
+        assert received.wait(5)
+        yield [folded['bybucket']['hm.bucket00001']]
+    monkeypatch.setattr(server, 'iter_pipeline_folded', _iter_pipeline_folded)
+    monkeypatch.setattr(server, 'ANALYSIS_CACHE', {})
+    monkeypatch.setenv('S3ANALYSER_PORT', '0')
+    monkeypatch.setenv('TOKEN', 'hi')
+    http_server = server.make_server()
+    threading.Thread(target=http_server.serve_forever).start()
+    try:
+        conn = http.client.HTTPConnection('localhost', http_server.server_address[1])
+        conn.request('GET', '/api/?token=hi&fmt=csv&pipeline=1')
+        res = conn.getresponse()
+        assert res.status == 200
+        assert res.readline().startswith(b'Bucket,Region,')
+        assert res.readline().startswith(b'hm.bucket00000,')
+        received.set()
+        assert res.read().startswith(b'hm.bucket00001,')
+        conn.close()
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+        s3_storage_analyser._POOL_SIZE[0] = None
+    assert not server.IN_FLIGHT
+
+def test_server_single_flight(monkeypatch):
+    """Test the concurrent requests for a prefix share the analysis in flight"""
+    buckets, metrics = _fake_buckets_metrics(1)
+    data = [dict(buckets[0], BucketName=buckets[0]['Name'], MetricName='NumberOfObjects',
+                 StorageType='AllStorageTypes', Value=4.0)]
+    calls = []
+    release = threading.Event()
+    def _analyse_folded(**kwargs):
+        calls.append(kwargs['prefix'])
+        release.wait(5)
+        return fold_metrics_data(data)
+    monkeypatch.setattr(server, 'analyse_folded', _analyse_folded)
+    monkeypatch.setattr(server, 'CACHE_TTL', [0])
+    monkeypatch.setattr(server, 'MAX_QUEUED', [1])
+    results = []
+    def _request(prefix):
+        try:
+            results.append(server._run_analysis(fmt='json', prefix=prefix))
+        except ValueError as err:
+            results.append(err)
+    threads = [threading.Thread(target=_request, args=(prefix,))
+               for prefix in ['hm.a*', 'hm.a*', 'hm.a*', 'hm.b*']]
+    for thread in threads:
+        thread.start()
+    for _ in range(0, 50):
+        if len(server.IN_FLIGHT) == 2:
+            break
+        threading.Event().wait(0.1)
+    # let the other requests of 'hm.a*' join the flight
+    threading.Event().wait(0.2)
+    # one analysis running and one queued: no room for another prefix
+    _request('hm.c*')
+    assert 'Too many analyses queued' in str(results.pop())
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert sorted(calls) == ['hm.a*', 'hm.b*']
+    assert len(results) == 4
+    assert all(result.startswith(b'{"Buckets":') for result in results)
+    assert not server.IN_FLIGHT
+
+def test_server_metrics_from_memory(monkeypatch, tmpdir):
+    """Test /s3-metrics is served from memory, gzipped and with an ETag"""
+    monkeypatch.setenv('S3_PROM_TEXT', str(tmpdir.join('s3.prom')))
+    monkeypatch.setenv('S3ANALYSER_PORT', '0')
+    buckets, _ = _fake_buckets_metrics(2)
+    for bucket in buckets:
+        s3_storage_analyser._merge_storage_stats(bucket, [])
+    s3_storage_analyser.update_s3_gauges(buckets)
+    s3_storage_analyser.commit_s3_gauges()
+    http_server = server.make_server()
+    thread = threading.Thread(target=http_server.serve_forever)
+    thread.start()
+    try:
+        conn = http.client.HTTPConnection('localhost', http_server.server_address[1])
+        conn.request('GET', '/s3-metrics', headers={'Accept-Encoding': 'gzip'})
+        res = conn.getresponse()
+        assert res.status == 200
+        assert res.getheader('Content-Encoding') == 'gzip'
+        text = gzip.decompress(res.read()).decode()
+        assert 's3_size_bytes{' in text
+        etag = res.getheader('ETag')
+
+        conn.request('GET', '/s3-metrics', headers={'If-None-Match': etag})
+        res = conn.getresponse()
+        res.read()
+        assert res.status == 304
+
+        conn.request('GET', '/s3-metrics', headers={'Accept': 'application/openmetrics-text'})
+        res = conn.getresponse()
+        assert res.getheader('Content-Type').startswith('application/openmetrics-text')
+        assert res.read().decode().endswith('# EOF\n')
+    finally:
+        http_server.shutdown()
+        thread.join()
+
+def test_columnar_collector(monkeypatch, tmpdir):
+    """Test a new analysis replaces the whole gauge tables"""
+    monkeypatch.setenv('PROM_TEXT', str(tmpdir.join('cw.prom')))
+    buckets, _ = _fake_buckets_metrics(3)
+    data = [dict(bucket, BucketName=bucket['Name'], MetricName='BucketSizeBytes',
+                 StorageType='StandardStorage', Value=24.0) for bucket in buckets]
+    update_gauges(data)
+    text = s3_storage_analyser.generate_latest(s3_storage_analyser.REGISTRY[0]).decode()
+    assert 'cloudwatch_s3_size_bytes{bucket="hm.bucket00002",region="us-east-1",storage="st"} 24.0' in text
+    update_gauges(data[:1])
+    text = s3_storage_analyser.generate_latest(s3_storage_analyser.REGISTRY[0]).decode()
+    assert 'hm.bucket00000' in text
+    assert 'hm.bucket00002' not in text
+    # a table that the next S3 analysis does not produce is not exported anymore
+    monkeypatch.setenv('S3_PROM_TEXT', str(tmpdir.join('s3.prom')))
+    bucket_stats = benchmark.make_bucket_stats(2)
+    bucket_stats[0]['Sampled'] = True
+    s3_storage_analyser.update_s3_gauges(bucket_stats)
+    assert 's3_sampled' in s3_storage_analyser.generate_latest(s3_storage_analyser.REGISTRY[0]).decode()
+    s3_storage_analyser.update_s3_gauges(bucket_stats[1:])
+    text = s3_storage_analyser.generate_latest(s3_storage_analyser.REGISTRY[0]).decode()
+    assert 's3_sampled' not in text
+    assert 's3_size_bytes{bucket="bucket000001"' in text
+    assert 'hm.bucket00000' in text